@@ -0,0 +1,249 @@
+'''
+Incremental ensemble of probability maps
+
+./output/<accumulator_dir>/ keeps the running weighted sum of the probability maps (in %) of every pred_dir added,
+as one float32 map per image, so that adding or removing a model only reads the maps of that model:
+  sums/<img_name>.<num_ops>.npy: weighted sum after the first num_ops operations
+  ops.csv:     committed operations, one line of add/remove,pred_dir,weight each
+  pending.csv: the operation in progress, if any
+
+An operation writes the sum of each image under the next number of operations and then removes the old one,
+so an interrupted operation is resumed by running it again, skipping images that are already updated.
+An operation interrupted after it was committed to ops.csv but before pending.csv was removed is complete,
+and its pending.csv is removed when the accumulator is opened.
+'''
+
+import torch
+import torch.utils.data
+
+import os
+import csv
+import glob
+
+import numpy as np
+
+import util.const as const
+import util.load as load
+import util.ensemble as ensemble
+import util.submit as submit
+import util.run_length as run_length
+import util.threshold as threshold
+import util.exp as exp
+
+import dataloader
+
+
+def get_sum_path(accumulator_dir, img_name, num_ops):
+    return os.path.join(const.OUTPUT_DIR, accumulator_dir, 'sums', '{}.{}.npy'.format(img_name, num_ops))
+
+def read_ops(ops_path):
+    ops = []
+    if os.path.isfile(ops_path):
+        with open(ops_path, newline='') as f:
+            for row in csv.reader(f):
+                ops.append((row[0], row[1], float(row[2])))
+    return ops
+
+def write_ops(ops_path, ops):
+    with open(ops_path, 'w', newline='') as f:
+        csv.writer(f).writerows(ops)
+    return
+
+
+class AccumulateRunner(torch.utils.data.dataset.Dataset):
+    '''
+    add sign * weight * (probability map of pred_dir) to the sum of each image
+    '''
+    def __init__(self, accumulator_dir, img_names, pred_dir, weight, num_ops):
+        self.accumulator_dir = accumulator_dir
+        self.img_names = img_names
+        self.pred_dir = pred_dir
+        self.weight = weight
+        self.num_ops = num_ops
+        return
+
+    def __len__(self):
+        return len(self.img_names)
+
+    def __getitem__(self, idx):
+
+        img_name = self.img_names[idx]
+
+        old_path = get_sum_path(self.accumulator_dir, img_name, self.num_ops)
+        new_path = get_sum_path(self.accumulator_dir, img_name, self.num_ops + 1)
+
+        if not os.path.isfile(new_path):
+            img_sum = np.load(old_path).astype(np.float32) if os.path.isfile(old_path) else np.zeros(const.img_size, dtype=np.float32)
+
+            pred_path = os.path.join(const.OUTPUT_DIR, self.pred_dir, const.PROBS_DIR_NAME, img_name + '.npy')
+            img_sum += self.weight * np.load(pred_path)
+
+            # write to a temporary file first, so that a sum is either complete or missing
+            # float32 keeps rounding errors of repeated adds and removes far below the 1% bins of the masks
+            np.save(new_path + '.tmp.npy', img_sum)
+            os.replace(new_path + '.tmp.npy', new_path)
+
+        if os.path.isfile(old_path):
+            os.remove(old_path)
+
+        return img_name
+
+
+class FinalizeRunner(torch.utils.data.dataset.Dataset):
+    def __init__(self, accumulator_dir, img_names, num_ops, total_weight, mask_threshold):
+        self.accumulator_dir = accumulator_dir
+        self.img_names = img_names
+        self.num_ops = num_ops
+        self.total_weight = total_weight
+        self.threshold_bin = submit.get_threshold_bin(mask_threshold)
+        return
+
+    def __len__(self):
+        return len(self.img_names)
+
+    def __getitem__(self, idx):
+
+        img_name = self.img_names[idx]
+        img_sum = np.load(get_sum_path(self.accumulator_dir, img_name, self.num_ops)).astype(np.float32)
+
+        # floored like the int8 prob maps saved by EnsembleRunner, so the masks match run_rle.py on them
+        img_prob = submit.floor_ensembled_bins(img_sum, self.total_weight)
+
+        img_mask = submit.get_mask(img_prob, self.threshold_bin)
+
+        rle = run_length.encode(img_mask)
+        return img_name, rle
+
+
+class EnsembleAccumulator(object):
+    def __init__(self, accumulator_dir, loader_settings=None):
+        '''
+        input:
+          accumulator_dir: relative to ./output/, like pred_dirs
+        '''
+        self.accumulator_dir = accumulator_dir
+        self.loader_settings = loader_settings
+
+        accumulator_path = os.path.join(const.OUTPUT_DIR, accumulator_dir)
+        exp.create_dir_if_not_exist(os.path.join(accumulator_path, 'sums'))
+        self.ops_path = os.path.join(accumulator_path, 'ops.csv')
+        self.pending_path = os.path.join(accumulator_path, 'pending.csv')
+
+        self.clear_committed_pending()
+        return
+
+    def clear_committed_pending(self):
+        '''
+        remove pending.csv if its operation is the last one committed, i.e. run_op() stopped between committing and removing it
+        '''
+        pending_ops = read_ops(self.pending_path)
+        if len(pending_ops) == 0:
+            return
+
+        ops = read_ops(self.ops_path)
+        # the same operation can't be committed twice in a row, a model is added or removed only once
+        if len(ops) > 0 and pending_ops[0] == ops[-1] and len(self.get_img_names(len(ops) + 1)) == 0:
+            print('Operation {} was already committed'.format(pending_ops[0]))
+            os.remove(self.pending_path)
+        return
+
+    def get_models(self):
+        '''
+        output:
+          models: a dict of weights, with pred_dirs added and not removed as keys
+        '''
+        models = {}
+        for op, pred_dir, weight in read_ops(self.ops_path):
+            if op == 'add':
+                models[pred_dir] = weight
+            else:
+                del models[pred_dir]
+        return models
+
+    def get_img_names(self, num_ops):
+        sums_dir = os.path.join(const.OUTPUT_DIR, self.accumulator_dir, 'sums')
+        suffix = '.{}.npy'.format(num_ops)
+        return sorted(os.path.basename(path)[:-len(suffix)] for path in glob.glob(os.path.join(sums_dir, '*' + suffix)))
+
+    def run_op(self, op, pred_dir, weight):
+        '''
+        apply one add or remove operation, or resume it if it was interrupted
+        '''
+        pending_ops = read_ops(self.pending_path)
+        if len(pending_ops) > 0:
+            assert pending_ops[0] == (op, pred_dir, weight), \
+                'Operation {} was interrupted, run it again first'.format(pending_ops[0])
+        else:
+            write_ops(self.pending_path, [ (op, pred_dir, weight) ])
+
+        ops = read_ops(self.ops_path)
+        num_ops = len(ops)
+
+        # every model covers the same images, the ones with sums, or the first model's ones
+        pred_img_names = sorted(load.list_npy_in_dir(os.path.join(const.OUTPUT_DIR, pred_dir, const.PROBS_DIR_NAME)))
+        if num_ops > 0 and len(self.get_models()) > 0:
+            img_names = sorted(set(self.get_img_names(num_ops)) | set(self.get_img_names(num_ops + 1)))
+            assert img_names == pred_img_names, '{} does not have the same images as {}'.format(pred_dir, self.accumulator_dir)
+        else:
+            img_names = pred_img_names
+
+        sign = 1 if op == 'add' else -1
+        dataset = AccumulateRunner(self.accumulator_dir, img_names, pred_dir, sign * weight, num_ops)
+        loader = dataloader.make_loader(dataset, batch_size=1, shuffle=False, loader_settings=self.loader_settings)
+
+        for i, img_name in enumerate(loader):
+            if (i % 1000) == 0:
+                print('{} {}: {} / {}'.format(op, pred_dir, i, len(loader)))
+
+        # commit
+        write_ops(self.ops_path, ops + [ (op, pred_dir, weight) ])
+        os.remove(self.pending_path)
+        return
+
+    def add(self, pred_dir, weight):
+        assert pred_dir not in self.get_models(), '{} is already in {}'.format(pred_dir, self.accumulator_dir)
+        self.run_op('add', pred_dir, weight)
+        return
+
+    def remove(self, pred_dir):
+        models = self.get_models()
+        assert pred_dir in models, '{} is not in {}'.format(pred_dir, self.accumulator_dir)
+        self.run_op('remove', pred_dir, models[pred_dir])
+        return
+
+    def finalize(self, mask_threshold=None):
+        '''
+        save ./output/<accumulator_dir>/submission.csv of the ensemble of models currently added
+
+        input:
+          mask_threshold: threshold of ensembled probabilities, threshold.load_threshold() of accumulator_dir by default
+        '''
+        assert not os.path.isfile(self.pending_path), 'Operation {} was interrupted, run it again first'.format(read_ops(self.pending_path)[0])
+
+        models = self.get_models()
+        total_weight = sum(models.values())
+        assert total_weight > 0, 'No models in {}'.format(self.accumulator_dir)
+
+        # record the models ensembled, like EnsembleRunner does
+        models_ensembled_path = os.path.join(const.OUTPUT_DIR, self.accumulator_dir, 'models_ensembled.txt')
+        if os.path.isfile(models_ensembled_path):
+            os.remove(models_ensembled_path)
+        ensemble.create_models_ensembled(sorted(models.keys()), self.accumulator_dir)
+
+        if mask_threshold is None:
+            mask_threshold = threshold.load_threshold(self.accumulator_dir)
+        print('Finalizing {} models with threshold {}'.format(len(models), mask_threshold))
+
+        num_ops = len(read_ops(self.ops_path))
+        dataset = FinalizeRunner(self.accumulator_dir, self.get_img_names(num_ops), num_ops, total_weight, mask_threshold)
+        loader = dataloader.make_loader(dataset, batch_size=1, shuffle=False, loader_settings=self.loader_settings)
+
+        img_rles = {}
+        for i, (img_name, rle) in enumerate(loader):
+            img_rles[img_name[0]] = rle[0]
+
+            if (i % 1000) == 0:
+                print('Finalize: {} / {}'.format(i, len(loader)))
+
+        submit.save_predictions(self.accumulator_dir, img_rles)
+        return
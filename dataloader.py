@@ -2,13 +2,19 @@ import torch
 import torch.utils.data
 from torchvision import transforms
 
+import os
 import random
-from random import randrange
+
+import numpy as np
 
 import util.const as const
 import util.load as load
 import util.tile as tile
 import util.augmentation as augmentation
+import util.distributed as distributed
+import util.val_cache as val_cache
+import util.aug_cache as aug_cache
+import util.boundary as boundary
 
 
 __all__ = [
@@ -18,12 +24,76 @@ __all__ = [
     'get_train_loader',
     'get_val_loader',
     'get_test_loader',
+    'get_tta_test_loader',
+    'get_cached_val_loader',
+    'get_aug_cache_loader',
+
+    'get_loader_settings',
 ]
 
+
+# used when the experiment config has no 'loader' section
+default_loader_settings = {
+    'num_workers': 8,
+    'prefetch_factor': 2,
+    'pin_memory': False,
+    'persistent_workers': False,
+    'cpu_affinity': None,  # a list of CPU core ids to pin workers to, one core per worker in turn
+}
+
+def get_loader_settings(cfg=None, **overrides):
+    '''
+    get DataLoader settings from the 'loader' section of an experiment config
+    '''
+    settings = dict(default_loader_settings)
+
+    if cfg is not None:
+        settings.update(cfg.get('loader', None) or {})
+
+    settings.update(overrides)
+    return settings
+
+def make_worker_init_fn(cpu_affinity):
+    if not cpu_affinity:
+        return None
+
+    def worker_init_fn(worker_id):
+        core = cpu_affinity[worker_id % len(cpu_affinity)]
+        os.sched_setaffinity(0, [core])
+
+    return worker_init_fn
+
+def make_loader(dataset, batch_size, shuffle=False, sampler=None, loader_settings=None):
+    '''
+    create a DataLoader with settings from get_loader_settings()
+    '''
+    if loader_settings is None:
+        loader_settings = get_loader_settings()
+
+    num_workers = loader_settings['num_workers']
+
+    kwargs = {}
+    if num_workers > 0:
+        # only valid with worker processes
+        kwargs['prefetch_factor'] = loader_settings['prefetch_factor']
+        kwargs['persistent_workers'] = loader_settings['persistent_workers']
+        kwargs['worker_init_fn'] = make_worker_init_fn(loader_settings['cpu_affinity'])
+
+    loader = torch.utils.data.dataloader.DataLoader(
+                                dataset,
+                                batch_size=batch_size,
+                                shuffle=shuffle,
+                                sampler=sampler,
+                                num_workers=num_workers,
+                                pin_memory=loader_settings['pin_memory'] and torch.cuda.is_available(),
+                                **kwargs
+                            )
+    return loader
+
 class LargeDataset(torch.utils.data.dataset.Dataset):
     def __init__(self, data_dir, ids=None, mask_dir=None,
                  hflip_enabled=False, shift_enabled=False, color_enabled=False, rotate_enabled=False, scale_enabled=False, fancy_pca_enabled=False, edge_enh_enabled=False,
-                 test_time_aug=None, paddings=None, tile_size=None):
+                 test_time_aug=None, paddings=None, tile_size=None, resolution_scale=1, aug_seed=None, boundary_dir=None):
         self.data_dir = data_dir
 
         # process img names
@@ -34,13 +104,15 @@ class LargeDataset(torch.utils.data.dataset.Dataset):
 
         # compute tile borders from tile size
         if tile_size:
-            img_height, img_width = const.img_size
-            padded_img_size = img_height + 2 * paddings[0], img_width + 2 * paddings[1]
+            padded_img_size = tile.get_padded_img_size(paddings, resolution_scale)
             self.data_files = tile.generate_tile_names(self.data_files, tile_size, padded_img_size)
             _, self.tile_borders = tile.get_tile_layout(tile_size, padded_img_size)
 
         self.mask_dir = mask_dir
 
+        # boundary maps precomputed by util/boundary.py are returned as a fourth element if given
+        self.boundary_dir = boundary_dir
+
         self.hflip_enabled = hflip_enabled
         self.shift_enabled = shift_enabled
         self.color_enabled = color_enabled
@@ -64,6 +136,27 @@ class LargeDataset(torch.utils.data.dataset.Dataset):
         self.paddings = paddings
         self.tile_size = tile_size
 
+        # images are resized on load when training at reduced resolution
+        self.resolution_scale = resolution_scale
+        if resolution_scale != 1:
+            assert test_time_aug is None  # Test Time augmentation functions only work at full resolution
+            self.img_size = tile.get_scaled_img_size(paddings, resolution_scale)
+        else:
+            self.img_size = None
+
+        # decoded images are only cached when tiles of an image are loaded together, see set_img_cache_size()
+        self.img_cache = None
+
+        # augmentations are reproducible per (epoch, sample) when seeded, see get_rng()
+        self.aug_seed = aug_seed
+
+        return
+
+    def set_img_cache_size(self, img_cache_size):
+        '''
+        cache up to img_cache_size decoded images in each worker
+        '''
+        self.img_cache = load.ImageCache(img_cache_size) if img_cache_size > 0 else None
         return
 
     def get_tile_borders(self):
@@ -76,24 +169,42 @@ class LargeDataset(torch.utils.data.dataset.Dataset):
     def __len__(self):
         return len(self.data_files)
 
+    def get_rng(self, epoch, idx):
+        '''
+        a random generator for augmentations of sample idx in epoch
+
+        Without aug_seed, a freshly seeded generator is used, so that forked workers don't repeat each other.
+        '''
+        if self.aug_seed is None:
+            return np.random.default_rng()
+        return np.random.default_rng([self.aug_seed, epoch, idx])
+
     def __getitem__(self, idx):
+        # EpochSampler yields (epoch, idx) pairs
+        if isinstance(idx, tuple):
+            epoch, idx = idx
+        else:
+            epoch = 0
+        rng = self.get_rng(epoch, idx)
 
         img_name = self.data_files[idx]
 
         # randomly generate parameters for data augmentations
-        is_hflip = self.hflip_enabled and (random.random() < 0.5)
+        is_hflip = self.hflip_enabled and (rng.random() < 0.5)
         if self.shift_enabled:
-            vshift, hshift = randrange(-120, 120), randrange(-25, 25)
+            vshift, hshift = int(rng.integers(-120, 120)), int(rng.integers(-25, 25))
+            # shifts are in pixels of full resolution images
+            vshift, hshift = int(round(vshift * self.resolution_scale)), int(round(hshift * self.resolution_scale))
         else:
             vshift, hshift = 0, 0
-        if self.rotate_enabled and (random.random() < 0.5):
-            rotate = randrange(-5,5)
+        if self.rotate_enabled and (rng.random() < 0.5):
+            rotate = int(rng.integers(-5, 5))
         else:
             rotate = 0
-        is_fancy_pca_trans = self.fancy_pca_enabled and (random.random() < 0.5)
-        is_edge_enh_trans = self.edge_enh_enabled and (random.random() < 0.5)
-        if self.scale_enabled and (random.random() < 0.5):
-            scale_size = randrange(90,110)/100
+        is_fancy_pca_trans = self.fancy_pca_enabled and (rng.random() < 0.5)
+        is_edge_enh_trans = self.edge_enh_enabled and (rng.random() < 0.5)
+        if self.scale_enabled and (rng.random() < 0.5):
+            scale_size = int(rng.integers(90, 110))/100
         else:
             scale_size = 0
 
@@ -102,7 +213,8 @@ class LargeDataset(torch.utils.data.dataset.Dataset):
             self.data_dir, img_name,
             is_hflip=is_hflip, hshift=hshift, vshift=vshift, rotate=rotate, scale_size=scale_size,
             is_color_trans=self.color_enabled,  is_fancy_pca_trans=is_fancy_pca_trans, is_edge_enh_trans=is_edge_enh_trans,
-            test_time_aug=self.test_time_aug, paddings=self.paddings, tile_size=self.tile_size
+            test_time_aug=self.test_time_aug, paddings=self.paddings, tile_size=self.tile_size, img_size=self.img_size,
+            img_cache=self.img_cache, rng=rng
         )
 
         # load target
@@ -112,8 +224,18 @@ class LargeDataset(torch.utils.data.dataset.Dataset):
             target = load.load_train_mask(
                 self.mask_dir, img_name,
                 is_hflip=is_hflip, hshift=hshift, vshift=vshift, rotate=rotate, scale_size=scale_size,
-                test_time_aug=self.test_time_aug, paddings=self.paddings, tile_size=self.tile_size
+                test_time_aug=self.test_time_aug, paddings=self.paddings, tile_size=self.tile_size, img_size=self.img_size,
+                img_cache=self.img_cache
+            )
+
+        if self.boundary_dir is not None and not self.is_test():
+            boundary_map = load.load_boundary_map(
+                self.boundary_dir, img_name,
+                is_hflip=is_hflip, hshift=hshift, vshift=vshift, rotate=rotate, scale_size=scale_size,
+                paddings=self.paddings, tile_size=self.tile_size, img_size=self.img_size,
+                img_cache=self.img_cache
             )
+            return img_name, img, target, boundary_map
 
         return img_name, img, target
 
@@ -121,12 +243,181 @@ class LargeDataset(torch.utils.data.dataset.Dataset):
         return (self.mask_dir is None)
 
 
-def get_test_loader(batch_size, paddings, tile_size, test_time_aug):
+class PassSampler(torch.utils.data.sampler.Sampler):
+    '''
+    iterate over one pass, i.e. one Test Time Augmentation, of a ConcatDataset in order
+
+    Since samplers live in the main process, switching passes doesn't require re-spawning persistent workers.
+    '''
+    def __init__(self, concat_dataset):
+        self.datasets = concat_dataset.datasets
+        self.cumulative_sizes = [0] + list(concat_dataset.cumulative_sizes)
+        self.set_pass(0)
+
+    def set_pass(self, pass_idx):
+        self.pass_idx = pass_idx
+        self.start = self.cumulative_sizes[pass_idx]
+        self.end = self.cumulative_sizes[pass_idx + 1]
+        self.idxs = range(self.start, self.end)
+        return
+
+    def get_tile_names(self):
+        return self.datasets[self.pass_idx].data_files
+
+    def get_img_names(self):
+        return sorted(set(tile.get_img_name(tile_name) for tile_name in self.get_tile_names()))
+
+    def skip_imgs(self, img_names):
+        '''
+        skip all tiles of img_names in the current pass, e.g. images whose predictions are already cached
+        '''
+        img_names = set(img_names)
+        self.idxs = [ self.start + i for i, tile_name in enumerate(self.get_tile_names()) if tile.get_img_name(tile_name) not in img_names ]
+        return
+
+    def __iter__(self):
+        return iter(self.idxs)
+
+    def __len__(self):
+        return len(self.idxs)
+
+class ImageGroupedSampler(torch.utils.data.sampler.Sampler):
+    '''
+    shuffle at image (or car) level and load all tiles of an image close together on the same worker
+
+    DataLoader hands batch i to worker (i % num_workers). Groups of tiles, one per image or car, are dealt
+    to num_workers streams, and every stream shuffles the tiles of groups_per_worker groups at a time,
+    so each worker only needs a few decoded images in its cache while batches still mix several images.
+    '''
+    def __init__(self, tile_names, batch_size, num_workers, groups_per_worker=2, group_by='image', seed=0):
+        assert group_by in ('image', 'car')
+        self.batch_size = batch_size
+        self.num_streams = max(num_workers, 1)
+        self.groups_per_worker = groups_per_worker
+        self.seed = seed
+        self.epoch = 0
+
+        get_group = tile.get_img_name if group_by == 'image' else distributed.get_car_id
+        self.indices_by_group = {}
+        img_names_by_group = {}
+        for idx, tile_name in enumerate(tile_names):
+            group = get_group(tile_name)
+            self.indices_by_group.setdefault(group, []).append(idx)
+            img_names_by_group.setdefault(group, set()).add(tile.get_img_name(tile_name))
+        self.groups = sorted(self.indices_by_group.keys())
+        self.max_imgs_per_group = max([ len(img_names) for img_names in img_names_by_group.values() ] or [0])
+
+        self.num_samples = len(tile_names)
+
+    def get_img_cache_size(self):
+        '''
+        number of images each worker needs to cache to decode every image only once
+        '''
+        return self.groups_per_worker * self.max_imgs_per_group
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+        return
+
+    def __iter__(self):
+        rng = random.Random(self.seed + self.epoch)
+
+        groups = list(self.groups)
+        rng.shuffle(groups)
+
+        # shuffle tiles within a window of groups_per_worker groups of each stream
+        streams = []
+        for stream_idx in range(self.num_streams):
+            stream_groups = groups[stream_idx::self.num_streams]
+            stream = []
+            for i in range(0, len(stream_groups), self.groups_per_worker):
+                window = []
+                for group in stream_groups[i:i + self.groups_per_worker]:
+                    window += self.indices_by_group[group]
+                rng.shuffle(window)
+                stream += window
+            streams.append(stream)
+
+        # interleave full batches of streams, so batch i of a stream goes to the same worker as its previous batches
+        stream_batches = []
+        remainder = []
+        for stream in streams:
+            num_full = len(stream) // self.batch_size * self.batch_size
+            stream_batches.append([ stream[i:i + self.batch_size] for i in range(0, num_full, self.batch_size) ])
+            remainder += stream[num_full:]
+
+        indices = []
+        for batch_idx in range(max(len(batches) for batches in stream_batches)):
+            for batches in stream_batches:
+                if batch_idx < len(batches):
+                    indices += batches[batch_idx]
+        indices += remainder
+
+        return iter(indices)
+
+    def __len__(self):
+        return self.num_samples
+
+
+class SeededRandomSampler(torch.utils.data.sampler.Sampler):
+    '''
+    shuffle all samples in an order that only depends on seed and epoch
+    '''
+    def __init__(self, num_samples, seed=0):
+        self.num_samples = num_samples
+        self.seed = seed
+        self.epoch = 0
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+        return
+
+    def __iter__(self):
+        indices = list(range(self.num_samples))
+        random.Random(self.seed + self.epoch).shuffle(indices)
+        return iter(indices)
+
+    def __len__(self):
+        return self.num_samples
+
+class EpochSampler(torch.utils.data.sampler.Sampler):
+    '''
+    yield (epoch, idx) pairs of indices of sampler, so LargeDataset can seed augmentations per epoch and sample
+
+    The epoch is passed along with indices because persistent workers hold their own copy of the dataset.
+    '''
+    def __init__(self, sampler):
+        self.sampler = sampler
+        self.epoch = 0
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+        if hasattr(self.sampler, 'set_epoch'):
+            self.sampler.set_epoch(epoch)
+        return
+
+    def __iter__(self):
+        for idx in self.sampler:
+            yield (self.epoch, idx)
+
+    def __len__(self):
+        return len(self.sampler)
+
+
+def get_test_dataset(paddings, tile_size, test_time_aug, skip_img_names=None):
+    '''
+    input:
+      skip_img_names: names of images not to load, e.g. ones completed before test.py was interrupted
+    '''
     test_dir = const.TEST_DIR
 
     test_ids = load.list_img_in_dir(test_dir)
     test_ids.sort()
 
+    if skip_img_names:
+        skip_img_names = set(skip_img_names)
+        test_ids = [ test_id for test_id in test_ids if test_id not in skip_img_names ]
+
     print('Number of Test Images:', len(test_ids))
 
     test_dataset = LargeDataset(
@@ -148,22 +439,49 @@ def get_test_loader(batch_size, paddings, tile_size, test_time_aug):
 
 
     )
+    return test_dataset
+
+def get_test_loader(batch_size, paddings, tile_size, test_time_aug, loader_settings=None, skip_img_names=None):
+    test_dataset = get_test_dataset(paddings, tile_size, test_time_aug, skip_img_names)
     tile_borders = test_dataset.get_tile_borders()
 
-    test_loader = torch.utils.data.dataloader.DataLoader(
-                                test_dataset,
-                                batch_size=batch_size,
-                                shuffle=False, # For inference
-                                num_workers=8,
-                            )
+    test_loader = make_loader(test_dataset, batch_size, shuffle=False, loader_settings=loader_settings) # For inference
     return test_loader, tile_borders
 
-def get_trainval_loader(batch_size, car_ids, paddings, tile_size, hflip_enabled=False, shift_enabled=False, color_enabled=False, rotate_enabled=False, scale_enabled=False, fancy_pca_enabled=False, edge_enh_enabled=False, test_time_aug=None):
+def get_tta_test_loader(batch_size, paddings, tile_size, test_time_augs, loader_settings=None):
+    '''
+    one loader for all Test Time Augmentations, so that persistent workers are reused across passes
+
+    Call test_loader.sampler.set_pass(i) before running the i-th Test Time Augmentation,
+    and test_loader.sampler.skip_imgs() to skip images of that pass, e.g. completed ones of an interrupted run.
+    '''
+    test_datasets = [ get_test_dataset(paddings, tile_size, test_time_aug) for test_time_aug in test_time_augs ]
+    tile_borders = test_datasets[0].get_tile_borders()
+
+    concat_dataset = torch.utils.data.dataset.ConcatDataset(test_datasets)
+    sampler = PassSampler(concat_dataset)
+
+    test_loader = make_loader(concat_dataset, batch_size, sampler=sampler, loader_settings=loader_settings)
+    return test_loader, tile_borders
+
+def get_trainval_loader(batch_size, car_ids, paddings, tile_size, hflip_enabled=False, shift_enabled=False, color_enabled=False, rotate_enabled=False, scale_enabled=False, fancy_pca_enabled=False, edge_enh_enabled=False, test_time_aug=None, is_distributed=False, loader_settings=None, resolution_scale=1, grouped_sampler=None, aug_seed=None, boundary_enabled=False):
+    '''
+    input:
+      grouped_sampler: keyword arguments of ImageGroupedSampler, e.g. {'group_by': 'image', 'groups_per_worker': 2},
+                       or None to shuffle tiles independently
+      aug_seed: an int to make sample order and augmentations reproducible, the same for a given epoch and sample
+      boundary_enabled: load precomputed boundary maps of masks as a fourth element of batches, for BoundaryWeightedLoss
+    '''
     train_dir = const.TRAIN_DIR
     train_mask_dir = const.TRAIN_MASK_DIR
 
     print('Number of Images:', len(car_ids))
 
+    if boundary_enabled:
+        # computed once per image and resolution, the first time they are needed
+        boundary_img_size = tile.get_scaled_img_size(paddings, resolution_scale) if resolution_scale != 1 else None
+        boundary.build_boundary_maps(car_ids, boundary_img_size)
+
     dataset = LargeDataset(
         train_dir,
         ids=car_ids,
@@ -181,28 +499,157 @@ def get_trainval_loader(batch_size, car_ids, paddings, tile_size, hflip_enabled=
 
         paddings=paddings,
         tile_size=tile_size,
+        resolution_scale=resolution_scale,
+        aug_seed=aug_seed,
+        boundary_dir=boundary.get_boundary_dir(boundary_img_size) if boundary_enabled else None,
     )
     tile_borders = dataset.get_tile_borders()
 
-    loader = torch.utils.data.dataloader.DataLoader(
-                                dataset,
-                                batch_size=batch_size,
-                                shuffle=True,
-                                num_workers=8,
-                            )
+    if is_distributed:
+        # each process only loads the cars of its own shard
+        sampler = distributed.CarDistributedSampler(dataset.data_files, seed=aug_seed or 0)
+    elif grouped_sampler:
+        # load tiles of an image together so each worker decodes it only once
+        num_workers = (loader_settings or get_loader_settings())['num_workers']
+        sampler = ImageGroupedSampler(dataset.data_files, batch_size, num_workers, seed=aug_seed or 0, **grouped_sampler)
+        # an image, its mask and its boundary map are cached separately
+        files_per_img = 3 if boundary_enabled else 2
+        dataset.set_img_cache_size(sampler.get_img_cache_size() * files_per_img)
+    elif aug_seed is not None:
+        sampler = SeededRandomSampler(len(dataset), seed=aug_seed)
+    else:
+        sampler = None
+
+    if aug_seed is not None:
+        sampler = EpochSampler(sampler)
+
+    loader = make_loader(dataset, batch_size, shuffle=(sampler is None), sampler=sampler, loader_settings=loader_settings)
     return loader, tile_borders
 
-def get_train_loader(batch_size, paddings, tile_size, hflip, shift, color, rotate, scale, fancy_pca, edge_enh):
+def get_train_loader(batch_size, paddings, tile_size, hflip, shift, color, rotate, scale, fancy_pca, edge_enh, is_distributed=False, loader_settings=None, resolution_scale=1, grouped_sampler=None, aug_seed=None, boundary_enabled=False):
     train_imgs = load.load_train_imageset()
     return get_trainval_loader(batch_size, train_imgs, paddings, tile_size,
                                hflip_enabled=hflip, shift_enabled=shift, color_enabled=color, rotate_enabled=rotate,
-                               scale_enabled=scale, fancy_pca_enabled=fancy_pca, edge_enh_enabled=edge_enh)
+                               scale_enabled=scale, fancy_pca_enabled=fancy_pca, edge_enh_enabled=edge_enh,
+                               is_distributed=is_distributed, loader_settings=loader_settings, resolution_scale=resolution_scale,
+                               grouped_sampler=grouped_sampler, aug_seed=aug_seed, boundary_enabled=boundary_enabled)
 
-def get_val_loader(batch_size, paddings, tile_size, hflip, shift, color, rotate, scale, fancy_pca, edge_enh):
+def get_val_loader(batch_size, paddings, tile_size, hflip, shift, color, rotate, scale, fancy_pca, edge_enh, loader_settings=None):
     val_imgs = load.load_val_imageset()
     return get_trainval_loader(batch_size, val_imgs, paddings, tile_size,
                                hflip_enabled=hflip, shift_enabled=shift, color_enabled=color, rotate_enabled=rotate,
-                               scale_enabled=scale, fancy_pca_enabled=fancy_pca, edge_enh_enabled=edge_enh)
+                               scale_enabled=scale, fancy_pca_enabled=fancy_pca, edge_enh_enabled=edge_enh,
+                               loader_settings=loader_settings)
+
+class CachedDataset(torch.utils.data.dataset.Dataset):
+    '''
+    tiles and targets read from a cache built by util/val_cache.py
+    '''
+    def __init__(self, cache_dir, tile_size, img_names=None):
+        self.cache_dir = cache_dir
+        self.tile_size = tile_size
+
+        tile_names = val_cache.load_tile_names(cache_dir)
+
+        if img_names is not None:
+            img_names = set(img_names)
+            self.indices = [ idx for idx, tile_name in enumerate(tile_names) if tile.get_img_name(tile_name) in img_names ]
+        else:
+            self.indices = list(range(len(tile_names)))
+
+        self.tile_names = [ tile_names[idx] for idx in self.indices ]
+
+        # memory-mapped arrays are opened lazily so each worker opens its own
+        self.images = None
+        self.targets = None
+
+    def __len__(self):
+        return len(self.indices)
+
+    def __getitem__(self, idx):
+        if self.images is None:
+            self.images, self.targets = val_cache.open_cache(self.cache_dir)
+
+        cache_idx = self.indices[idx]
+        img = np.array(self.images[cache_idx])
+        target = val_cache.unpack_mask(self.targets[cache_idx], self.tile_size)
+
+        return self.tile_names[idx], img, target
+
+def get_cached_val_loader(batch_size, paddings, tile_size, img_names=None, loader_settings=None):
+    '''
+    validation loader reading from a cache of pre-tiled images, which is built the first time it's needed
+
+    input:
+      img_names: a subset of validation image names to use, or None for all of them
+    '''
+    cache_dir = val_cache.get_cache_dir('val', paddings, tile_size)
+
+    if not val_cache.is_cache_complete(cache_dir):
+        print('Building validation cache at {}...'.format(cache_dir))
+
+        val_imgs = load.load_val_imageset()
+        dataset = LargeDataset(const.TRAIN_DIR, ids=val_imgs, mask_dir=const.TRAIN_MASK_DIR, paddings=paddings, tile_size=tile_size)
+        loader = make_loader(dataset, batch_size, shuffle=False, loader_settings=loader_settings)
+
+        val_cache.build_cache(cache_dir, loader, len(dataset), tile_size)
+
+    dataset = CachedDataset(cache_dir, tile_size, img_names=img_names)
+    print('Number of cached validation tiles:', len(dataset))
+
+    padded_img_size = const.img_size[0] + 2 * paddings[0], const.img_size[1] + 2 * paddings[1]
+    _, tile_borders = tile.get_tile_layout(tile_size, padded_img_size)
+
+    loader = make_loader(dataset, batch_size, shuffle=False, loader_settings=loader_settings)
+    return loader, tile_borders
+
+class AugCacheDataset(torch.utils.data.dataset.Dataset):
+    '''
+    pre-augmented training tiles and targets read from a cache built by run_aug_cache.py
+
+    Indices are (epoch, idx) pairs from EpochSampler, and epochs cycle through the complete variants.
+    '''
+    def __init__(self, cache_dir, tile_size):
+        self.cache_dir = cache_dir
+        self.tile_size = tile_size
+
+        self.data_files = val_cache.load_tile_names(cache_dir)
+        self.variants = aug_cache.list_variants(cache_dir)
+        assert self.variants, 'No complete variants in {}, run run_aug_cache.py first'.format(cache_dir)
+
+    def __len__(self):
+        return len(self.data_files)
+
+    def __getitem__(self, idx):
+        epoch, idx = idx
+        variant = self.variants[(epoch - 1) % len(self.variants)]
+
+        try:
+            img, target = aug_cache.load_sample(self.cache_dir, variant, idx, self.tile_size)
+        except FileNotFoundError:
+            # the variant was removed by a newer run of run_aug_cache.py
+            self.variants = aug_cache.list_variants(self.cache_dir)
+            variant = self.variants[(epoch - 1) % len(self.variants)]
+            img, target = aug_cache.load_sample(self.cache_dir, variant, idx, self.tile_size)
+
+        return self.data_files[idx], img, target
+
+def get_aug_cache_loader(batch_size, cache_dir, paddings, tile_size, is_distributed=False, loader_settings=None, seed=0, resolution_scale=1):
+    '''
+    training loader replaying pre-augmented samples instead of augmenting them on the fly
+    '''
+    dataset = AugCacheDataset(cache_dir, tile_size)
+    print('Number of cached training tiles: {}, variants: {}'.format(len(dataset), dataset.variants))
+
+    _, tile_borders = tile.get_tile_layout(tile_size, tile.get_padded_img_size(paddings, resolution_scale))
+
+    if is_distributed:
+        sampler = distributed.CarDistributedSampler(dataset.data_files, seed=seed)
+    else:
+        sampler = SeededRandomSampler(len(dataset), seed=seed)
+
+    loader = make_loader(dataset, batch_size, sampler=EpochSampler(sampler), loader_settings=loader_settings)
+    return loader, tile_borders
 
 def get_small_loader(batch_size, paddings, tile_size, hflip, shift, color, rotate, scale, fancy_pca, edge_enh):
     small_imgs = load.load_small_imageset()
@@ -11,13 +11,21 @@ import util.ensemble as ensemble
 import util.submit as submit
 import util.get_time as get_time
 import util.exp as exp
+import util.threshold as threshold
+
+import dataloader
 import matplotlib.pyplot as plt
 
 class EnsembleRunner(torch.utils.data.dataset.Dataset):
-    def __init__(self, pred_dirs):
+    def __init__(self, pred_dirs, mask_threshold=None, weights_path=None):
+        '''
+        input:
+          mask_threshold: saved with the ensembled probability maps for run_rle.py, or None to leave it to run_rle.py
+          weights_path: weights of models from run_fit_ensemble_weights.py, or None to weight every model equally
+        '''
         self.pred_dirs = pred_dirs
 
-        self.weights = ensemble.get_ensemble_weights(self.pred_dirs)
+        self.weights = ensemble.get_ensemble_weights(self.pred_dirs, weights_path)
 
         first_pred_dir_path = os.path.join(const.OUTPUT_DIR, self.pred_dirs[0], const.PROBS_DIR_NAME)
         self.img_names = load.list_npy_in_dir(first_pred_dir_path)
@@ -25,6 +33,8 @@ class EnsembleRunner(torch.utils.data.dataset.Dataset):
         self.ensemble_dir = get_time.get_current_time()
 
         ensemble.create_models_ensembled(self.pred_dirs, self.ensemble_dir)
+        if mask_threshold is not None:
+            threshold.save_threshold(self.ensemble_dir, mask_threshold)
         return
 
     def __len__(self):
@@ -43,6 +53,7 @@ class EnsembleRunner(torch.utils.data.dataset.Dataset):
             ensembled = np.add(ensembled, weighted_img_prob)
 
         # save into new output/ folder
+        ensembled = submit.floor_ensembled_bins(ensembled)
         submit.save_ensembled_prob_map(self.ensemble_dir, img_name, ensembled)
         #plt.imshow(ensembled)
         #plt.show()
@@ -50,14 +61,9 @@ class EnsembleRunner(torch.utils.data.dataset.Dataset):
         return img_name, ensembled
 
 
-def get_ensemble_loader(pred_dirs):
+def get_ensemble_loader(pred_dirs, loader_settings=None, mask_threshold=None, weights_path=None):
 
-    dataset = EnsembleRunner(pred_dirs)
+    dataset = EnsembleRunner(pred_dirs, mask_threshold, weights_path)
 
-    loader = torch.utils.data.dataloader.DataLoader(
-                                dataset,
-                                batch_size=1,
-                                shuffle=False,
-                                num_workers=8,
-                            )
+    loader = dataloader.make_loader(dataset, batch_size=1, shuffle=False, loader_settings=loader_settings)
     return loader
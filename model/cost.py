@@ -0,0 +1,216 @@
+'''
+Estimate the computational cost of U-Net models: parameters, FLOPs, activation and peak memory, and CPU latency
+'''
+
+import inspect
+import time
+
+import torch
+import torch.nn as nn
+
+try:
+    import torch.profiler as profiler
+except ImportError:
+    profiler = None  # torch < 1.8
+
+import model.unet as unet
+
+
+def get_factory_names():
+    '''
+    get names of all model factories in model/unet.py, i.e. the names exp.get_network() accepts
+    '''
+    names = []
+    for name, obj in vars(unet).items():
+        if not name[0].isupper():
+            continue
+
+        if inspect.isfunction(obj):
+            names.append(name)
+        elif inspect.isclass(obj) and issubclass(obj, unet.BaseNet) and obj is not unet.BaseNet:
+            names.append(name)
+
+    names.sort()
+    return names
+
+def count_params(net):
+    return sum(param.numel() for param in net.parameters())
+
+
+def get_layer_flops(module, inputs, output):
+    '''
+    number of floating point operations of a leaf module, counting a multiply-add as 2
+    '''
+    x = inputs[0]
+
+    if isinstance(module, nn.Conv2d):
+        kernel_h, kernel_w = module.kernel_size
+        flops_per_output = 2 * (module.in_channels // module.groups) * kernel_h * kernel_w
+        flops = output.numel() * flops_per_output
+        if module.bias is not None:
+            flops += output.numel()
+        return flops
+
+    if isinstance(module, nn.ConvTranspose2d):
+        kernel_h, kernel_w = module.kernel_size
+        flops_per_input = 2 * (module.out_channels // module.groups) * kernel_h * kernel_w
+        return x.numel() * flops_per_input
+
+    if isinstance(module, nn.BatchNorm2d):
+        return 2 * output.numel()
+
+    if isinstance(module, (nn.ReLU, nn.Dropout2d)):
+        return output.numel()
+
+    if isinstance(module, nn.MaxPool2d):
+        kernel_size = module.kernel_size
+        if isinstance(kernel_size, int):
+            kernel_size = (kernel_size, kernel_size)
+        return output.numel() * kernel_size[0] * kernel_size[1]
+
+    if isinstance(module, nn.Upsample):
+        return output.numel()
+
+    return 0
+
+def profile_layers(net, input_size, batch_size=1):
+    '''
+    run one forward pass and record the cost of every leaf module
+
+    input:
+      input_size: a tuple of ints (height, width)
+    output:
+      layers: a list of dicts with keys 'name', 'type', 'output_shape', 'flops', 'output_bytes'
+
+    Note that functional ops such as F.relu in Conv3BN, torch.cat and the last sigmoid are not counted.
+    '''
+    layers = []
+    hooks = []
+
+    def make_hook(name):
+        def hook(module, inputs, output):
+            layers.append({
+                'name': name,
+                'type': type(module).__name__,
+                'output_shape': tuple(output.size()),
+                'flops': get_layer_flops(module, inputs, output),
+                'output_bytes': output.numel() * output.element_size(),
+            })
+        return hook
+
+    for name, module in net.named_modules():
+        is_leaf = len(list(module.children())) == 0
+        if is_leaf:
+            hooks.append(module.register_forward_hook(make_hook(name)))
+
+    height, width = input_size
+    images = torch.rand(batch_size, 3, height, width)
+
+    net.eval()
+    with torch.no_grad():
+        net(images)
+
+    for hook in hooks:
+        hook.remove()
+
+    return layers
+
+def measure_cuda_memory(net, input_size, batch_size=1):
+    '''
+    measure peak GPU memory of forward only and forward + backward passes
+    output:
+      forward_peak, backward_peak: bytes, or None if CUDA is not available
+    '''
+    if not torch.cuda.is_available():
+        return None, None
+
+    height, width = input_size
+    net = net.cuda()
+
+    torch.cuda.empty_cache()
+    torch.cuda.reset_max_memory_allocated()
+    net.eval()
+    with torch.no_grad():
+        net(torch.rand(batch_size, 3, height, width).cuda())
+    forward_peak = torch.cuda.max_memory_allocated()
+
+    torch.cuda.empty_cache()
+    torch.cuda.reset_max_memory_allocated()
+    net.train()
+    outputs = net(torch.rand(batch_size, 3, height, width).cuda())
+    outputs.mean().backward()
+    backward_peak = torch.cuda.max_memory_allocated()
+
+    net.zero_grad()
+    net.cpu()
+    torch.cuda.empty_cache()
+
+    return forward_peak, backward_peak
+
+def get_profiled_peak(prof):
+    '''
+    input:
+      prof: a finished torch.profiler.profile with profile_memory=True
+    output:
+      peak: bytes, the largest amount allocated and not yet freed at any time while profiling
+    '''
+    memory_events = sorted((event for event in prof.events() if event.name == '[memory]'), key=lambda event: event.time_range.start)
+
+    allocated = 0
+    peak = 0
+    for event in memory_events:
+        allocated += event.cpu_memory_usage  # negative for frees
+        peak = max(peak, allocated)
+    return peak
+
+def measure_cpu_memory(net, input_size, batch_size=1):
+    '''
+    measure peak CPU memory of forward only and forward + backward passes with the torch profiler,
+    counting parameters and buffers like measure_cuda_memory() does
+    output:
+      forward_peak, backward_peak: bytes, or None if torch has no profiler
+    '''
+    if profiler is None:
+        return None, None
+
+    height, width = input_size
+    net = net.cpu()
+    model_bytes = sum(tensor.numel() * tensor.element_size() for tensor in list(net.parameters()) + list(net.buffers()))
+    activities = [profiler.ProfilerActivity.CPU]
+
+    net.eval()
+    with profiler.profile(activities=activities, profile_memory=True) as prof:
+        with torch.no_grad():
+            net(torch.rand(batch_size, 3, height, width))
+    forward_peak = model_bytes + get_profiled_peak(prof)
+
+    net.train()
+    with profiler.profile(activities=activities, profile_memory=True) as prof:
+        outputs = net(torch.rand(batch_size, 3, height, width))
+        outputs.mean().backward()
+    backward_peak = model_bytes + get_profiled_peak(prof)
+
+    net.zero_grad()
+    return forward_peak, backward_peak
+
+def measure_cpu_latency(net, input_size, batch_size=1, num_iters=3):
+    '''
+    output:
+      latency: average seconds of one forward pass on CPU
+    '''
+    height, width = input_size
+    images = torch.rand(batch_size, 3, height, width) * 255
+
+    net = net.cpu()
+    net.eval()
+
+    # without autograd, the same as measure_cuda_memory() measures forward passes
+    with torch.no_grad():
+        net(images)  # warm up
+
+        start = time.time()
+        for i in range(num_iters):
+            net(images)
+        latency = (time.time() - start) / num_iters
+
+    return latency
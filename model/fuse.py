@@ -0,0 +1,199 @@
+'''
+Fold BatchNorm layers into convolutions for inference.
+
+At inference time BatchNorm is just a per channel affine transform y = a * x + b with
+  a = gamma / sqrt(running_var + eps)
+  b = beta - running_mean * a
+so it can be merged into the neighbouring convolution:
+
+  conv -> bn -> relu   (BasicConv2d, DUC)
+    exact: conv weights and bias are scaled by a, then shifted by b
+
+  conv -> relu -> bn   (Conv3BN, Dilation_Conv3BN)
+    a * relu(z) == relu(a * z) when a >= 0, so a is folded into the conv for those channels
+    and only the shift b (plus a for channels with a < 0, if any) is left after the relu
+
+DenseLayer (relu -> bn -> conv) is left untouched, since folding bn into the following
+zero padded conv would change the results along tile borders.
+'''
+
+import copy
+
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+from torch.autograd import Variable
+
+import model.unet as unet
+
+
+def get_bn_affine(bn):
+    '''
+    input:
+      bn: a nn.BatchNorm2d in eval mode
+    output:
+      scale, shift: FloatTensors of size (num_channels) so that bn(x) == x * scale + shift
+    '''
+    std = torch.sqrt(bn.running_var + bn.eps)
+
+    if bn.affine:
+        scale = bn.weight.data / std
+        shift = bn.bias.data - bn.running_mean * scale
+    else:
+        scale = 1 / std
+        shift = - bn.running_mean * scale
+
+    return scale, shift
+
+def scale_conv(conv, scale, shift=None):
+    '''
+    return a copy of conv whose output channels are multiplied by scale and then added by shift
+    '''
+    fused = copy.deepcopy(conv)
+
+    fused.weight.data = conv.weight.data * scale.view(-1, 1, 1, 1)
+
+    if conv.bias is not None:
+        bias = conv.bias.data * scale
+    else:
+        bias = torch.zeros(scale.size()).type_as(scale)
+
+    if shift is not None:
+        bias = bias + shift
+
+    fused.bias = nn.Parameter(bias)
+    return fused
+
+def fuse_conv_bn(conv, bn):
+    '''
+    fold bn into conv for conv -> bn
+    '''
+    scale, shift = get_bn_affine(bn)
+    return scale_conv(conv, scale, shift)
+
+
+class FusedConvReLUAffine(nn.Module):
+    '''
+    inference replacement for Conv3BN and Dilation_Conv3BN, which compute bn(relu(conv(x)))
+    '''
+    def __init__(self, conv, bn):
+        super().__init__()
+
+        scale, shift = get_bn_affine(bn)
+
+        # relu commutes with non-negative scaling
+        is_foldable = scale.ge(0)
+        fold_scale = torch.where(is_foldable, scale, torch.ones(scale.size()).type_as(scale))
+        self.conv = scale_conv(conv, fold_scale)
+
+        if is_foldable.all():
+            self.scale = None
+        else:
+            rest_scale = torch.where(is_foldable, torch.ones(scale.size()).type_as(scale), scale)
+            self.register_buffer('scale', rest_scale.view(1, -1, 1, 1))
+
+        self.register_buffer('shift', shift.view(1, -1, 1, 1))
+
+    def forward(self, x):
+        x = F.relu(self.conv(x), inplace=True)
+
+        if self.scale is not None:
+            x = x * Variable(self.scale)
+        x = x + Variable(self.shift)
+        return x
+
+
+def fuse_module(module):
+    '''
+    return the inference replacement of module, or None if it can't be fused
+    '''
+    if isinstance(module, (unet.Conv3BN, unet.Dilation_Conv3BN)):
+        if module.bn is None:
+            return None  # nothing to fold
+        if module.activation is not F.relu:
+            return None  # folding scale into conv only holds for relu
+        return FusedConvReLUAffine(module.conv, module.bn)
+
+    if isinstance(module, unet.BasicConv2d):
+        return nn.Sequential(
+            fuse_conv_bn(module.conv, module.bn),
+            nn.ReLU(inplace=True),
+        )
+
+    if isinstance(module, unet.DUC):
+        return nn.Sequential(
+            fuse_conv_bn(module.conv, module.bn),
+            nn.ReLU(inplace=True),
+            module.pixel_shuffle,
+        )
+
+    return None
+
+def fuse_network(net):
+    '''
+    replace fusable submodules of net in place
+    '''
+    for name, child in net.named_children():
+        fused = fuse_module(child)
+
+        if fused is not None:
+            setattr(net, name, fused)
+        else:
+            fuse_network(child)
+
+    return net
+
+def freeze_network(net, output_logits=True):
+    '''
+    input:
+      net: a trained network
+      output_logits: if True, the last sigmoid is skipped and masks should be computed as logits > 0
+    output:
+      frozen: a fused copy of net for inference only
+    '''
+    frozen = copy.deepcopy(net).cpu()
+    frozen.eval()
+
+    fuse_network(frozen)
+
+    if hasattr(frozen, 'output_logits'):
+        frozen.output_logits = output_logits
+
+    for param in frozen.parameters():
+        param.requires_grad = False
+
+    return frozen
+
+
+def check_equivalence(net, frozen, input_size, batch_size=1):
+    '''
+    compare the outputs of the original and the frozen network on CPU with random input
+
+    input:
+      input_size: a tuple of ints (height, width)
+    output:
+      max_diff: max absolute difference between predicted probabilities
+      num_mismatches: number of pixels whose predicted mask differs
+    '''
+    net = copy.deepcopy(net).cpu()
+    net.eval()
+    frozen.eval()
+
+    height, width = input_size
+    images = torch.rand(batch_size, 3, height, width) * 255  # images are fed in range [0, 255]
+
+    with torch.no_grad():
+        probs = net(images)
+        frozen_outputs = frozen(images)
+
+    if getattr(frozen, 'output_logits', False):
+        frozen_probs = F.sigmoid(frozen_outputs)
+        frozen_masks = frozen_outputs > 0
+    else:
+        frozen_probs = frozen_outputs
+        frozen_masks = frozen_outputs > 0.5
+
+    max_diff = (probs - frozen_probs).abs().max().item()
+    num_mismatches = int((frozen_masks != (probs > 0.5)).sum().item())
+
+    return max_diff, num_mismatches
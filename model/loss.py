@@ -24,12 +24,12 @@ class CrossEntropy2dLoss(nn.Module):
         assert predict.size(0) == target.size(0), "{0} vs {1} ".format(predict.size(0), target.size(0))
         assert predict.size(2) == target.size(1), "{0} vs {1} ".format(predict.size(2), target.size(1))
         assert predict.size(3) == target.size(2), "{0} vs {1} ".format(predict.size(3), target.size(3))
-        n, c, h, w = predict.size()
-        target_mask = (target >= 0) * (target != self.ignore_label)
-        target = target[target_mask]
-        predict = predict.transpose(1, 2).transpose(2, 3).contiguous()
-        predict = predict[target_mask.view(n, h, w, 1).repeat(1, 1, 1, c)].view(-1, c)
-        loss = F.cross_entropy(predict, target, weight=weight, size_average=self.size_average)
+
+        # cross_entropy takes (n, c, h, w) directly, so pixels don't need to be transposed and gathered,
+        # negative labels are ignored like ignore_label
+        target = target.masked_fill(target < 0, self.ignore_label)
+        loss = F.cross_entropy(predict, target, weight=weight, ignore_index=self.ignore_label,
+                               reduction='mean' if self.size_average else 'sum')
         return loss
 
 class StableBCELoss(nn.modules.Module):
@@ -130,21 +130,62 @@ class StableHengLoss(nn.Module):
         return self.dice(inputs, targets) + self.stable_bce(inputs, targets)
 
 class BoundaryWeightedLoss(nn.Module):
+    '''
+    WeightedSoftDiceLoss + WeightedBCELoss2d with 3 times the weight on pixels near mask boundaries,
+    computed in one pass over shared intermediates
+
+    The weight buffer is reused across steps as long as the tile size and device don't change.
+    '''
     def __init__(self):
         super(BoundaryWeightedLoss, self).__init__()
-        self.weighted_bce = WeightedBCELoss2d()
-        self.weighted_dice = WeightedSoftDiceLoss()
+        self.weights = None
+
+    def get_weights_buffer(self, like):
+        if self.weights is None or self.weights.size() != like.size() or self.weights.device != like.device or self.weights.dtype != like.dtype:
+            self.weights = torch.empty_like(like)
+        return self.weights
+
+    def get_boundary_weights(self, targets, boundary_maps=None):
+        '''
+        input:
+          boundary_maps: uint8 maps of boundaries precomputed by util/boundary.py, or None to compute them from targets
+        output:
+          weights: 1 inside and outside of masks, 3 where 0.01 <= average of the 11x11 neighborhood <= 0.99,
+                   normalized to sum up to the number of pixels
+        '''
+        targets = targets.data
+        weights = self.get_weights_buffer(targets)
+
+        if boundary_maps is not None:
+            weights.copy_(boundary_maps.data)
+        else:
+            # is_boundary: 0.01 <= avg_neighbors <= 0.99, compared as is since |avg_neighbors - 0.5| <= 0.49
+            # rounds differently in float32 right at the edges
+            avg_neighbors = F.avg_pool2d(targets, kernel_size=11, padding=5, stride=1)
+            weights.copy_(avg_neighbors.ge(0.01).logical_and_(avg_neighbors.le(0.99)))
+
+        num_pixels = weights.numel()
+        num_boundary = weights.sum()
+        weights.mul_(2).add_(1).mul_(num_pixels / (num_pixels + 2 * num_boundary))
+        return weights
+
+    def forward(self, inputs, targets, boundary_maps=None):
+        weights = self.get_boundary_weights(targets, boundary_maps)
 
-    def forward(self, inputs, targets):
-        avg_neighbors = F.avg_pool2d(targets, kernel_size=11, padding=5, stride=1)
-        is_boundary = avg_neighbors.ge(0.01) * avg_neighbors.le(0.99)
-        is_boundary = is_boundary.float()
-
-        weights = Variable(torch.tensor.torch.ones(avg_neighbors.size())).cuda()
-
-        w0 = weights.sum()
-        weights = weights + is_boundary * 2
-        w1 = weights.sum()
-        weights = weights * w0 / w1
-
-        return self.weighted_dice(inputs, targets, weights) + self.weighted_bce(inputs, targets, weights)
+        num = targets.size(0)
+        m1 = inputs.view(num, -1)
+        m2 = targets.view(num, -1)
+        w  = Variable(weights.view(num, -1))
+        w2 = w * w
+
+        # weighted soft dice
+        w2_m1 = w2 * m1
+        intersection = (w2_m1 * m2).sum(1)
+        dice = 2. * (intersection + 1) / (w2_m1.sum(1) + (w2 * m2).sum(1) + 1)
+        dice_loss = 1 - dice.sum() / num
+
+        # weighted BCE, the weights sum up to the number of pixels
+        bce = m1.clamp(min=0) - m1 * m2 + torch.log1p(torch.exp(-m1.abs()))
+        bce_loss = (w * bce).sum() / w.sum()
+
+        return dice_loss + bce_loss
@@ -0,0 +1,176 @@
+'''
+Post-training static int8 quantization of DynamicUnet models for CPU inference.
+
+The float modules can't be quantized as is:
+  - Conv3BN applies bn after relu, so bn is replaced with an equivalent depthwise 1x1 conv
+  - skip connections use torch.cat, which is replaced with nn.quantized.FloatFunctional
+  - inputs and outputs need to be quantized and dequantized by QuantStub and DeQuantStub
+
+Only networks built from Conv3BN or Dilation_Conv3BN blocks with relu are supported,
+i.e. PeterUnet, PeterUnet3, PeterUnet4, PeterUnet5, PeterUnet34, HDCUnet3, HDCUnet124 and their dropout variants.
+'''
+
+import copy
+
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+import torch.quantization as quantization
+
+import model.unet as unet
+import model.fuse as fuse
+
+
+class ConvReLUAffine(nn.Module):
+    '''
+    quantizable replacement for Conv3BN and Dilation_Conv3BN, which compute bn(relu(conv(x)))
+    '''
+    def __init__(self, conv, bn):
+        super().__init__()
+        self.conv = copy.deepcopy(conv)
+        self.relu = nn.ReLU()
+
+        if bn is not None:
+            scale, shift = fuse.get_bn_affine(bn)
+            num_channels = scale.size(0)
+
+            # bn at inference is a per channel affine transform, i.e. a depthwise 1x1 conv
+            self.affine = nn.Conv2d(num_channels, num_channels, 1, groups=num_channels)
+            self.affine.weight.data = scale.view(-1, 1, 1, 1).clone()
+            self.affine.bias.data = shift.clone()
+        else:
+            self.affine = None
+
+    def forward(self, x):
+        x = self.relu(self.conv(x))
+        if self.affine is not None:
+            x = self.affine(x)
+        return x
+
+    def fuse(self):
+        quantization.fuse_modules(self, [['conv', 'relu']], inplace=True)
+        return
+
+
+def convert_layer(layer):
+    if not isinstance(layer, (unet.Conv3BN, unet.Dilation_Conv3BN)):
+        raise ValueError('{} can not be quantized'.format(type(layer).__name__))
+
+    if layer.activation is not F.relu:
+        raise ValueError('Only relu activation can be quantized')
+
+    return ConvReLUAffine(layer.conv, layer.bn)
+
+def get_block_layers(block):
+    '''
+    get l1, l2, ... of a UNetDownBlock*/UNetUpBlock*/Dilation*Block*
+    '''
+    layers = []
+    i = 1
+    while hasattr(block, 'l{}'.format(i)):
+        layers.append(getattr(block, 'l{}'.format(i)))
+        i += 1
+
+    return layers
+
+
+class QuantizableDownBlock(nn.Module):
+    def __init__(self, block):
+        super().__init__()
+        self.layers = nn.Sequential(*[ convert_layer(layer) for layer in get_block_layers(block) ])
+
+    def forward(self, x):
+        return self.layers(x)
+
+class QuantizableUpBlock(nn.Module):
+    def __init__(self, block):
+        super().__init__()
+        self.up = block.up
+        if not isinstance(self.up, (nn.Upsample, nn.ConvTranspose2d)):
+            raise ValueError('{} can not be quantized'.format(type(self.up).__name__))
+
+        self.layers = nn.Sequential(*[ convert_layer(layer) for layer in get_block_layers(block) ])
+        self.skip_cat = nn.quantized.FloatFunctional()
+
+    def forward(self, skip, x):
+        up = self.up(x)
+        x = self.skip_cat.cat([up, skip], 1)
+        return self.layers(x)
+
+
+class QuantizableUnet(nn.Module):
+    '''
+    quantizable copy of a DynamicUnet, with the same forward pass
+    '''
+    def __init__(self, net):
+        super().__init__()
+        assert isinstance(net, unet.DynamicUnet)
+
+        net = copy.deepcopy(net).cpu()
+        net.eval()
+
+        self.quant = quantization.QuantStub()
+        self.down = nn.ModuleList([ QuantizableDownBlock(block) for block in net.down ])
+        self.pool = net.pool
+        self.up = nn.ModuleList([ QuantizableUpBlock(block) for block in net.up ])
+        self.classify = net.classify
+        self.dequant = quantization.DeQuantStub()
+
+        self.output_logits = net.output_logits
+        self.is_quantized = False
+
+    def forward(self, x):
+        x = self.quant(x)
+
+        down_outputs = []
+        for i in range(len(self.down)):
+            down_output = self.down[i](x)
+            down_outputs.append(down_output)
+
+            if i < len(self.pool):
+                x = self.pool[i](down_output)
+
+        x = down_outputs[-1]
+        for i in reversed(range(len(self.up))):
+            x = self.up[i](down_outputs[i], x)
+
+        out = self.classify(x)
+        out = self.dequant(out)
+
+        if self.output_logits:
+            return out
+        return F.sigmoid(out)
+
+    def fuse(self):
+        for module in self.modules():
+            if isinstance(module, ConvReLUAffine):
+                module.fuse()
+        return
+
+
+def quantize_network(net, calibration_batches, backend='fbgemm'):
+    '''
+    input:
+      net: a trained DynamicUnet
+      calibration_batches: an iterable of FloatTensors of size (batch_size, 3, height, width) on CPU
+    output:
+      quantized: an int8 copy of net which only runs on CPU
+    '''
+    torch.backends.quantized.engine = backend
+
+    quantized = QuantizableUnet(net)
+    quantized.eval()
+    quantized.fuse()
+
+    quantized.qconfig = quantization.get_default_qconfig(backend)
+    quantization.prepare(quantized, inplace=True)
+
+    # collect activation ranges
+    with torch.no_grad():
+        for images in calibration_batches:
+            quantized(images)
+
+    quantization.convert(quantized, inplace=True)
+    quantized.is_quantized = True
+
+    return quantized
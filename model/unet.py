@@ -11,6 +11,9 @@ import torch.nn as nn
 import torch.nn.functional as F
 
 
+def identity(x):
+    return x
+
 class BaseNet(nn.Module):
     def __init__(self, n_channels=3, n_classes=1, dropout=0.0, bn=1, activation='relu'):
         super().__init__()
@@ -21,10 +24,14 @@ class BaseNet(nn.Module):
         self.activation = activation
         self.dropout = dropout
 
+        # when True, forward() skips the last sigmoid and returns logits
+        # so that masks can be computed as logits > 0 (see model/fuse.py)
+        self.output_logits = False
+
         if dropout:
             self.dropout2d = nn.Dropout2d(p=dropout)
         else:
-            self.dropout2d = lambda x: x
+            self.dropout2d = identity  # a module level function so the model can be pickled
 
 class SmallUnet(BaseNet):
     def __init__(self):
@@ -50,6 +57,9 @@ class SmallUnet(BaseNet):
         x = torch.cat([x, x1], 1)
         x = F.relu(self.conv6(x))
         x = self.conv7(x)
+
+        if self.output_logits:
+            return x
         return F.sigmoid(x)
 
 
@@ -489,6 +499,9 @@ class Unet(BaseNet): # Improved: add the last Sigmoid layer
         up1 = self.up1(down1, up2)
 
         out =  self.classify(up1)
+
+        if self.output_logits:
+            return out
         return F.sigmoid(out)
 
 class UpsamplingUnet(BaseNet):
@@ -536,6 +549,9 @@ class UpsamplingUnet(BaseNet):
         up1 = self.up1(down1, up2)
 
         out =  self.classify(up1)
+
+        if self.output_logits:
+            return out
         return F.sigmoid(out)
 
 class DynamicUnet(BaseNet):
@@ -572,6 +588,9 @@ class DynamicUnet(BaseNet):
             x = self.dropout2d(x)
 
         out =  self.classify(x)
+
+        if self.output_logits:
+            return out
         return F.sigmoid(out)
 
 
@@ -8,6 +8,8 @@ import util.const as const
 import util.ensemble as ensemble
 import util.submit as submit
 import util.run_length as run_length
+
+import dataloader
 import matplotlib.pyplot as plt
 
 def load_submissions(pred_dirs):
@@ -23,13 +25,14 @@ def load_submissions(pred_dirs):
     return submissions
 
 class RleEnsembleRunner(torch.utils.data.dataset.Dataset):
-    def __init__(self, pred_dirs, ensemble_dir):
+    def __init__(self, pred_dirs, ensemble_dir, vote_threshold=0.5, weights_path=None):
         self.pred_dirs = pred_dirs
+        self.vote_threshold = vote_threshold  # weighted fraction of masks a pixel needs to be car
         self.submissions = load_submissions(pred_dirs)
 
         self.img_names = list(self.submissions[0].keys())
 
-        self.weights = ensemble.get_ensemble_weights(self.pred_dirs)
+        self.weights = ensemble.get_ensemble_weights(self.pred_dirs, weights_path)
 
         self.ensemble_dir = ensemble_dir
         ensemble.create_models_ensembled(self.pred_dirs, self.ensemble_dir)
@@ -51,8 +54,8 @@ class RleEnsembleRunner(torch.utils.data.dataset.Dataset):
             weighted_mask = np.multiply(mask, self.weights[i])
             ensembled_mask = np.add(ensembled_mask, weighted_mask)
 
-        ensembled_mask[ ensembled_mask > 0.5 ] = 1
-        ensembled_mask[ ensembled_mask <= 0.5 ] = 0
+        ensembled_mask[ ensembled_mask > self.vote_threshold ] = 1
+        ensembled_mask[ ensembled_mask <= self.vote_threshold ] = 0
 
         # plt.imshow(ensembled_mask)
         # plt.show()
@@ -62,14 +65,9 @@ class RleEnsembleRunner(torch.utils.data.dataset.Dataset):
         return img_name, ensembled_rle
 
 
-def get_rle_ensemble_loader(pred_dirs, ensemble_dir):
+def get_rle_ensemble_loader(pred_dirs, ensemble_dir, loader_settings=None, vote_threshold=0.5, weights_path=None):
 
-    dataset = RleEnsembleRunner(pred_dirs, ensemble_dir)
+    dataset = RleEnsembleRunner(pred_dirs, ensemble_dir, vote_threshold, weights_path)
 
-    loader = torch.utils.data.dataloader.DataLoader(
-                                dataset,
-                                batch_size=1,
-                                shuffle=False,
-                                num_workers=8,
-                            )
+    loader = dataloader.make_loader(dataset, batch_size=1, shuffle=False, loader_settings=loader_settings)
     return loader
@@ -10,11 +10,17 @@ import util.load as load
 import util.submit as submit
 import util.run_length as run_length
 
+import dataloader
+
 
 class RLErunner(torch.utils.data.dataset.Dataset):
-    def __init__(self, pred_dir):
+    def __init__(self, pred_dir, threshold=0.5):
         self.pred_dir = pred_dir
 
+        # prob maps are saved in int8 with values ranging from 0 to 100
+        # so the threshold for image mask is bin 50 instead of 0.5 by default
+        self.threshold_bin = submit.get_threshold_bin(threshold)
+
         pred_dir_path = os.path.join(const.OUTPUT_DIR, self.pred_dir, const.PROBS_DIR_NAME)
         self.img_names = load.list_npy_in_dir(pred_dir_path)
         return
@@ -30,23 +36,15 @@ class RLErunner(torch.utils.data.dataset.Dataset):
         img_prob = np.load(pred_path)
 
         # generate image mask
-        img_mask = np.zeros(img_prob.shape)
-        img_mask[img_prob > 50] = 1
-        # prob maps are saved in int8 with values ranging from 0 to 100
-        # The threshold for image mask is 50 instead of 0.5
+        img_mask = submit.get_mask(img_prob, self.threshold_bin)
 
         rle = run_length.encode(img_mask)
         return img_name, rle
 
 
-def get_rle_loader(pred_dir):
+def get_rle_loader(pred_dir, loader_settings=None, threshold=0.5):
 
-    dataset = RLErunner(pred_dir)
+    dataset = RLErunner(pred_dir, threshold)
 
-    loader = torch.utils.data.dataloader.DataLoader(
-                                dataset,
-                                batch_size=1,
-                                shuffle=False,
-                                num_workers=8,
-                            )
+    loader = dataloader.make_loader(dataset, batch_size=1, shuffle=False, loader_settings=loader_settings)
     return loader
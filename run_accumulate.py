@@ -0,0 +1,39 @@
+import time
+import argparse
+
+import util.ensemble as ensemble
+
+import dataloader
+import accumulator_loader
+
+
+if __name__ == "__main__":
+    program_start = time.time()
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('accumulator_dir', help='directory in ./output/ to keep the ensemble in')
+    parser.add_argument('-a', '--add', nargs='+', default=[], help='pred_dirs to add to the ensemble')
+    parser.add_argument('-r', '--remove', nargs='+', default=[], help='pred_dirs to remove from the ensemble')
+    parser.add_argument('--weight', type=float, default=None, help='weight of added pred_dirs, the number of models in them or their weights in --weights_file by default')
+    parser.add_argument('--weights_file', default=None, help='weights of models fitted by run_fit_ensemble_weights.py, e.g. {}'.format(ensemble.DEFAULT_WEIGHTS_PATH))
+    parser.add_argument('--finalize', action='store_true', help='generate submission.csv of the ensemble')
+    parser.add_argument('--threshold', type=float, default=None, help='threshold of ensembled probability maps, the one saved by run_threshold_sweep.py by default')
+    parser.add_argument('--num_workers', type=int, default=8, help='number of DataLoader worker processes')
+    args = parser.parse_args()
+
+    accumulator = accumulator_loader.EnsembleAccumulator(args.accumulator_dir, loader_settings=dataloader.get_loader_settings(num_workers=args.num_workers))
+    model_weights = ensemble.load_ensemble_weights(args.weights_file) if args.weights_file is not None else None
+
+    for pred_dir in args.remove:
+        accumulator.remove(pred_dir)
+
+    for pred_dir in args.add:
+        weight = args.weight if args.weight is not None else ensemble.get_ensemble_dir_weight(pred_dir, model_weights)
+        accumulator.add(pred_dir, weight)
+
+    print('Models in {}: {}'.format(args.accumulator_dir, accumulator.get_models()))
+
+    if args.finalize:
+        accumulator.finalize(args.threshold)
+
+    print('Total time spent: {} sec = {} hours'.format(time.time() - program_start, (time.time() - program_start) / 3600))
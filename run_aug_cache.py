@@ -0,0 +1,69 @@
+import time
+import argparse
+
+import util.exp as exp
+import util.aug_cache as aug_cache
+import util.val_cache as val_cache
+
+from dataloader import *
+import config
+
+
+if __name__ == "__main__":
+    program_start = time.time()
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('exp_name', nargs='?', default='PeterUnet3_all_aug_1280')
+    parser.add_argument('--num_variants', type=int, default=None, help='number of augmented variants of every sample to add, train.aug_cache.num_variants by default')
+    parser.add_argument('--max_gb', type=float, default=None, help='size cap of the cache, the oldest variants are removed beyond it')
+    parser.add_argument('--num_workers', type=int, default=None)
+    args = parser.parse_args()
+
+    exp_name = args.exp_name
+    cfg = config.load_config_file(exp_name)
+    aug_cache_cfg = cfg['train'].get('aug_cache', None) or {}
+
+    num_variants = args.num_variants or aug_cache_cfg.get('num_variants', 4)
+    max_gb = args.max_gb or aug_cache_cfg.get('max_gb', None)
+
+    loader_settings = get_loader_settings(cfg)
+    if args.num_workers is not None:
+        loader_settings['num_workers'] = args.num_workers
+
+    # augmentations of a variant are seeded like an epoch of training with aug_seed
+    train_data_loader, _ = get_train_loader(
+        cfg['train']['batch_size'],
+        cfg['train']['paddings'],
+        cfg['train']['tile_size'],
+        cfg['train']['hflip'],
+        cfg['train']['shift'],
+        cfg['train']['color'],
+        cfg['train']['rotate'],
+        cfg['train']['scale'],
+        cfg['train']['fancy_pca'],
+        cfg['train']['edge_enh'],
+        loader_settings=loader_settings,
+        aug_seed=cfg['train'].get('aug_seed', None) or 0,
+    )
+    tile_names = train_data_loader.dataset.data_files
+
+    cache_dir = exp.create_dir_if_not_exist(aug_cache.get_cache_dir(exp_name))
+    if aug_cache.list_variants(cache_dir):
+        # sample indices of new variants must match the ones of existing variants
+        assert val_cache.load_tile_names(cache_dir) == tile_names, 'Training set changed, remove {} first'.format(cache_dir)
+    else:
+        aug_cache.save_tile_names(cache_dir, tile_names)
+
+    for _ in range(num_variants):
+        variant = aug_cache.get_next_variant(cache_dir)
+        variant_start = time.time()
+
+        train_data_loader.sampler.set_epoch(variant)
+        aug_cache.build_variant(cache_dir, variant, train_data_loader, tile_names)
+        print('Variant {} done in {:.2f} sec'.format(variant, time.time() - variant_start))
+
+        if max_gb is not None:
+            aug_cache.remove_oldest_variants(cache_dir, max_gb * 2**30)
+
+    print('Complete variants in {}: {}'.format(cache_dir, aug_cache.list_variants(cache_dir)))
+    print('Total time spent: {:.2f} sec'.format(time.time() - program_start))
@@ -0,0 +1,120 @@
+import time
+import argparse
+
+import numpy as np
+
+import util.exp as exp
+import util.const as const
+import util.load as load
+import util.tile as tile
+import util.submit as submit
+import util.run_length as run_length
+import util.backend as backend
+import util.cascade as cascade
+import util.threshold as threshold
+import config
+
+
+def load_padded_img(data_dir, img_name, paddings, resolution_scale=1):
+    '''
+    load an image padded like test.tester() does, or at a reduced resolution_scale like LargeDataset does,
+    in which case it's decoded at reduced resolution
+    '''
+    img_size = tile.get_scaled_img_size(paddings, resolution_scale) if resolution_scale != 1 else None
+    img = load.load_image_file(data_dir, img_name, 'jpg', 0, img_size)
+    return tile.pad_image(np.moveaxis(img, 2, 0), paddings)
+
+
+if __name__ == "__main__":
+    program_start = time.time()
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('exp_name', nargs='?', default='PeterUnet3_all_aug_1280', help='experiment of the fine model')
+    parser.add_argument('--coarse_exp', default=None, help='experiment of the coarse model, the fine model by default')
+    parser.add_argument('--coarse_scale', type=float, default=0.25, help='resolution scale the coarse model runs at')
+    parser.add_argument('--refine_tile_size', nargs=2, type=int, default=[384, 512], help='height and width of tiles refined at full resolution')
+    parser.add_argument('--uncertain_band', nargs=2, type=float, default=[0.02, 0.98], help='probabilities between them are uncertain')
+    parser.add_argument('--batch_size', type=int, default=8)
+    parser.add_argument('--num_imgs', type=int, default=None, help='number of validation images to evaluate, all of them by default')
+    parser.add_argument('--threshold', type=float, default=None, help='mask threshold, the one saved by run_threshold_sweep.py by default')
+    parser.add_argument('--submit', action='store_true', help='predict test images with the cascade and generate submission.csv')
+    args = parser.parse_args()
+
+    exp_name = args.exp_name
+    cfg = config.load_config_file(exp_name)
+    paddings = cfg['test']['paddings']
+    refine_tile_size = tuple(args.refine_tile_size)
+
+    mask_threshold = args.threshold if args.threshold is not None else threshold.load_threshold(exp_name)
+    threshold_bin = submit.get_threshold_bin(mask_threshold)
+    print('Threshold: {}'.format(mask_threshold))
+
+    def get_mask(probs):
+        return submit.get_mask(submit.get_prob_bins(tile.remove_paddings(probs, paddings)), threshold_bin)
+
+    fine_net, _, _, _ = exp.load_exp(exp_name)
+    fine_net = backend.get_backend(fine_net)
+    fine_net.eval()
+
+    if args.coarse_exp is None:
+        coarse_net = fine_net
+    else:
+        coarse_net, _, _, _ = exp.load_exp(args.coarse_exp)
+        coarse_net = backend.get_backend(coarse_net)
+        coarse_net.eval()
+
+    def predict_cascade(data_dir, img_name, padded_img):
+        small_padded_img = load_padded_img(data_dir, img_name, paddings, args.coarse_scale)
+        return cascade.predict_cascade(coarse_net, fine_net, padded_img, small_padded_img, paddings, refine_tile_size,
+                                       uncertain_band=tuple(args.uncertain_band), batch_size=args.batch_size)
+
+    if args.submit:
+        test_imgs = sorted(load.list_img_in_dir(const.TEST_DIR))
+        img_rles = {}
+        refined_fractions = []
+        for i, img_name in enumerate(test_imgs):
+            probs, refined_fraction = predict_cascade(const.TEST_DIR, img_name, load_padded_img(const.TEST_DIR, img_name, paddings))
+            refined_fractions.append(refined_fraction)
+
+            img_mask = get_mask(probs)
+            img_rles[img_name] = run_length.encode(img_mask)
+
+            if (i % 1000) == 0:
+                print('Image {}/{}: {:.1%} of pixels refined'.format(i, len(test_imgs), refined_fraction))
+
+        submit.save_predictions(exp_name, img_rles)
+        print('Mean fraction of pixels refined: {:.1%}'.format(np.mean(refined_fractions)))
+
+    else:
+        val_imgs = load.load_val_imageset()[:args.num_imgs]
+
+        full_time, cascade_time = 0, 0
+        full_dices, cascade_dices, refined_fractions = [], [], []
+        for i, img_name in enumerate(val_imgs):
+            padded_img = load_padded_img(const.TRAIN_DIR, img_name, paddings)
+            target = load.load_image_file(const.TRAIN_MASK_DIR, img_name + '_mask', 'gif', 0)
+
+            start = time.time()
+            full_probs = cascade.predict_full(fine_net, padded_img, cfg['test']['tile_size'], batch_size=args.batch_size)
+            full_time += time.time() - start
+
+            start = time.time()
+            cascade_probs, refined_fraction = predict_cascade(const.TRAIN_DIR, img_name, padded_img)
+            cascade_time += time.time() - start
+
+            full_dices.append(cascade.get_dice(get_mask(full_probs), target > 0))
+            cascade_dices.append(cascade.get_dice(get_mask(cascade_probs), target > 0))
+            refined_fractions.append(refined_fraction)
+
+            if (i % 100) == 0:
+                print('Image {}/{}: {:.1%} of pixels refined, dice {:.5f} -> {:.5f}'.format(
+                    i, len(val_imgs), refined_fraction, full_dices[-1], cascade_dices[-1]))
+
+        print('\nImages:                  {}'.format(len(val_imgs)))
+        print('Pixels refined:          {:.1%}'.format(np.mean(refined_fractions)))
+        print('Full resolution:         {:.3f} sec/image, dice {:.5f}'.format(full_time / len(val_imgs), np.mean(full_dices)))
+        print('Cascade:                 {:.3f} sec/image, dice {:.5f}'.format(cascade_time / len(val_imgs), np.mean(cascade_dices)))
+        print('Speedup:                 {:.2f}x'.format(full_time / cascade_time))
+        print('Dice change:             {:+.5f}'.format(np.mean(cascade_dices) - np.mean(full_dices)))
+
+    print('Total time spent: {:.2f} sec'.format(time.time() - program_start))
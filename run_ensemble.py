@@ -4,7 +4,9 @@ import argparse
 import util.ensemble as ensemble
 import util.submit as submit
 import util.const as const
+import util.threshold as threshold
 
+import dataloader
 import ensemble_loader
 
 def apply_ensemble(ensemble_loader):
@@ -31,15 +33,24 @@ if __name__ == "__main__":
 
     parser = argparse.ArgumentParser()
     parser.add_argument('-p', '--pred_dirs', nargs='+')
+    parser.add_argument('--num_workers', type=int, default=8, help='number of DataLoader worker processes')
+    parser.add_argument('--threshold', type=float, default=None, help='threshold for run_rle.py on the ensembled probability maps, e.g. from run_threshold_sweep.py --pair_exp')
+    parser.add_argument('--weights_file', default=None, help='weights of models fitted by run_fit_ensemble_weights.py, e.g. {}'.format(ensemble.DEFAULT_WEIGHTS_PATH))
     args = parser.parse_args()
 
     pred_dirs = args.pred_dirs
 
+    # without --threshold, keep the threshold of the ensembled predictions if they all share one
+    mask_threshold = args.threshold
+    pred_thresholds = set(threshold.load_threshold(pred_dir) for pred_dir in pred_dirs)
+    if mask_threshold is None and len(pred_thresholds) == 1:
+        mask_threshold = pred_thresholds.pop()
+
     for pred_dir in pred_dirs:
         exp_names, test_time_aug_names = ensemble.get_models_ensembled(pred_dir)
         print('The predictions in {} are predicted by {}. '.format(pred_dir, list(zip(exp_names, test_time_aug_names))))
 
-    ensemble_loader = ensemble_loader.get_ensemble_loader(pred_dirs)
+    ensemble_loader = ensemble_loader.get_ensemble_loader(pred_dirs, loader_settings=dataloader.get_loader_settings(num_workers=args.num_workers), mask_threshold=mask_threshold, weights_path=args.weights_file)
 
     apply_ensemble(ensemble_loader)
     print('Total time spent: {} sec = {} hours'.format(time.time() - program_start, (time.time() - program_start) / 3600))
@@ -0,0 +1,32 @@
+import time
+import argparse
+
+import util.exp as exp
+import util.backend as backend
+
+import config
+
+
+if __name__ == "__main__":
+    program_start = time.time()
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('exp_name', nargs='?', default='PeterUnet3_all_aug_1280')
+    parser.add_argument('--frozen', action='store_true', help='export the model saved by run_freeze.py instead of the latest checkpoint')
+    parser.add_argument('--dynamic', action='store_true', help='export with dynamic height and width instead of the test tile size, batch size is always dynamic')
+    args = parser.parse_args()
+
+    exp_name = args.exp_name
+
+    cfg = config.load_config_file(exp_name)
+
+    if args.frozen:
+        net, _, _ = exp.load_frozen_exp(exp_name)
+    else:
+        net, _, _, _ = exp.load_exp(exp_name)
+
+    save_path = exp.get_onnx_path(exp_name)
+    backend.export_onnx(net, save_path, cfg['test']['tile_size'], batch_size=cfg['test']['batch_size'], dynamic=args.dynamic)
+    print('=> exported {} to {}'.format(exp_name, save_path))
+
+    print('Total time spent: {:.2f} sec'.format(time.time() - program_start))
@@ -0,0 +1,51 @@
+import time
+import argparse
+
+import numpy as np
+
+import util.load as load
+import util.ensemble as ensemble
+import util.ensemble_weights as ensemble_weights
+import util.threshold as threshold
+import util.val_probs as val_probs
+
+
+if __name__ == "__main__":
+    program_start = time.time()
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-e', '--exp_names', nargs='+', required=True)
+    parser.add_argument('-t', '--test_time_augs', nargs='+', default=['nothing'], help='test time augmentations of every experiment, see augmentation.get_TTA_funcs()')
+    parser.add_argument('--weights_file', default=ensemble.DEFAULT_WEIGHTS_PATH)
+    parser.add_argument('--num_steps', type=int, default=21, help='number of weights from 0 to 1 to try for each model')
+    parser.add_argument('--max_rounds', type=int, default=10, help='maximum number of coordinate search rounds over all models')
+    parser.add_argument('--num_processes', type=int, default=8, help='number of processes compacting probability maps')
+    parser.add_argument('--batch_size', type=int, default=8, help='batch size of tiles when caching validation probability maps')
+    parser.add_argument('--num_imgs', type=int, default=None, help='number of validation images to fit on, all of them by default')
+    args = parser.parse_args()
+
+    val_imgs = load.load_val_imageset()[:args.num_imgs]
+    models = [ (exp_name, aug_name) for exp_name in args.exp_names for aug_name in args.test_time_augs ]
+
+    # only models added since the last run are predicted
+    for exp_name, aug_name in models:
+        val_probs.cache_val_probs(exp_name, val_imgs, args.batch_size, test_time_aug_name=aug_name)
+
+    start = time.time()
+    tables = ensemble_weights.build_tables([ threshold.get_val_probs_dir(exp_name, aug_name) for exp_name, aug_name in models ],
+                                           val_imgs, num_processes=args.num_processes)
+    print('Compacted {} models on {} images into {} rows, {:.2f} sec spent'.format(len(models), len(val_imgs), len(tables['counts']), time.time() - start))
+
+    for i, (exp_name, aug_name) in enumerate(models):
+        single_dice, single_threshold = ensemble_weights.evaluate(tables, np.eye(len(models))[i])
+        print('{}, {}: dice {:.5f}, threshold {:.2f}'.format(exp_name, aug_name, single_dice, single_threshold))
+
+    start = time.time()
+    weights, mean_dice, best_threshold = ensemble_weights.fit_weights(tables, num_steps=args.num_steps, max_rounds=args.max_rounds)
+    print('Fitted weights in {:.2f} sec'.format(time.time() - start))
+
+    ensemble.save_ensemble_weights(args.weights_file, [ exp_name for exp_name, _ in models ], [ aug_name for _, aug_name in models ], weights)
+    print('Saved weights into {}, dice {:.5f} at threshold {:.2f}'.format(args.weights_file, mean_dice, best_threshold))
+    print('Run python run_ensemble.py --weights_file {} --threshold {:.2f} --pred_dirs ...'.format(args.weights_file, best_threshold))
+
+    print('Total time spent: {:.2f} sec'.format(time.time() - program_start))
@@ -0,0 +1,32 @@
+import time
+import argparse
+
+import util.exp as exp
+import model.fuse as fuse
+
+import config
+
+
+if __name__ == "__main__":
+    program_start = time.time()
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('exp_name', nargs='?', default='PeterUnet3_all_aug_1280')
+    parser.add_argument('--keep_sigmoid', action='store_true', help='keep the last sigmoid so that probability maps can still be saved for ensembling')
+    parser.add_argument('--no_check', action='store_true', help='skip comparing frozen model against the original one on CPU')
+    args = parser.parse_args()
+
+    exp_name = args.exp_name
+
+    cfg = config.load_config_file(exp_name)
+
+    net, frozen = exp.freeze_exp(exp_name, output_logits=not args.keep_sigmoid)
+
+    if not args.no_check:
+        tile_size = cfg['test']['tile_size']
+        max_diff, num_mismatches = fuse.check_equivalence(net, frozen, tile_size)
+        print('Max probability difference: {:.2e}, mismatched mask pixels: {}'.format(max_diff, int(num_mismatches)))
+
+        assert max_diff < 1e-4, 'frozen model is not equivalent to the original model'
+
+    print('Total time spent: {:.2f} sec'.format(time.time() - program_start))
@@ -0,0 +1,82 @@
+import time
+import argparse
+import itertools
+
+import torch
+
+from dataloader import *
+import config
+
+
+def benchmark_loader(data_loader, num_batches, use_cuda):
+    '''
+    output:
+      samples_per_sec: number of samples loaded per second, excluding worker start up
+    '''
+    num_samples = 0
+    start = None
+
+    for i, (img_name, images, targets) in enumerate(data_loader):
+        if use_cuda:
+            images = images.cuda(non_blocking=True)
+            targets = targets.cuda(non_blocking=True)
+
+        if i == 0:
+            # start timing after the first batch so worker start up isn't counted
+            start = time.time()
+            continue
+
+        num_samples += len(img_name)
+        if i >= num_batches:
+            break
+
+    if start is None or num_samples == 0:
+        return 0
+    return num_samples / (time.time() - start)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('exp_name', nargs='?', default='PeterUnet3_all_aug_1280')
+    parser.add_argument('--num_workers', nargs='+', type=int, default=[4, 8, 16])
+    parser.add_argument('--prefetch_factors', nargs='+', type=int, default=[2, 4])
+    parser.add_argument('--pin_memory', nargs='+', type=int, default=[0, 1], help='0 or 1')
+    parser.add_argument('--num_batches', type=int, default=50, help='number of batches to load for each setting')
+    parser.add_argument('--aug_seed', type=int, default=0, help='seed of sample order and augmentations, so all settings load the same samples')
+    parser.add_argument('--resolution_scale', type=float, default=1, help='load images resized by this scale, e.g. 0.5 or 0.25')
+    args = parser.parse_args()
+
+    exp_name = args.exp_name
+    cfg = config.load_config_file(exp_name)
+    use_cuda = torch.cuda.is_available()
+
+    # tiles shrink with images at reduced resolution
+    tile_size = tuple(int(round(length * args.resolution_scale)) for length in cfg['train']['tile_size'])
+
+    results = []
+    for num_workers, prefetch_factor, pin_memory in itertools.product(args.num_workers, args.prefetch_factors, args.pin_memory):
+        loader_settings = get_loader_settings(cfg, num_workers=num_workers, prefetch_factor=prefetch_factor, pin_memory=bool(pin_memory))
+
+        train_data_loader, _ = get_train_loader(
+            cfg['train']['batch_size'],
+            cfg['train']['paddings'],
+            tile_size,
+            cfg['train']['hflip'],
+            cfg['train']['shift'],
+            cfg['train']['color'],
+            cfg['train']['rotate'],
+            cfg['train']['scale'],
+            cfg['train']['fancy_pca'],
+            cfg['train']['edge_enh'],
+            loader_settings=loader_settings,
+            resolution_scale=args.resolution_scale,
+            aug_seed=args.aug_seed,
+        )
+
+        samples_per_sec = benchmark_loader(train_data_loader, args.num_batches, use_cuda)
+        results.append((num_workers, prefetch_factor, pin_memory, samples_per_sec))
+        print('num_workers: {}, prefetch_factor: {}, pin_memory: {} -> {:.2f} samples/sec'.format(num_workers, prefetch_factor, pin_memory, samples_per_sec))
+
+    print('\n{:>11} {:>15} {:>10} {:>12}'.format('num_workers', 'prefetch_factor', 'pin_memory', 'samples/sec'))
+    for num_workers, prefetch_factor, pin_memory, samples_per_sec in sorted(results, key=lambda result: -result[3]):
+        print('{:>11} {:>15} {:>10} {:>12.2f}'.format(num_workers, prefetch_factor, pin_memory, samples_per_sec))
@@ -0,0 +1,142 @@
+import time
+import argparse
+
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+from torch.autograd import Variable
+
+import model.loss as loss
+
+
+class ReferenceCrossEntropy2dLoss(nn.Module):
+    '''
+    CrossEntropy2dLoss before pixels were passed to cross_entropy in (n, c, h, w) layout
+    '''
+    def __init__(self, ignore_label=255):
+        super(ReferenceCrossEntropy2dLoss, self).__init__()
+        self.ignore_label = ignore_label
+
+    def forward(self, predict, target):
+        n, c, h, w = predict.size()
+        target_mask = (target >= 0) * (target != self.ignore_label)
+        target = target[target_mask]
+        predict = predict.transpose(1, 2).transpose(2, 3).contiguous()
+        predict = predict[target_mask.view(n, h, w, 1).repeat(1, 1, 1, c)].view(-1, c)
+        return F.cross_entropy(predict, target)
+
+class ReferenceBoundaryWeightedLoss(nn.Module):
+    '''
+    BoundaryWeightedLoss before it was fused, with weights created on the device of targets instead of .cuda()
+    '''
+    def __init__(self):
+        super(ReferenceBoundaryWeightedLoss, self).__init__()
+        self.weighted_bce = loss.WeightedBCELoss2d()
+        self.weighted_dice = loss.WeightedSoftDiceLoss()
+
+    def forward(self, inputs, targets):
+        avg_neighbors = F.avg_pool2d(targets, kernel_size=11, padding=5, stride=1)
+        is_boundary = avg_neighbors.ge(0.01) * avg_neighbors.le(0.99)
+        is_boundary = is_boundary.float()
+
+        weights = Variable(torch.ones(avg_neighbors.size(), device=targets.device))
+
+        w0 = weights.sum()
+        weights = weights + is_boundary * 2
+        w1 = weights.sum()
+        weights = weights * w0 / w1
+
+        return self.weighted_dice(inputs, targets, weights) + self.weighted_bce(inputs, targets, weights)
+
+
+def check_equivalence(tolerance=1e-4):
+    '''
+    assert that fused losses give the same values as their references on small tensors on CPU
+    '''
+    torch.manual_seed(0)
+    probs = Variable(torch.rand(2, 1, 64, 64), requires_grad=True)
+
+    rectangle = torch.zeros(2, 1, 64, 64)
+    rectangle[:, :, 16:48, 16:48] = 1
+
+    # soft targets whose neighborhood averages are 0.01 and 0.99 up to float32 rounding, the edges of is_boundary
+    edges = torch.full((2, 1, 64, 64), 0.01)
+    edges[1] = 0.99
+
+    class_targets = torch.randint(0, 3, (2, 64, 64))
+    class_targets[:, :8] = 255  # ignored
+    logits = Variable(torch.randn(2, 3, 64, 64), requires_grad=True)
+
+    cases = [
+        ('BoundaryWeightedLoss on a rectangle', ReferenceBoundaryWeightedLoss(), loss.BoundaryWeightedLoss(), probs, rectangle),
+        ('BoundaryWeightedLoss at the edges', ReferenceBoundaryWeightedLoss(), loss.BoundaryWeightedLoss(), probs, edges),
+        ('CrossEntropy2dLoss', ReferenceCrossEntropy2dLoss(), loss.CrossEntropy2dLoss(), logits, class_targets),
+    ]
+    for name, reference, fused, inputs, targets in cases:
+        max_diff = float((reference(inputs, targets) - fused(inputs, targets)).abs().data)
+        assert max_diff <= tolerance, '{}: fused loss differs from the reference by {:.2e}'.format(name, max_diff)
+
+    print('Fused losses match their references within {:.0e}'.format(tolerance))
+    return
+
+def get_allocated_bytes(criterion, inputs, targets):
+    '''
+    bytes allocated by one forward and backward pass on CPU
+    '''
+    with torch.profiler.profile(activities=[torch.profiler.ProfilerActivity.CPU], profile_memory=True) as prof:
+        criterion(inputs, targets).backward()
+    return sum(max(event.self_cpu_memory_usage, 0) for event in prof.key_averages())
+
+def benchmark_loss(criterion, inputs, targets, num_iters):
+    '''
+    output:
+      latency: average seconds of one forward and backward pass
+      allocated_bytes: bytes allocated by one forward and backward pass
+    '''
+    criterion(inputs, targets).backward()  # warm up, and allocate reused buffers
+
+    start = time.time()
+    for i in range(num_iters):
+        criterion(inputs, targets).backward()
+    latency = (time.time() - start) / num_iters
+
+    return latency, get_allocated_bytes(criterion, inputs, targets)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--tile_size', nargs=2, type=int, default=[1280, 1280], help='height and width of tiles')
+    parser.add_argument('--batch_size', type=int, default=4)
+    parser.add_argument('--num_classes', type=int, default=2, help='number of classes for CrossEntropy2dLoss')
+    parser.add_argument('--num_iters', type=int, default=5)
+    args = parser.parse_args()
+
+    check_equivalence()
+
+    height, width = args.tile_size
+    torch.manual_seed(0)
+
+    # a rectangle mask, so that there are boundaries to weight
+    targets = torch.zeros(args.batch_size, 1, height, width)
+    targets[:, :, height // 4:3 * height // 4, width // 4:3 * width // 4] = 1
+    probs = Variable(torch.rand(args.batch_size, 1, height, width), requires_grad=True)
+
+    class_targets = torch.randint(0, args.num_classes, (args.batch_size, height, width))
+    class_targets[:, :height // 10] = 255  # ignored
+    logits = Variable(torch.randn(args.batch_size, args.num_classes, height, width), requires_grad=True)
+
+    cases = [
+        ('BoundaryWeightedLoss', ReferenceBoundaryWeightedLoss(), loss.BoundaryWeightedLoss(), probs, targets),
+        ('CrossEntropy2dLoss', ReferenceCrossEntropy2dLoss(), loss.CrossEntropy2dLoss(), logits, class_targets),
+    ]
+
+    print('{:<22} {:>10} {:>14} {:>14} {:>12} {:>12} {:>10}'.format(
+        'loss', 'max diff', 'ref time(ms)', 'new time(ms)', 'ref mem(MB)', 'new mem(MB)', 'speedup'))
+    for name, reference, fused, inputs, case_targets in cases:
+        max_diff = float((reference(inputs, case_targets) - fused(inputs, case_targets)).abs().data)
+
+        ref_latency, ref_bytes = benchmark_loss(reference, inputs, case_targets, args.num_iters)
+        new_latency, new_bytes = benchmark_loss(fused, inputs, case_targets, args.num_iters)
+
+        print('{:<22} {:>10.2e} {:>14.1f} {:>14.1f} {:>12.1f} {:>12.1f} {:>9.2f}x'.format(
+            name, max_diff, ref_latency * 1000, new_latency * 1000, ref_bytes / 2**20, new_bytes / 2**20, ref_latency / new_latency))
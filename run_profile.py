@@ -0,0 +1,82 @@
+import os
+import csv
+import time
+import argparse
+
+import util.exp as exp
+import util.const as const
+import util.get_time as get_time
+import model.unet as unet
+import model.cost as cost
+
+
+def save_table(rows, save_path):
+    '''
+    save a list of dicts with the same keys as a csv file
+    '''
+    with open(save_path, 'w', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=list(rows[0].keys()))
+        writer.writeheader()
+        writer.writerows(rows)
+    return
+
+
+if __name__ == "__main__":
+    program_start = time.time()
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('model_names', nargs='*', help='model factories in model/unet.py, all of them by default')
+    parser.add_argument('--tile_size', nargs=2, type=int, default=[1280, 1280], help='height and width of input tiles')
+    parser.add_argument('--batch_sizes', nargs='+', type=int, default=[1, 2, 4], help='batch sizes to measure CPU latency with')
+    parser.add_argument('--num_iters', type=int, default=3, help='number of forward passes to average latency over')
+    args = parser.parse_args()
+
+    model_names = args.model_names or cost.get_factory_names()
+    tile_size = tuple(args.tile_size)
+
+    profile_dir = exp.create_dir_if_not_exist(os.path.join(const.OUTPUT_DIR, 'profile'))
+    timestamp = get_time.get_current_time()
+
+    summary = []
+    layer_rows = []
+    for model_name in model_names:
+        print('Profiling {} with tile size {}...'.format(model_name, tile_size))
+        net = getattr(unet, model_name)()
+
+        layers = cost.profile_layers(net, tile_size)
+        for layer in layers:
+            layer_row = {'model': model_name}
+            layer_row.update(layer)
+            layer_rows.append(layer_row)
+
+        forward_peak, backward_peak = cost.measure_cuda_memory(net, tile_size)
+        cpu_forward_peak, cpu_backward_peak = cost.measure_cpu_memory(net, tile_size)
+
+        row = {
+            'model': model_name,
+            'params': cost.count_params(net),
+            'gflops': sum(layer['flops'] for layer in layers) / 1e9,
+            # an estimate of activations kept for backward for batch size 1: outputs of leaf modules are summed,
+            # those of functional ops such as F.relu and torch.cat are missed
+            'activation_estimate_mb': sum(layer['output_bytes'] for layer in layers) / 2**20,
+            'cuda_forward_peak_mb': forward_peak / 2**20 if forward_peak is not None else '',
+            'cuda_backward_peak_mb': backward_peak / 2**20 if backward_peak is not None else '',
+            'cpu_forward_peak_mb': cpu_forward_peak / 2**20 if cpu_forward_peak is not None else '',
+            'cpu_backward_peak_mb': cpu_backward_peak / 2**20 if cpu_backward_peak is not None else '',
+        }
+
+        for batch_size in args.batch_sizes:
+            latency = cost.measure_cpu_latency(net, tile_size, batch_size=batch_size, num_iters=args.num_iters)
+            row['cpu_latency_bs{}'.format(batch_size)] = latency
+            row['cpu_tiles_per_sec_bs{}'.format(batch_size)] = batch_size / latency
+
+        print(row)
+        summary.append(row)
+
+    summary_path = os.path.join(profile_dir, timestamp + '_summary.csv')
+    layers_path = os.path.join(profile_dir, timestamp + '_layers.csv')
+    save_table(summary, summary_path)
+    save_table(layer_rows, layers_path)
+    print('Saved results to {} and {}'.format(summary_path, layers_path))
+
+    print('Total time spent: {:.2f} sec'.format(time.time() - program_start))
@@ -0,0 +1,103 @@
+import torch
+
+import time
+import argparse
+
+import util.exp as exp
+import util.load as load
+import util.tile as tile
+import util.evaluation as evaluation
+import model.quantize as quantize
+
+import dataloader
+import config
+
+
+def get_val_subset_loader(cfg, img_names):
+    return dataloader.get_trainval_loader(
+        cfg['test']['batch_size'],
+        img_names,
+        cfg['test']['paddings'],
+        cfg['test']['tile_size'],
+    )
+
+def evaluate(net, data_loader, tile_borders):
+    '''
+    compute mean dice and CPU inference time of net over data_loader
+    output:
+      accuracy: mean dice
+      sec_per_tile: average forward time per tile
+    '''
+    net.eval()
+
+    total_accuracy = 0
+    total_forward_time = 0
+    num_tiles = 0
+
+    # both models run without autograd, so that only forward passes are timed
+    with torch.no_grad():
+        for i, (img_name, images, targets) in enumerate(data_loader):
+            images = images.float()
+            targets = targets.float()
+
+            forward_start = time.time()
+            outputs = net(images)
+            total_forward_time += time.time() - forward_start
+
+            outputs = tile.remove_tile_borders(outputs, tile_borders)
+            targets = tile.remove_tile_borders(targets, tile_borders)
+
+            masks = (outputs > 0.5).float()
+            total_accuracy += evaluation.dice_loss(masks, targets)
+
+            num_tiles += len(img_name)
+
+    return total_accuracy / len(data_loader), total_forward_time / num_tiles
+
+
+if __name__ == "__main__":
+    program_start = time.time()
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('exp_names', nargs='+')
+    parser.add_argument('--num_calib_imgs', type=int, default=32, help='number of val images used for calibration')
+    parser.add_argument('--num_eval_imgs', type=int, default=64, help='number of val images used to measure dice drop and speedup')
+    parser.add_argument('--num_threads', type=int, default=0, help='number of CPU threads, 0 to use torch default')
+    args = parser.parse_args()
+
+    if args.num_threads > 0:
+        torch.set_num_threads(args.num_threads)
+
+    val_imgs = load.load_val_imageset()
+    calib_imgs = val_imgs[:args.num_calib_imgs]
+    eval_imgs = val_imgs[args.num_calib_imgs:args.num_calib_imgs + args.num_eval_imgs]
+
+    results = []
+    for exp_name in args.exp_names:
+        print('\n\nNow quantizing: {}'.format(exp_name))
+        cfg = config.load_config_file(exp_name)
+
+        net, _, _, start_epoch = exp.load_exp(exp_name)
+        net = net.cpu()
+        net.eval()
+
+        calib_loader, _ = get_val_subset_loader(cfg, calib_imgs)
+        calib_batches = ( images.float() for _, images, _ in calib_loader )
+        quantized = quantize.quantize_network(net, calib_batches)
+
+        exp.save_quantized_exp(exp_name, start_epoch - 1, quantized)
+
+        eval_loader, tile_borders = get_val_subset_loader(cfg, eval_imgs)
+        float_accuracy, float_sec = evaluate(net, eval_loader, tile_borders)
+        int8_accuracy, int8_sec = evaluate(quantized, eval_loader, tile_borders)
+
+        results.append((exp_name, float_accuracy, int8_accuracy, float_sec, int8_sec))
+        print('{}: float32 dice {:.5f} in {:.3f} sec/tile, int8 dice {:.5f} in {:.3f} sec/tile'.format(
+            exp_name, float_accuracy, float_sec, int8_accuracy, int8_sec))
+
+    print('\n{:<40} {:>10} {:>10} {:>10} {:>8}'.format('exp_name', 'fp32 dice', 'int8 dice', 'dice drop', 'speedup'))
+    for exp_name, float_accuracy, int8_accuracy, float_sec, int8_sec in results:
+        print('{:<40} {:>10.5f} {:>10.5f} {:>10.5f} {:>7.2f}x'.format(
+            exp_name, float_accuracy, int8_accuracy, float_accuracy - int8_accuracy, float_sec / int8_sec))
+
+    print('Total time spent: {:.2f} sec'.format(time.time() - program_start))
@@ -4,7 +4,9 @@ import argparse
 import util.ensemble as ensemble
 import util.submit as submit
 import util.const as const
+import util.threshold as threshold
 
+import dataloader
 import rle_loader
 
 def apply_rle(pred_dir, rle_loader):
@@ -32,14 +34,18 @@ if __name__ == "__main__":
 
     parser = argparse.ArgumentParser()
     parser.add_argument('pred_dir', nargs='?', default='0922-03:34:53')
+    parser.add_argument('--num_workers', type=int, default=8, help='number of DataLoader worker processes')
+    parser.add_argument('--threshold', type=float, default=None, help='threshold of probability maps, the one saved by run_threshold_sweep.py by default')
     args = parser.parse_args()
 
     pred_dir = args.pred_dir
+    mask_threshold = args.threshold if args.threshold is not None else threshold.load_threshold(pred_dir)
+    print('Threshold: {}'.format(mask_threshold))
 
     exp_names, test_time_aug_names = ensemble.get_models_ensembled(pred_dir)
     print('The predictions are ensemble from {}. '.format(list(zip(exp_names, test_time_aug_names))))
 
-    rle_loader = rle_loader.get_rle_loader(pred_dir)
+    rle_loader = rle_loader.get_rle_loader(pred_dir, loader_settings=dataloader.get_loader_settings(num_workers=args.num_workers), threshold=mask_threshold)
 
     apply_rle(pred_dir, rle_loader)
     print('Total time spent: {} sec = {} hours'.format(time.time() - program_start, (time.time() - program_start) / 3600))
@@ -10,6 +10,7 @@ import util.const as const
 import util.run_length as run_length
 import util.get_time as get_time
 
+import dataloader
 import rle_ensemble_loader
 
 def apply_ensemble(ensemble_loader, ensemble_dir):
@@ -36,12 +37,15 @@ def apply_ensemble(ensemble_loader, ensemble_dir):
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument('-p', '--pred_dirs', nargs='+')
+    parser.add_argument('--num_workers', type=int, default=8, help='number of DataLoader worker processes')
+    parser.add_argument('--vote_threshold', type=float, default=0.5, help='weighted fraction of submissions a pixel needs to be predicted as car')
+    parser.add_argument('--weights_file', default=None, help='weights of models fitted by run_fit_ensemble_weights.py, e.g. {}'.format(ensemble.DEFAULT_WEIGHTS_PATH))
     args = parser.parse_args()
 
     pred_dirs = args.pred_dirs
 
     ensemble_dir = get_time.get_current_time()
 
-    rle_ensemble_loader = rle_ensemble_loader.get_rle_ensemble_loader(pred_dirs, ensemble_dir)
+    rle_ensemble_loader = rle_ensemble_loader.get_rle_ensemble_loader(pred_dirs, ensemble_dir, loader_settings=dataloader.get_loader_settings(num_workers=args.num_workers), vote_threshold=args.vote_threshold, weights_path=args.weights_file)
 
     apply_ensemble(rle_ensemble_loader, ensemble_dir)
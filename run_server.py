@@ -0,0 +1,149 @@
+import os
+import time
+import json
+import argparse
+import socketserver
+import http.server
+from urllib.parse import urlparse, parse_qs
+from concurrent.futures import TimeoutError
+
+import util.exp as exp
+import util.const as const
+import util.backend as backend
+import util.threshold as threshold
+import util.run_length as run_length
+import util.serve as serve
+import config
+
+
+class ThreadingHTTPServer(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    daemon_threads = True
+
+
+class ThreadingUnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+def make_handler(service, exp_name):
+
+    class Handler(http.server.BaseHTTPRequestHandler):
+        '''
+        POST /predict?format=rle|png  with the bytes of an image file as body
+        GET  /stats                   latency percentiles, queue depth and batch sizes
+        GET  /health
+        '''
+        def address_string(self):
+            # client_address is an empty string on Unix sockets
+            return self.client_address[0] if self.client_address else 'unix'
+
+        def send_body(self, status, body, content_type, headers=None):
+            self.send_response(status)
+            self.send_header('Content-Type', content_type)
+            self.send_header('Content-Length', str(len(body)))
+            for key, value in (headers or {}).items():
+                self.send_header(key, value)
+            self.end_headers()
+            self.wfile.write(body)
+            return
+
+        def send_json(self, status, obj):
+            self.send_body(status, json.dumps(obj).encode('utf-8'), 'application/json')
+            return
+
+        def do_GET(self):
+            path = urlparse(self.path).path
+            if path == '/stats':
+                self.send_json(200, service.get_stats())
+            elif path == '/health':
+                self.send_json(200, {'status': 'ok', 'exp_name': exp_name})
+            else:
+                self.send_json(404, {'error': 'not found: {}'.format(path)})
+            return
+
+        def do_POST(self):
+            url = urlparse(self.path)
+            if url.path != '/predict':
+                self.send_json(404, {'error': 'not found: {}'.format(url.path)})
+                return
+
+            mask_format = parse_qs(url.query).get('format', ['rle'])[0]
+            if mask_format not in ('rle', 'png'):
+                self.send_json(400, {'error': 'format has to be rle or png'})
+                return
+
+            start = time.time()
+            data = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+            try:
+                img, original_size = serve.decode_image(data, const.img_size)
+            except Exception as e:
+                self.send_json(400, {'error': 'cannot decode image: {}'.format(e)})
+                return
+
+            try:
+                img_mask = service.predict_mask(img, original_size)
+            except TimeoutError:
+                self.send_json(503, {'error': 'prediction timed out after {} sec'.format(service.timeout)})
+                return
+            except Exception as e:
+                self.send_json(500, {'error': 'prediction failed: {}'.format(e)})
+                return
+            height, width = img_mask.shape
+
+            if mask_format == 'png':
+                body = serve.encode_png(img_mask)
+            else:
+                rle = run_length.encode(img_mask)
+
+            latency = time.time() - start
+            service.stats.add_request(latency)
+
+            if mask_format == 'png':
+                self.send_body(200, body, 'image/png', headers={'X-Latency-Ms': '{:.1f}'.format(latency * 1000)})
+            else:
+                self.send_json(200, {'rle': rle, 'height': height, 'width': width, 'latency_ms': latency * 1000})
+            return
+
+    return Handler
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('exp_name', nargs='?', default='PeterUnet3_all_aug_1280')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--socket', default=None, help='path of a Unix socket to listen on instead of host and port')
+    parser.add_argument('--max_batch_size', type=int, default=None, help='maximum number of tiles in a batch, batch_size of the test config by default')
+    parser.add_argument('--max_wait_ms', type=float, default=10, help='maximum time a batch waits for more tiles')
+    parser.add_argument('--timeout', type=float, default=30, help='seconds a request waits for its prediction before 503 is returned')
+    parser.add_argument('--threshold', type=float, default=None, help='mask threshold, the one saved by run_threshold_sweep.py by default')
+    args = parser.parse_args()
+
+    exp_name = args.exp_name
+    cfg = config.load_config_file(exp_name)
+
+    net, _, _, _ = exp.load_exp(exp_name)
+    net = backend.get_backend(net)
+
+    mask_threshold = args.threshold if args.threshold is not None else threshold.load_threshold(exp_name)
+    max_batch_size = args.max_batch_size if args.max_batch_size is not None else cfg['test']['batch_size']
+
+    service = serve.SegmentationService(net, cfg['test']['paddings'], cfg['test']['tile_size'], threshold=mask_threshold,
+                                        max_batch_size=max_batch_size, max_wait_ms=args.max_wait_ms, timeout=args.timeout)
+    service.warm_up()
+    print('Model warmed up, threshold: {}, max batch size: {}, max wait: {} ms'.format(mask_threshold, max_batch_size, args.max_wait_ms))
+
+    handler = make_handler(service, exp_name)
+    if args.socket is not None:
+        if os.path.exists(args.socket):
+            os.remove(args.socket)  # left by a previous server
+        server = ThreadingUnixHTTPServer(args.socket, handler)
+        print('Serving {} on {}'.format(exp_name, args.socket))
+    else:
+        server = ThreadingHTTPServer((args.host, args.port), handler)
+        print('Serving {} on http://{}:{}'.format(exp_name, args.host, args.port))
+
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    server.server_close()
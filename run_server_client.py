@@ -0,0 +1,119 @@
+import io
+import os
+import time
+import json
+import socket
+import argparse
+import http.client
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import cv2
+from PIL import Image
+
+import util.const as const
+import util.load as load
+
+
+class UnixHTTPConnection(http.client.HTTPConnection):
+    def __init__(self, socket_path):
+        super(UnixHTTPConnection, self).__init__('localhost')
+        self.socket_path = socket_path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.connect(self.socket_path)
+
+
+def get_connection(args):
+    if args.socket is not None:
+        return UnixHTTPConnection(args.socket)
+    return http.client.HTTPConnection(args.host, args.port)
+
+def request(args, method, path, body=None):
+    conn = get_connection(args)
+    conn.request(method, path, body=body)
+    response = conn.getresponse()
+    data = response.read()
+    conn.close()
+
+    assert response.status == 200, '{} {} failed with {}: {}'.format(method, path, response.status, data)
+    return data
+
+def make_synthetic_image(seed):
+    '''
+    a gray background with a dark ellipse in the middle, roughly where cars are, encoded as JPEG
+    '''
+    rng = np.random.RandomState(seed)
+    height, width = const.img_size
+    img = np.full((height, width, 3), 230, dtype=np.uint8)
+    cv2.ellipse(img, (width // 2, height // 2), (width // 3, height // 4), 0, 0, 360, (40, 40, 60), -1)
+    img = np.clip(img + rng.randint(-10, 10, img.shape), 0, 255).astype(np.uint8)
+
+    f = io.BytesIO()
+    Image.fromarray(img).save(f, format='JPEG', quality=95)
+    return f.getvalue()
+
+def load_image_bytes(args):
+    '''
+    output:
+      imgs: a list of (img_name, bytes of the image file)
+    '''
+    if args.synthetic:
+        return [ ('synthetic_{}'.format(i), make_synthetic_image(i)) for i in range(args.num_imgs) ]
+
+    imgs = []
+    for img_name in load.load_val_imageset()[:args.num_imgs]:
+        with open(os.path.join(const.TRAIN_DIR, img_name + '.jpg'), 'rb') as f:
+            imgs.append((img_name, f.read()))
+    return imgs
+
+def predict(args, img_name, data):
+    start = time.time()
+    result = request(args, 'POST', '/predict?format={}'.format(args.format), body=data)
+    latency = time.time() - start
+
+    if args.format == 'rle':
+        result = json.loads(result.decode('utf-8'))
+        num_mask_pixels = sum(int(length) for length in result['rle'].split()[1::2])
+        mask_fraction = num_mask_pixels / (result['height'] * result['width'])
+    else:
+        img_mask = np.asarray(Image.open(io.BytesIO(result)))
+        mask_fraction = (img_mask > 0).mean()
+
+    return img_name, latency, mask_fraction
+
+
+if __name__ == "__main__":
+    program_start = time.time()
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--socket', default=None, help='path of the Unix socket of run_server.py, instead of host and port')
+    parser.add_argument('--format', default='rle', choices=['rle', 'png'])
+    parser.add_argument('--num_imgs', type=int, default=8, help='number of different validation images to send')
+    parser.add_argument('--num_requests', type=int, default=64)
+    parser.add_argument('--concurrency', type=int, default=8, help='number of clients sending requests at once')
+    parser.add_argument('--synthetic', action='store_true', help='send generated images, so that no data is needed')
+    args = parser.parse_args()
+
+    print('Server: {}'.format(request(args, 'GET', '/health').decode('utf-8')))
+
+    imgs = load_image_bytes(args)
+    jobs = [ imgs[i % len(imgs)] for i in range(args.num_requests) ]
+
+    send_start = time.time()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+        results = list(executor.map(lambda job: predict(args, *job), jobs))
+    send_time = time.time() - send_start
+
+    for img_name, latency, mask_fraction in results[:len(imgs)]:
+        print('{}: {:.1f} ms, {:.1%} of pixels are car'.format(img_name, latency * 1000, mask_fraction))
+
+    latencies = np.array([ latency for _, latency, _ in results ]) * 1000
+    print('{} requests by {} clients in {:.2f} sec, {:.2f} images/sec'.format(len(results), args.concurrency, send_time, len(results) / send_time))
+    print('Client latency: p50 {:.1f} ms, p90 {:.1f} ms, p99 {:.1f} ms'.format(*np.percentile(latencies, [50, 90, 99])))
+    print('Server stats: {}'.format(request(args, 'GET', '/stats').decode('utf-8')))
+
+    print('Total time spent: {} sec'.format(time.time() - program_start))
@@ -0,0 +1,47 @@
+import time
+import argparse
+
+import numpy as np
+
+import util.load as load
+import util.threshold as threshold
+import util.val_probs as val_probs
+
+
+def print_sweep(thresholds, mean_dices, top_k=5):
+    default_idx = int(round(threshold.DEFAULT_THRESHOLD * (threshold.NUM_BINS - 1)))
+    print('Threshold {:.2f}: dice {:.5f}'.format(thresholds[default_idx], mean_dices[default_idx]))
+
+    for idx in np.argsort(-mean_dices)[:top_k]:
+        print('Threshold {:.2f}: dice {:.5f} ({:+.5f})'.format(thresholds[idx], mean_dices[idx], mean_dices[idx] - mean_dices[default_idx]))
+    return
+
+
+if __name__ == "__main__":
+    program_start = time.time()
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('exp_name', nargs='?', default='PeterUnet3_all_aug_1280')
+    parser.add_argument('--batch_size', type=int, default=8, help='batch size of tiles when caching validation probability maps')
+    parser.add_argument('--num_imgs', type=int, default=None, help='number of validation images to sweep over, all of them by default')
+    parser.add_argument('--dry_run', action='store_true', help='do not save the best threshold')
+    args = parser.parse_args()
+
+    exp_name = args.exp_name
+    val_imgs = load.load_val_imageset()[:args.num_imgs]
+
+    # probability maps are predicted only once, later sweeps only read their histograms
+    val_probs.cache_val_probs(exp_name, val_imgs, args.batch_size)
+
+    sweep_start = time.time()
+    histograms = threshold.load_histograms(threshold.get_val_probs_dir(exp_name), val_imgs)
+    thresholds, mean_dices = threshold.sweep_thresholds(histograms)
+    print('\n{} over {} validation images, {:.3f} sec spent'.format(exp_name, len(val_imgs), time.time() - sweep_start))
+    print_sweep(thresholds, mean_dices)
+
+    best_threshold = thresholds[np.argmax(mean_dices)]
+    if not args.dry_run:
+        threshold.save_threshold(exp_name, best_threshold)
+        print('Saved threshold {:.2f} into {}'.format(best_threshold, threshold.get_threshold_path(exp_name)))
+
+    print('Total time spent: {:.2f} sec'.format(time.time() - program_start))
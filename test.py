@@ -1,25 +1,49 @@
 import torch
-from torch.autograd import Variable
+import torch.nn.functional as F
 
+import os
 import time
+import json
 import argparse
 
+import numpy as np
+
 import util.exp as exp
 import util.evaluation as evaluation
 import util.visualization as viz
 import util.submit as submit
 import util.tile as tile
 import util.crf as crf
+import util.threshold as threshold
+import util.infer_cache as infer_cache
+import util.journal as journal
 import util.ensemble as ensemble
 import util.augmentation as augmentation
 import util.get_time as get_time
+import util.backend as backend
 
 from dataloader import *
 import config
 
 
 
-def tester(exp_name, data_loader, tile_borders, net, criterion, is_val=False, test_time_aug_name=None, reverse_test_time_aug=None, paddings=None, is_ensemble=False, use_crf=False, DEBUG=False):
+def add_to_journal(test_journal, img_names, img_rles):
+    '''
+    input:
+      img_rles: run-length-encoded masks of img_names, or None when only probability maps are saved
+    '''
+    for img_name in img_names:
+        test_journal.add(img_name, img_rles[img_name] if img_rles is not None else None)
+    return
+
+def tester(exp_name, data_loader, tile_borders, net, criterion, is_val=False, test_time_aug_name=None, reverse_test_time_aug=None, paddings=None, is_ensemble=False, crf_settings=None, threshold=0.5, infer_cache=None, run_key=None, DEBUG=False):
+    '''
+    input:
+      crf_settings: settings from crf.get_crf_settings() to post-process predictions with CRF, or None
+      threshold: pixels with probability above it are predicted as car, from run_threshold_sweep.py
+      infer_cache: an infer_cache.InferenceCache of this model and test time augmentation, or None
+      run_key: a string of the model and settings, to resume an interrupted run with the same one, or None
+    '''
     if is_val:
         assert paddings is None  # When validating, paddings is not used
         assert not is_ensemble  # Never save predictions during validation
@@ -28,9 +52,22 @@ def tester(exp_name, data_loader, tile_borders, net, criterion, is_val=False, te
         assert paddings is not None  # When testing, paddings is required
         assert test_time_aug_name is not None  # Test Time augmentation function is required when testing
 
+    # net can be a torch model or any backend from util/backend.py
+    net = backend.get_backend(net)
+    use_cuda = net.use_cuda
+
+    # frozen models from run_freeze.py may skip the last sigmoid and output logits
+    output_logits = net.output_logits
+    threshold_bin = submit.get_threshold_bin(threshold)
+    if output_logits:
+        assert not is_ensemble  # probability maps are required for ensembling
+        assert 0 < threshold < 1, 'threshold of logits has to be between 0 and 1: {}'.format(threshold)
+
+        # floor(100 * sigmoid(outputs)) > threshold_bin is the same as sigmoid(outputs) >= (threshold_bin + 1) / 100
+        min_prob = (threshold_bin + 1) / 100.
+        logit_threshold = np.log(min_prob / (1 - min_prob)) if min_prob < 1 else np.inf
 
-    if torch.cuda.is_available():
-        net.cuda()
+    if use_cuda:
         criterion = criterion.cuda()
     net.eval()  # Change model to 'eval' mode
 
@@ -50,86 +87,160 @@ def tester(exp_name, data_loader, tile_borders, net, criterion, is_val=False, te
         else:
             print('Will generate submission.csv for submission. ')
             img_rles = {}
+            ensemble_dir = None
+
+        # continue an interrupted run with the same run_key, skipping images in its journal
+        test_journal = None
+        completed_img_names = []
+        if run_key is not None:
+            resumable_dir, _ = journal.get_resumable_run(exp_name, test_time_aug_name, run_key)
+            if is_ensemble and resumable_dir is not None:
+                ensemble_dir = resumable_dir
+            run_dir = ensemble_dir if is_ensemble else exp_name
+
+            test_journal = journal.TestJournal(run_dir)
+            if resumable_dir is None:
+                test_journal.remove()  # left by a run of another model or settings
+            completed = test_journal.load()
+            if not is_ensemble:
+                img_rles.update(completed)
+            completed_img_names = list(completed.keys())
+
+            journal.save_run(exp_name, test_time_aug_name, run_key, run_dir, journal.RUNNING)
+            if len(completed_img_names) > 0:
+                print('Resuming {}: {} images are already done'.format(run_dir, len(completed_img_names)))
+
+        # predictions of images in the inference cache are reused
+        cached_img_names = []
+        if infer_cache is not None:
+            completed = set(completed_img_names)
+            test_img_names = [ img_name for img_name in data_loader.sampler.get_img_names() if img_name not in completed ]
+            if is_ensemble:
+                cached_img_names = infer_cache.load_prob_maps(ensemble_dir, test_img_names)
+            else:
+                cached_img_names = infer_cache.load_rles(img_rles, test_img_names)
+            print('{}/{} images are cached in {}'.format(len(cached_img_names), len(test_img_names), infer_cache.cache_dir))
+
+            if test_journal is not None:
+                add_to_journal(test_journal, cached_img_names, img_rles)
+
+        if len(completed_img_names) + len(cached_img_names) > 0:
+            # tiles of these images are skipped
+            data_loader.sampler.skip_imgs(completed_img_names + cached_img_names)
+
+    # CRF runs on whole images in other processes while the network keeps predicting
+    crf_pool = crf.CRFPool(crf_settings, infer_cache=infer_cache) if (crf_settings is not None and not is_val and not is_ensemble) else None
 
     epoch_start = time.time()
+    try:
+        for i, (img_name, images, targets) in enumerate(data_loader):
+            iter_start = time.time()
 
-    for i, (img_name, images, targets) in enumerate(data_loader):
-        iter_start = time.time()
+            images = images.float()  # convert to FloatTensor
+            targets = targets.float()
 
-        images = images.float()  # convert to FloatTensor
-        targets = targets.float()
+            if use_cuda:
+                images = images.cuda()
+                targets = targets.cuda()
 
-        images = Variable(images, volatile=True) # no need to compute gradients
-        targets = Variable(targets, volatile=True)
+            outputs = net(images)
 
-        if torch.cuda.is_available():
-            images = images.cuda()
-            targets = targets.cuda()
+            # remove tile borders
+            images = tile.remove_tile_borders(images, tile_borders)
+            outputs = tile.remove_tile_borders(outputs, tile_borders)
 
-        outputs = net(images)
+            if is_val:
+                targets = tile.remove_tile_borders(targets, tile_borders)
 
-        # remove tile borders
-        images = tile.remove_tile_borders(images, tile_borders)
-        outputs = tile.remove_tile_borders(outputs, tile_borders)
+            # compute dice
+            # binned like saved probability maps, see submit.get_threshold_bin()
+            if output_logits:
+                masks = (outputs >= logit_threshold).float()
+            else:
+                masks = ((outputs * 100).floor() > threshold_bin).float()
 
-        if is_val:
-            targets = tile.remove_tile_borders(targets, tile_borders)
+            # apply CRF to image tiles when validating
+            if crf_settings is not None and is_val:
+                masks = crf.run_crf(images, F.sigmoid(outputs) if output_logits else outputs, crf_settings, threshold)
 
-        # compute dice
-        masks = (outputs > 0.5).float()
+            iter_end = time.time()
 
-        # apply CRF to image tiles
-        if use_crf:
-            masks = crf.run_crf(masks)
+            if is_val:
+                accuracy = evaluation.dice_score(masks, targets).data  # stays on device until the end of validation
+                if output_logits:
+                    loss = criterion(F.sigmoid(outputs), targets)
+                else:
+                    loss = criterion(outputs, targets)
 
-        iter_end = time.time()
+                # Update stats
+                epoch_val_loss     += loss.data
+                epoch_val_accuracy += accuracy
+            else:
+                # masks are merged instead of probabilities when only logits are available
+                tile_preds = masks if output_logits else outputs
+                for img_idx in range(len(img_name)):
+                    tile_probs[img_name[img_idx]] = tile_preds.data[img_idx].cpu().numpy()
+
+                # merge tile predictions into image predictions
+
+                func_start = time.time()
+                merged_img_names = tile.merge_preds_if_possible(exp_name, tile_probs, paddings, img_rles, is_ensemble=is_ensemble, ensemble_dir=ensemble_dir, reverse_test_time_aug=reverse_test_time_aug, crf_pool=crf_pool, threshold=threshold, infer_cache=infer_cache)
+                if test_journal is not None:
+                    add_to_journal(test_journal, crf_pool.pop_collected() if crf_pool is not None else merged_img_names, img_rles)
+                func_end = time.time()
+                #print('merge_preds takes {:.2f} sec. '.format(func_end - func_start))
+
+                iter_end = time.time()
+                if (i % 2000) == 0:
+                    print('Iter {}/{}: {:.2f} sec spent'.format(i, len(data_loader), iter_end - iter_start))
+
+            if DEBUG:
+                # convert to numpy array
+                image = images.data[0].cpu().numpy()
+                mask = masks.data[0].cpu().numpy()
+                target = targets.data[0].cpu().numpy()
+
+                if is_val and float(accuracy) < 0.98:
+                    print('Iter {}, {}: Loss {:.4f}, Accuracy: {:.5f}'.format(i, img_name, float(loss.data), float(accuracy)))
+                    viz.visualize(image, mask, target)
+                else:
+                    viz.visualize(image, mask)
+        # for loop ends
 
         if is_val:
-            accuracy = evaluation.dice_loss(masks, targets)
-            loss = criterion(outputs, targets)
-
-            # Update stats
-            epoch_val_loss     += loss.data[0]
-            epoch_val_accuracy += accuracy
+            epoch_val_loss     = float(epoch_val_loss) / len(data_loader)
+            epoch_val_accuracy = float(epoch_val_accuracy) / len(data_loader)
+            print('Validation Loss: {:.4f} Validation Accuracy:{:.5f}'.format(epoch_val_loss, epoch_val_accuracy))
         else:
-            for img_idx in range(len(img_name)):
-                tile_probs[img_name[img_idx]] = outputs.data[img_idx].cpu().numpy()
-
-            # merge tile predictions into image predictions
+            assert len(tile_probs) == 0  # all tile predictions should now be merged into image predictions now
 
-            func_start = time.time()
-            tile.merge_preds_if_possible(exp_name, tile_probs, paddings, img_rles, is_ensemble=is_ensemble, ensemble_dir=ensemble_dir, reverse_test_time_aug=reverse_test_time_aug)
-            func_end = time.time()
-            #print('merge_preds takes {:.2f} sec. '.format(func_end - func_start))
+            if is_ensemble:
+                if test_journal is not None:
+                    test_journal.flush()
 
-            iter_end = time.time()
-            if (i % 2000) == 0:
-                print('Iter {}/{}: {:.2f} sec spent'.format(i, len(data_loader), iter_end - iter_start))
-
-        if DEBUG:
-            # convert to numpy array
-            image = images.data[0].cpu().numpy()
-            mask = masks.data[0].cpu().numpy()
-            target = targets.data[0].cpu().numpy()
-
-            if is_val and accuracy < 0.98:
-                print('Iter {}, {}: Loss {:.4f}, Accuracy: {:.5f}'.format(i, img_name, loss.data[0], accuracy))
-                viz.visualize(image, mask, target)
+                # only commit the model once all images are saved, and only once if a rerun resumed a run interrupted right here
+                if (exp_name, test_time_aug_name) not in zip(*ensemble.get_models_ensembled(ensemble_dir)):
+                    ensemble.mark_model_ensembled(ensemble_dir, exp_name, test_time_aug_name)
             else:
-                viz.visualize(image, mask)
-    # for loop ends
-
-    if is_val:
-        epoch_val_loss     /= len(data_loader)
-        epoch_val_accuracy /= len(data_loader)
-        print('Validation Loss: {:.4f} Validation Accuracy:{:.5f}'.format(epoch_val_loss, epoch_val_accuracy))
-    else:
-        assert len(tile_probs) == 0  # all tile predictions should now be merged into image predictions now
-
-        if is_ensemble:
-            ensemble.mark_model_ensembled(ensemble_dir, exp_name, test_time_aug_name)
-        else:
-            submit.save_predictions(exp_name, img_rles)
+                if crf_pool is not None:
+                    crf_pool.wait(img_rles)
+                    if test_journal is not None:
+                        add_to_journal(test_journal, crf_pool.pop_collected(), img_rles)
+
+                if test_journal is not None:
+                    test_journal.flush()
+                submit.save_predictions(exp_name, img_rles)
+
+            if test_journal is not None:
+                journal.save_run(exp_name, test_time_aug_name, run_key, run_dir, journal.DONE)
+                test_journal.remove()
+
+            if infer_cache is not None:
+                infer_cache.evict()
+    finally:
+        # pool processes are stopped when testing fails as well
+        if crf_pool is not None:
+            crf_pool.close()
 
     epoch_end = time.time()
     print('Total: {:.2f} sec = {:.1f} hour spent'.format(epoch_end - epoch_start, (epoch_end - epoch_start)/3600))
@@ -146,31 +257,90 @@ if __name__ == "__main__":
 
     parser = argparse.ArgumentParser()
     parser.add_argument('exp_name', nargs='?', default='PeterUnet3_all_aug_1280')
+    parser.add_argument('--frozen', action='store_true', help='use the model saved by run_freeze.py')
+    parser.add_argument('--quantized', action='store_true', help='use the int8 model saved by run_quantize.py on CPU')
+    parser.add_argument('--onnx', action='store_true', help='run the model exported by run_export_onnx.py with ONNX Runtime on CPU')
+    parser.add_argument('--submit', action='store_true', help='generate submission.csv directly instead of saving probability maps for ensembling')
     args = parser.parse_args()
 
     exp_name = args.exp_name
+    is_ensemble = not args.submit
 
     cfg = config.load_config_file(exp_name)
 
-    net, _, criterion, _ = exp.load_exp(exp_name)
+    if args.frozen:
+        net, criterion, _ = exp.load_frozen_exp(exp_name)
+    elif args.quantized:
+        net, criterion, _ = exp.load_quantized_exp(exp_name)
+    elif args.onnx:
+        net = backend.OnnxBackend(exp.get_onnx_path(exp_name))
+        criterion = exp.get_criterion(exp_name)
+    else:
+        net, _, criterion, _ = exp.load_exp(exp_name)
+
+    # threshold chosen by run_threshold_sweep.py, 0.5 if it has not been run
+    mask_threshold = threshold.load_threshold(exp_name)
+    print('Threshold: {}'.format(mask_threshold))
+
+    # CRF post-processing of submissions, set in the 'crf' section of the test config
+    crf_settings = crf.get_crf_settings(cfg) if not is_ensemble else None
+
+    # reuse predictions of the same model file and settings, set in the 'infer_cache' section of the test config
+    model_path = infer_cache.get_model_path(exp_name, frozen=args.frozen, quantized=args.quantized, onnx=args.onnx)
+    infer_cache_settings = infer_cache.get_infer_cache_settings(cfg)
+    model_hash = None
+    if infer_cache_settings is not None and model_path is not None:
+        model_hash = infer_cache.hash_file(model_path)
 
-    TTA_funcs = augmentation.get_TTA_funcs(cfg['test']['test_time_aug'])
+    if is_ensemble:
+        mask_settings = None  # probability maps are cached
+    else:
+        crf_key = { key: value for key, value in crf_settings.items() if key != 'num_processes' } if crf_settings is not None else None
+        mask_settings = {'threshold': mask_threshold, 'crf': crf_key}
+
+    # an interrupted run is resumed by a rerun with the same model file and settings, see util/journal.py
+    run_key = json.dumps({
+        'model': [model_path, os.path.getmtime(model_path)] if model_path is not None else None,
+        'paddings': list(cfg['test']['paddings']),
+        'tile_size': list(cfg['test']['tile_size']),
+        'masks': mask_settings,
+    }, sort_keys=True)
+
+    # Test Time Augmentation is only used for ensembling
+    TTA_funcs = augmentation.get_TTA_funcs(cfg['test']['test_time_aug'] and is_ensemble)
     print('{} test time augmentations to be run...'.format(len(TTA_funcs)))
 
-    for aug_name, test_time_aug, reverse_test_time_aug in TTA_funcs:
+    # one loader for all Test Time Augmentations, so that persistent workers are spawned only once
+    data_loader, tile_borders = get_tta_test_loader(
+        cfg['test']['batch_size'],
+        cfg['test']['paddings'],
+        cfg['test']['tile_size'],
+        [ test_time_aug for _, test_time_aug, _ in TTA_funcs ],
+        loader_settings=get_loader_settings(cfg),
+    )
+
+    for tta_idx, (aug_name, test_time_aug, reverse_test_time_aug) in enumerate(TTA_funcs):
         print('\n\nNow running Test Tiem Augmentaion: {}'.format(aug_name))
 
+        _, run_status = journal.get_resumable_run(exp_name, aug_name, run_key)
+        if run_status == journal.DONE:
+            print('{} was done before this run was interrupted, skipped'.format(aug_name))
+            continue
+
         # data_loader, tile_borders = get_small_test_loader(
-        data_loader, tile_borders = get_test_loader(
-            cfg['test']['batch_size'],
-            cfg['test']['paddings'],
-            cfg['test']['tile_size'],
-            test_time_aug,
-        )
-
-        tester(exp_name, data_loader, tile_borders, net, criterion, paddings=cfg['test']['paddings'], test_time_aug_name=aug_name, reverse_test_time_aug=reverse_test_time_aug, is_ensemble=True)
-        # epoch_val_loss, epoch_val_accuracy = tester(exp_name, data_loader, tile_borders, net, criterion, is_val=True)
+        data_loader.sampler.set_pass(tta_idx)
 
-        # Note that CRF doesn't seem to improve results in previous experiments
+        if model_hash is not None:
+            cache_key = infer_cache.get_cache_key(model_hash, aug_name, cfg['test']['paddings'], cfg['test']['tile_size'], mask_settings)
+            tta_infer_cache = infer_cache.InferenceCache(cache_key, infer_cache_settings)
+        else:
+            tta_infer_cache = None
+
+        tester(exp_name, data_loader, tile_borders, net, criterion, paddings=cfg['test']['paddings'], test_time_aug_name=aug_name, reverse_test_time_aug=reverse_test_time_aug, is_ensemble=is_ensemble,
+               crf_settings=crf_settings, threshold=mask_threshold, infer_cache=tta_infer_cache, run_key=run_key)
+        # epoch_val_loss, epoch_val_accuracy = tester(exp_name, data_loader, tile_borders, net, criterion, is_val=True)
     # for loop ends
+
+    # all Test Time Augmentations are done, a rerun starts over
+    journal.clear_runs(exp_name)
     print('Total time spent: {} secs = {} hours'.format(time.time() - program_start, (time.time() - program_start)/3600))
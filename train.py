@@ -2,6 +2,7 @@ import torch
 import torch.nn as nn
 from torch.autograd import Variable
 
+import os
 import time
 import argparse
 
@@ -14,22 +15,41 @@ import util.exp as exp
 import util.evaluation as evaluation
 import util.visualization as viz
 import util.tile as tile
+import util.timer as timer
+import util.distributed as distributed
+import util.val_cache as val_cache
+import util.load as load
+import util.schedule as schedule
+import util.aug_cache as aug_cache
 
 from dataloader import *
 import config
 import test
 
 
-def trainer(exp_name, train_data_loader, train_tile_borders, cfg, val_data_loader=None, val_tile_borders=None, DEBUG=False, use_tensorboard=True):
+def trainer(exp_name, train_data_loader, train_tile_borders, cfg, val_data_loader=None, val_tile_borders=None, DEBUG=False, use_tensorboard=True, is_distributed=False, local_rank=0, val_subset_loader=None,
+            train_phases=None, loader_settings=None):
+    '''
+    input:
+      train_phases: phases of progressive-resolution training from schedule.get_phases(),
+                    train loaders are then built at the start of every phase instead of using train_data_loader
+    '''
     net, optimizer, criterion, start_epoch = exp.load_exp(exp_name)
 
-    if torch.cuda.is_available():
+    # only the main process logs, validates and saves checkpoints in distributed mode
+    is_main = distributed.is_main_process()
+
+    if is_distributed:
+        net = distributed.wrap_model(net, local_rank)
+        if torch.cuda.is_available():
+            criterion = criterion.cuda()
+    elif torch.cuda.is_available():
         net.cuda()
         criterion = criterion.cuda()
     net.train()  # Change model to 'train' mode
 
     # set up TensorBoard
-    experiment, use_tensorboard = exp.setup_crayon(use_tensorboard, CrayonClient, exp_name)
+    experiment, use_tensorboard = exp.setup_crayon(use_tensorboard and is_main, CrayonClient, exp_name)
 
     # Training setting
     log_iter_interval     = cfg['log_iter_interval']
@@ -37,22 +57,57 @@ def trainer(exp_name, train_data_loader, train_tile_borders, cfg, val_data_loade
     num_epochs = cfg['num_epochs']
     accumulated_batch_size = cfg['train']['accumulated_batch_size']
 
+    # when validating on a subset, the full validation set is only used every full_val_epoch_interval epochs
+    full_val_epoch_interval = (cfg.get('val', None) or {}).get('full_val_epoch_interval', 1)
+
+    # computing training dice every N iterations saves a thresholding pass per step
+    dice_iter_interval = cfg['train'].get('dice_iter_interval', 1)
+
+    # per-stage timers, set sync_stage_timers to True to time GPU stages accurately at the cost of some speed
+    stage_timer = timer.StageTimer(window_size=log_iter_interval, sync_cuda=cfg.get('sync_stage_timers', False))
+
+    phase = None
+
     # Train the Model
     for epoch in range(start_epoch, num_epochs + 1):
         epoch_start = time.time()
 
+        # switch to the resolution of this epoch's phase, also when resuming from a checkpoint
+        if train_phases is not None and schedule.get_phase(train_phases, epoch) is not phase:
+            phase = schedule.get_phase(train_phases, epoch)
+            print('Phase {}: resolution scale {}, tile size {}, batch size {}'.format(
+                phase['index'], phase['scale'], phase['tile_size'], phase['batch_size']))
+
+            train_data_loader = None  # shut down workers of the previous phase
+            train_data_loader, train_tile_borders = get_phase_train_loader(cfg, phase, is_distributed=is_distributed, loader_settings=loader_settings, exp_name=exp_name)
+
         # initialize epoch stats
+        # Note that stats are kept as tensors on device, and are only copied to host when being logged,
+        # so that training doesn't wait for the GPU at every iteration
         epoch_train_loss = 0
         epoch_train_accuracy   = 0
+        num_accuracy_computed  = 0
         accumulated_batch_loss = 0
+        accuracy = 0
 
         print('Epoch [%d/%d] starts'
               % (epoch, num_epochs))
 
-        for i, (img_name, images, targets) in enumerate(train_data_loader):
+        # reshuffle shards of distributed samplers
+        if hasattr(train_data_loader.sampler, 'set_epoch'):
+            train_data_loader.sampler.set_epoch(epoch)
+
+        stage_timer.start('data')
+        for i, batch in enumerate(train_data_loader):
+            stage_timer.stop('data')
             iter_start = time.time()
 
+            # precomputed boundary maps of targets come as an optional fourth element
+            img_name, images, targets = batch[:3]
+            boundary_maps = batch[3] if len(batch) > 3 else None
+
             # convert to FloatTensor
+            stage_timer.start('h2d')
             images = images.float()
             targets = targets.float()
 
@@ -62,37 +117,59 @@ def trainer(exp_name, train_data_loader, train_tile_borders, cfg, val_data_loade
             if torch.cuda.is_available():
                 images = images.cuda()
                 targets = targets.cuda()
-
-            outputs = net(images)
-
-
-            # remove tile borders
-            images = tile.remove_tile_borders(images, train_tile_borders)
-            outputs = tile.remove_tile_borders(outputs, train_tile_borders)
-            targets = tile.remove_tile_borders(targets, train_tile_borders)
-
-            loss = criterion(outputs, targets)
-
-            # generate prediction
-            masks = (outputs > 0.5).float()
-
-            accuracy = evaluation.dice_loss(masks, targets)
-            epoch_train_accuracy += accuracy
-
-            # Backward pass
-            loss.backward()
-            accumulated_batch_loss += (loss.data[0] / accumulated_batch_size)
+                if boundary_maps is not None:
+                    boundary_maps = boundary_maps.cuda()
+            stage_timer.stop('h2d')
+
+            # all-reduce gradients only on iterations that update weights
+            is_step = (i + 1) % accumulated_batch_size == 0
+            with distributed.grad_sync(net, is_step):
+                stage_timer.start('forward')
+                outputs = net(images)
+                stage_timer.stop('forward')
+
+                # remove tile borders
+                stage_timer.start('borders')
+                images = tile.remove_tile_borders(images, train_tile_borders)
+                outputs = tile.remove_tile_borders(outputs, train_tile_borders)
+                targets = tile.remove_tile_borders(targets, train_tile_borders)
+                if boundary_maps is not None:
+                    boundary_maps = tile.remove_tile_borders(boundary_maps, train_tile_borders)
+                stage_timer.stop('borders')
+
+                stage_timer.start('loss')
+                if boundary_maps is not None:
+                    loss = criterion(outputs, targets, boundary_maps)
+                else:
+                    loss = criterion(outputs, targets)
+                stage_timer.stop('loss')
+
+                # generate prediction
+                if (i + 1) % dice_iter_interval == 0 or DEBUG:
+                    stage_timer.start('dice')
+                    masks = (outputs > 0.5).float()
+
+                    accuracy = evaluation.dice_score(masks, targets).data
+                    epoch_train_accuracy  += accuracy
+                    num_accuracy_computed += 1
+                    stage_timer.stop('dice')
+
+                # Backward pass
+                stage_timer.start('backward')
+                loss.backward()
+                stage_timer.stop('backward')
+            accumulated_batch_loss += (loss.data / accumulated_batch_size)
 
             # Update epoch stats
-            epoch_train_loss     += loss.data[0]
+            epoch_train_loss     += loss.data
 
             # Log Training Progress
-            if (i + 1) % log_iter_interval == 0:
+            if (i + 1) % log_iter_interval == 0 and is_main:
                 print('Epoch [%d/%d] Iter [%d/%d] Loss: %.3f Accumd Loss:%.4f Accuracy: %.5f'
-                    % (epoch, num_epochs, i + 1, len(train_data_loader), loss.data[0], accumulated_batch_loss, accuracy))
+                    % (epoch, num_epochs, i + 1, len(train_data_loader), float(loss.data), float(accumulated_batch_loss), float(accuracy)))
 
-            if DEBUG and accuracy < 0.98:
-                print('Epoch {}, Iter {}, {}: Loss {:.5f}, Accuracy: {:.6f}'.format(epoch, i, img_name, loss.data[0], accuracy))
+            if DEBUG and float(accuracy) < 0.98:
+                print('Epoch {}, Iter {}, {}: Loss {:.5f}, Accuracy: {:.6f}'.format(epoch, i, img_name, float(loss.data), float(accuracy)))
 
                 # convert to numpy array
                 image = images.data[0].cpu().numpy()
@@ -101,40 +178,58 @@ def trainer(exp_name, train_data_loader, train_tile_borders, cfg, val_data_loade
 
                 viz.visualize(image, mask, target)
 
-            if (i+1) % accumulated_batch_size == 0:
+            if is_step:
+                stage_timer.start('step')
                 optimizer.step()
 
                 # reset
                 optimizer.zero_grad()
                 accumulated_batch_loss = 0
+                stage_timer.stop('step')
 
             iter_end = time.time()
             # Log Training Progress
-            if (i + 1) % log_iter_interval == 0:
+            if (i + 1) % log_iter_interval == 0 and is_main:
                 print('Time Spent: {:.2f} sec'.format(iter_end - iter_start))
+                print(stage_timer.summary())
+
+                if use_tensorboard:
+                    stage_timer.log_to_crayon(experiment, step=(epoch - 1) * len(train_data_loader) + i + 1)
+
+            stage_timer.start('data')
 
         # inner for loop ends
 
-        epoch_train_loss     /= len(train_data_loader)
-        epoch_train_accuracy /= len(train_data_loader)
+        epoch_train_loss     = float(epoch_train_loss) / len(train_data_loader)
+        epoch_train_accuracy = float(epoch_train_accuracy) / max(num_accuracy_computed, 1)
 
         # Validate
-        if val_data_loader is not None:
-            epoch_val_loss, epoch_val_accuracy = test.tester(exp_name, val_data_loader, val_tile_borders, net, criterion, is_val=True)
+        is_full_val = (val_subset_loader is None) or (epoch % full_val_epoch_interval == 0) or (epoch == num_epochs)
+        if val_data_loader is not None and is_main:
+            epoch_val_loader = val_data_loader if is_full_val else val_subset_loader
+            epoch_val_loss, epoch_val_accuracy = test.tester(exp_name, epoch_val_loader, val_tile_borders, distributed.unwrap_model(net), criterion, is_val=True)
 
         if use_tensorboard:
             experiment.add_scalar_value('train loss', epoch_train_loss, step=epoch)
             experiment.add_scalar_value('train accuracy', epoch_train_accuracy, step=epoch)
 
-            if val_data_loader is not None:
+            if val_data_loader is not None and is_full_val:
                 experiment.add_scalar_value('val loss', epoch_val_loss, step=epoch)
                 experiment.add_scalar_value('val accuracy', epoch_val_accuracy, step=epoch)
+            elif val_data_loader is not None:
+                experiment.add_scalar_value('val subset loss', epoch_val_loss, step=epoch)
+                experiment.add_scalar_value('val subset accuracy', epoch_val_accuracy, step=epoch)
 
             # experiment.add_scalar_value('learning_rate', lr, step=epoch)
 
         # Save the trained model
-        if epoch % snapshot_epoch_interval == 0:
-            exp.save_checkpoint(exp_name, epoch, net.state_dict(), optimizer.state_dict())
+        if epoch % snapshot_epoch_interval == 0 and is_main:
+            # only scores on the full validation set are comparable
+            epoch_score = epoch_val_accuracy if (val_data_loader is not None and is_full_val) else None
+            exp.save_checkpoint(exp_name, epoch, distributed.unwrap_model(net).state_dict(), optimizer.state_dict(), score=epoch_score, phase=phase)
+
+        # other processes wait for validation of the main process
+        distributed.barrier()
 
         epoch_end = time.time()
         print('Epoch [%d/%d] Loss: %.4f Accuracy: %.5f Time Spent: %.2f sec'
@@ -142,37 +237,145 @@ def trainer(exp_name, train_data_loader, train_tile_borders, cfg, val_data_loade
 
     # outer for loop ends
 
+    # make sure the last checkpoints are written
+    exp.wait_for_checkpoints()
+
     return
 
 
-if __name__ == "__main__":
-    parser = argparse.ArgumentParser()
-    parser.add_argument('exp_name', nargs='?', default='PeterUnetInception2')
-    args = parser.parse_args()
-
-    exp_name = args.exp_name
+def get_phase_train_loader(cfg, phase, is_distributed=False, loader_settings=None, exp_name=None):
+    '''
+    train loader of a phase of progressive-resolution training, with tile layout recomputed for its resolution
+    '''
+    aug_cache_cfg = cfg['train'].get('aug_cache', None) or {}
+    if aug_cache_cfg.get('replay', False) and phase['scale'] == 1:
+        # replay samples pre-augmented by run_aug_cache.py
+        return get_aug_cache_loader(
+            phase['batch_size'],
+            aug_cache.get_cache_dir(exp_name),
+            cfg['train']['paddings'],
+            phase['tile_size'],
+            is_distributed=is_distributed,
+            loader_settings=loader_settings,
+            seed=cfg['train'].get('aug_seed', None) or 0,
+        )
 
-    cfg = config.load_config_file(exp_name)
     # train_data_loader, train_tile_borders = get_small_loader(
-    train_data_loader, train_tile_borders = get_train_loader(
-        cfg['train']['batch_size'],
+    return get_train_loader(
+        phase['batch_size'],
         cfg['train']['paddings'],
-        cfg['train']['tile_size'],
+        phase['tile_size'],
         cfg['train']['hflip'],
         cfg['train']['shift'],
         cfg['train']['color'],
         cfg['train']['rotate'],
         cfg['train']['scale'],
         cfg['train']['fancy_pca'],
-        cfg['train']['edge_enh']
+        cfg['train']['edge_enh'],
+        is_distributed=is_distributed,
+        loader_settings=loader_settings,
+        resolution_scale=phase['scale'],
+        grouped_sampler=cfg['train'].get('grouped_sampler', None),
+        aug_seed=cfg['train'].get('aug_seed', None),
+        boundary_enabled=cfg['train'].get('precomputed_boundary', False),
     )
 
-    # val_data_loader, val_tile_borders = get_small_loader(
-    val_data_loader, val_tile_borders = get_val_loader(
-        cfg['test']['batch_size'],
-        cfg['test']['paddings'],
-        cfg['test']['tile_size'],
-        False, False, False, False, False, False, False
-    )
+def get_train_phases(cfg):
+    '''
+    phases of progressive-resolution training, or None if cfg has no schedule
+    '''
+    return schedule.get_phases(cfg) if cfg['train'].get('schedule', None) else None
+
+def get_loaders(cfg, is_distributed=False, with_val=True, loader_settings=None, exp_name=None):
+    if get_train_phases(cfg) is None:
+        train_data_loader, train_tile_borders = get_phase_train_loader(
+            cfg, schedule.get_phases(cfg)[0], is_distributed=is_distributed, loader_settings=loader_settings, exp_name=exp_name)
+    else:
+        # trainer builds a train loader at the start of every phase
+        train_data_loader, train_tile_borders = None, None
+
+    if not with_val:
+        return train_data_loader, train_tile_borders, None, None, None
+
+    val_cfg = cfg.get('val', None) or {}
+    val_subset_loader = None
+
+    if val_cfg.get('cache', False):
+        # validate on cached pre-tiled images instead of decoding them every epoch
+        val_batch_size = val_cfg.get('batch_size', cfg['test']['batch_size'])
+        val_data_loader, val_tile_borders = get_cached_val_loader(
+            val_batch_size,
+            cfg['test']['paddings'],
+            cfg['test']['tile_size'],
+            loader_settings=loader_settings,
+        )
+
+        if val_cfg.get('subset_size', None):
+            # validate on a fixed subset every epoch, and on the full split every full_val_epoch_interval epochs
+            val_subset_imgs = val_cache.get_stratified_subset(load.load_val_imageset(), val_cfg['subset_size'])
+            val_subset_loader, _ = get_cached_val_loader(
+                val_batch_size,
+                cfg['test']['paddings'],
+                cfg['test']['tile_size'],
+                img_names=val_subset_imgs,
+                loader_settings=loader_settings,
+            )
+    else:
+        # val_data_loader, val_tile_borders = get_small_loader(
+        val_data_loader, val_tile_borders = get_val_loader(
+            cfg['test']['batch_size'],
+            cfg['test']['paddings'],
+            cfg['test']['tile_size'],
+            False, False, False, False, False, False, False,
+            loader_settings=loader_settings,
+        )
+
+    return train_data_loader, train_tile_borders, val_data_loader, val_tile_borders, val_subset_loader
+
+def run_worker(local_rank, exp_name, world_size):
+    '''
+    entry point of one training process in distributed mode
+    '''
+    rank = int(os.environ.get('RANK', local_rank))  # set by torchrun when running across nodes
+    local_world_size = int(os.environ.get('LOCAL_WORLD_SIZE', world_size))
+
+    distributed.init_process_group(rank, world_size)
+    distributed.set_num_threads_per_process(local_world_size)
+
+    cfg = config.load_config_file(exp_name)
+
+    # split loader workers among local processes
+    loader_settings = get_loader_settings(cfg)
+    loader_settings['num_workers'] = max(1, loader_settings['num_workers'] // local_world_size)
+
+    train_data_loader, train_tile_borders, val_data_loader, val_tile_borders, val_subset_loader = get_loaders(
+        cfg, is_distributed=True, with_val=distributed.is_main_process(), loader_settings=loader_settings, exp_name=exp_name)
+
+    trainer(exp_name, train_data_loader, train_tile_borders, cfg, val_data_loader=val_data_loader, val_tile_borders=val_tile_borders, DEBUG=False,
+            is_distributed=True, local_rank=local_rank, val_subset_loader=val_subset_loader,
+            train_phases=get_train_phases(cfg), loader_settings=loader_settings)
+    return
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('exp_name', nargs='?', default='PeterUnetInception2')
+    parser.add_argument('--world_size', type=int, default=1, help='number of local training processes, each training on its own shard of cars')
+    args = parser.parse_args()
+
+    exp_name = args.exp_name
+
+    if 'LOCAL_RANK' in os.environ:
+        # launched by torchrun, possibly across nodes
+        run_worker(int(os.environ['LOCAL_RANK']), exp_name, int(os.environ['WORLD_SIZE']))
+
+    elif args.world_size > 1:
+        torch.multiprocessing.spawn(run_worker, args=(exp_name, args.world_size), nprocs=args.world_size)
+
+    else:
+        cfg = config.load_config_file(exp_name)
+        loader_settings = get_loader_settings(cfg)
+        train_data_loader, train_tile_borders, val_data_loader, val_tile_borders, val_subset_loader = get_loaders(cfg, loader_settings=loader_settings, exp_name=exp_name)
 
-    trainer(exp_name, train_data_loader, train_tile_borders, cfg, val_data_loader=val_data_loader, val_tile_borders=val_tile_borders, DEBUG=False)
+        trainer(exp_name, train_data_loader, train_tile_borders, cfg, val_data_loader=val_data_loader, val_tile_borders=val_tile_borders, DEBUG=False,
+                val_subset_loader=val_subset_loader, train_phases=get_train_phases(cfg), loader_settings=loader_settings)
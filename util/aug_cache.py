@@ -0,0 +1,124 @@
+'''
+Cache of pre-augmented training samples
+
+Augmentations are computed offline, e.g. on idle CPU machines with run_aug_cache.py, and replayed in training.
+Variant v of a sample is augmented with the generator of epoch v (see LargeDataset.get_rng), and saved as
+  variant_<v>/<sample_idx>.npz: compressed uint8 image of shape (3, tile_height, tile_width) and bit-packed target
+Training cycles through complete variants across epochs. The cache size is capped by removing the oldest variants.
+'''
+
+import os
+import csv
+import shutil
+
+import numpy as np
+
+import util.const as const
+import util.exp as exp
+import util.val_cache as val_cache
+
+
+def get_cache_dir(exp_name):
+    return os.path.join(const.CACHE_DIR, exp_name + '_aug')
+
+def get_variant_dir(cache_dir, variant):
+    return os.path.join(cache_dir, 'variant_{}'.format(variant))
+
+def list_variants(cache_dir):
+    '''
+    output:
+      variants: sorted list of ids of complete variants, oldest first
+    '''
+    if not os.path.isdir(cache_dir):
+        return []
+
+    variants = []
+    for dir_name in os.listdir(cache_dir):
+        if not dir_name.startswith('variant_'):
+            continue
+
+        variant = dir_name[len('variant_'):]
+        if variant.isdigit() and val_cache.is_cache_complete(os.path.join(cache_dir, dir_name)):
+            variants.append(int(variant))
+
+    return sorted(variants)
+
+def get_next_variant(cache_dir):
+    '''
+    new variants get new ids, so they are augmented differently from all variants generated before
+    '''
+    if not os.path.isdir(cache_dir):
+        return 1
+
+    variants = [ int(dir_name[len('variant_'):]) for dir_name in os.listdir(cache_dir)
+                 if dir_name.startswith('variant_') and dir_name[len('variant_'):].isdigit() ]
+    return max(variants) + 1 if variants else 1
+
+def get_dir_size(dir_path):
+    size = 0
+    for root, _, file_names in os.walk(dir_path):
+        for file_name in file_names:
+            size += os.path.getsize(os.path.join(root, file_name))
+    return size
+
+def save_tile_names(cache_dir, tile_names):
+    with open(os.path.join(cache_dir, 'tile_names.csv'), 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerows([ [tile_name] for tile_name in tile_names ])
+    return
+
+def build_variant(cache_dir, variant, data_loader, tile_names):
+    '''
+    save one augmented variant of every sample
+
+    input:
+      data_loader: yields batches of (tile_names, images, targets) in any order
+      tile_names: names of all samples, whose indices name the saved files
+    '''
+    variant_dir = exp.create_dir_if_not_exist(get_variant_dir(cache_dir, variant))
+    sample_idx_by_name = { tile_name: idx for idx, tile_name in enumerate(tile_names) }
+    num_samples = len(tile_names)
+
+    num_saved = 0
+    for i, (batch_tile_names, images, targets) in enumerate(data_loader):
+        images = images.numpy()
+        targets = targets.numpy()
+
+        for j in range(len(batch_tile_names)):
+            save_path = os.path.join(variant_dir, '{}.npz'.format(sample_idx_by_name[batch_tile_names[j]]))
+            np.savez_compressed(save_path, image=images[j], target=val_cache.pack_mask(targets[j]))
+            num_saved += 1
+
+        if (i % 100) == 0:
+            print('Caching variant {}: {}/{} samples'.format(variant, num_saved, num_samples))
+
+    assert num_saved == num_samples
+
+    # mark the variant as complete only when everything is written
+    open(val_cache.get_done_path(variant_dir), 'a').close()
+    return
+
+def remove_oldest_variants(cache_dir, max_bytes):
+    '''
+    remove the oldest variants until the cache fits in max_bytes, always keeping the newest one
+    '''
+    variants = list_variants(cache_dir)
+    sizes = { variant: get_dir_size(get_variant_dir(cache_dir, variant)) for variant in variants }
+
+    while len(variants) > 1 and sum(sizes[variant] for variant in variants) > max_bytes:
+        oldest = variants.pop(0)
+        print('Removing variant {} of {}'.format(oldest, cache_dir))
+        shutil.rmtree(get_variant_dir(cache_dir, oldest), ignore_errors=True)
+
+    return variants
+
+def load_sample(cache_dir, variant, sample_idx, tile_size):
+    '''
+    output:
+      img: uint8 numpy array of shape (3, tile_height, tile_width)
+      target: uint8 numpy array of shape (1, tile_height, tile_width)
+    '''
+    with np.load(os.path.join(get_variant_dir(cache_dir, variant), '{}.npz'.format(sample_idx))) as sample:
+        img = sample['image']
+        target = val_cache.unpack_mask(sample['target'], tile_size)
+    return img, target
@@ -0,0 +1,139 @@
+'''
+Inference backends used by test.tester
+
+A backend takes a batch of image tiles as a tensor of size (batch_size, 3, height, width)
+and returns predictions as a tensor of size (batch_size, 1, height, width) without gradients,
+so that the same tiling, TTA and RLE pipeline can run on different runtimes.
+'''
+
+import copy
+
+import torch
+
+try:
+    import onnx
+except ImportError:
+    onnx = None
+
+try:
+    import onnxruntime
+except ImportError:
+    onnxruntime = None
+
+
+class TorchBackend(object):
+    '''
+    run a torch nn.Module, on GPU if available
+    '''
+    def __init__(self, net):
+        self.net = net
+
+        # quantized models only run on CPU
+        self.use_cuda = torch.cuda.is_available() and not getattr(net, 'is_quantized', False)
+
+        # frozen models from run_freeze.py may skip the last sigmoid and output logits
+        self.output_logits = getattr(net, 'output_logits', False)
+
+    def eval(self):
+        if self.use_cuda:
+            self.net.cuda()
+        self.net.eval()
+        return
+
+    def train(self):
+        self.net.train()
+        return
+
+    def __call__(self, images):
+        with torch.no_grad():
+            return self.net(images)
+
+
+class OnnxBackend(object):
+    '''
+    run a model exported by export_onnx() with ONNX Runtime on CPU
+    '''
+    use_cuda = False
+
+    def __init__(self, onnx_path, num_threads=0):
+        if onnxruntime is None:
+            raise ImportError('onnxruntime is required to run ONNX models: pip install onnxruntime')
+
+        options = onnxruntime.SessionOptions()
+        options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+        if num_threads > 0:
+            options.intra_op_num_threads = num_threads
+
+        self.session = onnxruntime.InferenceSession(onnx_path, options, providers=['CPUExecutionProvider'])
+        self.input_name = self.session.get_inputs()[0].name
+
+        metadata = self.session.get_modelmeta().custom_metadata_map
+        self.output_logits = (metadata.get('output_logits') == 'True')
+
+    def eval(self):
+        return
+
+    def train(self):
+        return
+
+    def __call__(self, images):
+        inputs = images.cpu().numpy()
+        outputs = self.session.run(None, {self.input_name: inputs})[0]
+        return torch.from_numpy(outputs)
+
+
+def get_backend(net):
+    '''
+    wrap torch models with TorchBackend and leave other backends as they are
+    '''
+    if isinstance(net, torch.nn.Module):
+        return TorchBackend(net)
+    return net
+
+
+def export_onnx(net, save_path, tile_size, batch_size=1, dynamic=False, opset_version=11):
+    '''
+    input:
+      net: a torch model, exported from a copy on CPU
+      tile_size: a tuple of ints (height, width), input size used for tracing
+      dynamic: if True, height and width are dynamic axes of the exported model as well,
+               batch size always is since the last batch of a test loader can be smaller
+    '''
+    if onnx is None:
+        # without it output_logits can't be recorded, and logits of frozen models would be thresholded as probabilities
+        raise ImportError('onnx is required to export models: pip install onnx')
+
+    net = copy.deepcopy(net).cpu()
+    net.eval()
+
+    height, width = tile_size
+    images = torch.rand(batch_size, 3, height, width) * 255
+
+    if dynamic:
+        dynamic_axes = {
+            'images':  {0: 'batch_size', 2: 'height', 3: 'width'},
+            'outputs': {0: 'batch_size', 2: 'height', 3: 'width'},
+        }
+    else:
+        dynamic_axes = {
+            'images':  {0: 'batch_size'},
+            'outputs': {0: 'batch_size'},
+        }
+
+    with torch.no_grad():
+        torch.onnx.export(
+            net, images, save_path,
+            input_names=['images'],
+            output_names=['outputs'],
+            dynamic_axes=dynamic_axes,
+            opset_version=opset_version,
+        )
+
+    # record whether the last sigmoid is skipped so OnnxBackend knows how to threshold outputs
+    model = onnx.load(save_path)
+    metadata = model.metadata_props.add()
+    metadata.key = 'output_logits'
+    metadata.value = str(getattr(net, 'output_logits', False))
+    onnx.save(model, save_path)
+
+    return
@@ -0,0 +1,71 @@
+'''
+Boundary maps of training masks, precomputed for BoundaryWeightedLoss
+
+A boundary map is a uint8 png with 1 where the average of the 11x11 neighborhood of the mask is between 0.01 and 0.99,
+and 0 elsewhere. It is loaded with the same augmentations as its mask, so the loss doesn't need to pool targets every step.
+
+Maps are the boundaries BoundaryWeightedLoss would pool from the targets it is given, so in reduced-resolution phases
+they are computed from the mask resized to the phase resolution, and the band stays 11 pixels wide at every resolution.
+Maps of each image size are kept in a directory of their own, see get_boundary_dir().
+'''
+
+import os
+
+import numpy as np
+import cv2
+from PIL import Image
+
+import util.const as const
+import util.exp as exp
+import util.load as load
+
+
+BOUNDARY_DIR = os.path.join(const.CACHE_DIR, 'boundary')
+
+def get_boundary_dir(img_size=None):
+    '''
+    input:
+      img_size: a tuple of ints (height, width) masks are resized to before padding, or None for full resolution
+    '''
+    if img_size is None:
+        return BOUNDARY_DIR
+    return os.path.join(BOUNDARY_DIR, '{}x{}'.format(*img_size))
+
+def get_boundary_path(img_name, img_size=None):
+    return os.path.join(get_boundary_dir(img_size), img_name + '_boundary.png')
+
+def compute_boundary_map(mask, kernel_size=11):
+    '''
+    input:
+      mask: numpy array of shape (height, width) with 0's and 1's
+    output:
+      boundary_map: uint8 numpy array of shape (height, width) with 0's and 1's,
+                    the same as the boundary of BoundaryWeightedLoss with zero padding
+    '''
+    avg_neighbors = cv2.boxFilter((mask > 0).astype(np.float32), -1, (kernel_size, kernel_size),
+                                  normalize=True, borderType=cv2.BORDER_CONSTANT)
+    return ((avg_neighbors >= 0.01) & (avg_neighbors <= 0.99)).astype(np.uint8)
+
+def build_boundary_maps(img_names, img_size=None):
+    '''
+    compute boundary maps of the masks of img_names that don't have one yet
+
+    input:
+      img_size: a tuple of ints (height, width) to resize masks to like LargeDataset does, or None for full resolution
+    '''
+    exp.create_dir_if_not_exist(get_boundary_dir(img_size))
+
+    missing = [ img_name for img_name in img_names if not os.path.isfile(get_boundary_path(img_name, img_size)) ]
+    for i, img_name in enumerate(missing):
+        mask = load.load_image_file(const.TRAIN_MASK_DIR, img_name + '_mask', 'gif', 0, img_size)
+        boundary_map = compute_boundary_map(mask)
+
+        # write to a temporary file first, so that a map is either complete or missing
+        save_path = get_boundary_path(img_name, img_size)
+        Image.fromarray(boundary_map).save(save_path + '.tmp.png')
+        os.replace(save_path + '.tmp.png', save_path)
+
+        if (i % 100) == 0:
+            print('Computing boundary maps: {}/{}'.format(i + 1, len(missing)))
+
+    return
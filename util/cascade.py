@@ -0,0 +1,148 @@
+'''
+Coarse-to-fine cascade inference
+
+A coarse model predicts a whole padded image at reduced resolution, loaded and padded the same way as in reduced-resolution
+training phases, so that JPEG images are decoded at reduced resolution too. Its probabilities are upsampled to full
+resolution, and only the small tiles whose bodies have pixels in an uncertain band around the mask boundary,
+i.e. low < probability < high, are predicted again by a fine model at full resolution and pasted over the coarse ones.
+'''
+
+import numpy as np
+import cv2
+
+import torch
+import torch.nn.functional as F
+
+import util.const as const
+import util.tile as tile
+
+
+def predict_batch(net, images):
+    '''
+    input:
+      net: a backend from backend.get_backend()
+      images: numpy array of shape (batch_size, 3, height, width)
+    output:
+      probs: numpy array of shape (batch_size, height, width)
+    '''
+    images = torch.from_numpy(np.ascontiguousarray(images)).float()
+    if net.use_cuda:
+        images = images.cuda()
+
+    with torch.no_grad():
+        outputs = net(images)
+        if net.output_logits:
+            outputs = F.sigmoid(outputs)
+
+    return outputs.data[:, 0].cpu().numpy()
+
+def pad_to_multiple(img, multiple):
+    '''
+    pad the bottom and right of img of shape (channels, height, width) with 0's so that height and width are multiples of multiple
+    '''
+    _, height, width = img.shape
+    pad_height = -height % multiple
+    pad_width = -width % multiple
+    return np.lib.pad(img, ((0, 0), (0, pad_height), (0, pad_width)), 'constant')
+
+def predict_coarse(net, small_padded_img, paddings, multiple=128):
+    '''
+    input:
+      small_padded_img: numpy array of shape (3, small_height, small_width), an image loaded with
+                        load.load_image_file(..., img_size=tile.get_scaled_img_size(paddings, scale)) and padded with paddings
+      multiple: height and width of inputs have to be multiples of it, 2 ** (number of poolings) of the model
+    output:
+      probs: numpy array of shape (height, width) of the padded image at full resolution, 0 in paddings
+    '''
+    _, small_height, small_width = small_padded_img.shape
+    small_img = pad_to_multiple(small_padded_img, multiple)
+
+    small_probs = predict_batch(net, small_img[np.newaxis])[0, :small_height, :small_width]
+    small_probs = np.ascontiguousarray(tile.remove_paddings(small_probs, paddings))
+
+    probs = cv2.resize(small_probs, (const.img_size[1], const.img_size[0]), interpolation=cv2.INTER_LINEAR)
+    return tile.pad_image(probs[np.newaxis], paddings)[0]
+
+def get_tile_bodies(img_size, tile_size):
+    '''
+    output:
+      tile_names: tile names of one image named 'img', in img-<row_idx>-<col_idx> format
+      bodies: a list of (y_start, y_end, x_start, x_end) of tile bodies, i.e. tiles without borders, in the padded image
+    '''
+    tile_layout, tile_border = tile.get_tile_layout(tile_size, img_size)
+    body_height = tile_size[0] - 2 * tile_border[0]
+    body_width = tile_size[1] - 2 * tile_border[1]
+
+    tile_names = tile.generate_tile_names(['img'], tile_size, img_size)
+    bodies = []
+    for tile_name in tile_names:
+        row_idx, col_idx = tile.get_tile_pos(tile_name)
+        y_start, x_start = (row_idx - 1) * body_height, (col_idx - 1) * body_width
+        bodies.append((y_start, y_start + body_height, x_start, x_start + body_width))
+
+    return tile_names, bodies
+
+def predict_tiles(net, padded_img, tile_names, bodies, tile_size, probs, batch_size):
+    '''
+    predict tiles at full resolution, and paste their bodies into probs in place
+    '''
+    _, tile_border = tile.get_tile_layout(tile_size, padded_img.shape[1:])
+
+    for i in range(0, len(tile_names), batch_size):
+        batch_tile_names = tile_names[i:i + batch_size]
+        images = np.stack([ tile.get_tile(padded_img, tile_name, tile_size) for tile_name in batch_tile_names ])
+
+        tile_probs = predict_batch(net, images)
+        height_border, width_border = tile_border
+        tile_probs = tile_probs[:, height_border:tile_size[0] - height_border, width_border:tile_size[1] - width_border]
+
+        for j, (y_start, y_end, x_start, x_end) in enumerate(bodies[i:i + batch_size]):
+            probs[y_start:y_end, x_start:x_end] = tile_probs[j]
+
+    return probs
+
+def predict_full(net, padded_img, tile_size, batch_size=1):
+    '''
+    predict every tile at full resolution, the same as test.tester does
+    '''
+    tile_names, bodies = get_tile_bodies(padded_img.shape[1:], tile_size)
+    probs = np.zeros(padded_img.shape[1:], dtype=np.float32)
+    return predict_tiles(net, padded_img, tile_names, bodies, tile_size, probs, batch_size)
+
+def predict_cascade(coarse_net, fine_net, padded_img, small_padded_img, paddings, refine_tile_size, uncertain_band=(0.02, 0.98),
+                    min_uncertain_pixels=1, batch_size=8, multiple=128):
+    '''
+    input:
+      coarse_net, fine_net: backends from backend.get_backend(), possibly the same one
+      padded_img: numpy array of shape (3, height, width)
+      small_padded_img: the same image at the resolution scale of the coarse model, see predict_coarse()
+      refine_tile_size: a tuple of ints (height, width) of tiles refined at full resolution, which must fit
+                        tile.get_tile_layout() for the padded image size, e.g. (384, 512) for 1280x1920 images
+    output:
+      probs: numpy array of shape (height, width)
+      refined_fraction: fraction of pixels predicted again at full resolution
+    '''
+    probs = predict_coarse(coarse_net, small_padded_img, paddings, multiple)
+
+    low, high = uncertain_band
+    is_uncertain = (probs > low) & (probs < high)
+
+    tile_names, bodies = get_tile_bodies(padded_img.shape[1:], refine_tile_size)
+    refine_idxs = [ idx for idx, (y_start, y_end, x_start, x_end) in enumerate(bodies)
+                    if is_uncertain[y_start:y_end, x_start:x_end].sum() >= min_uncertain_pixels ]
+
+    refine_tile_names = [ tile_names[idx] for idx in refine_idxs ]
+    refine_bodies = [ bodies[idx] for idx in refine_idxs ]
+    predict_tiles(fine_net, padded_img, refine_tile_names, refine_bodies, refine_tile_size, probs, batch_size)
+
+    refined_pixels = sum((y_end - y_start) * (x_end - x_start) for y_start, y_end, x_start, x_end in refine_bodies)
+    refined_fraction = refined_pixels / float(probs.size)
+
+    return probs, refined_fraction
+
+def get_dice(mask, target):
+    '''
+    dice of numpy arrays of 0's and 1's, the same as evaluation.dice_score() for one image
+    '''
+    intersection = (mask * target).sum()
+    return 2. * (intersection + 1) / (mask.sum() + target.sum() + 1)
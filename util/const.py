@@ -13,6 +13,8 @@ OUTPUT_DIR = './output'
 
 PROBS_DIR_NAME = 'probs'
 
+CACHE_DIR = os.path.join(OUTPUT_DIR, 'cache')
+
 
 # Images are of size 1918 * 1280
 img_size = (1280, 1918) # (height, width)
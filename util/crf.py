@@ -1,26 +1,183 @@
 import time
+import multiprocessing
+
 import numpy as np
+import cv2
 import torch
-from torch.autograd import Variable
-
-import pydensecrf.densecrf as dcrf
-from pydensecrf.utils import compute_unary, create_pairwise_bilateral, create_pairwise_gaussian, unary_from_softmax
-
-def run_crf(masks):
-    print("You're using CRF. Are you sure? In our previous experiments, it has never improved the performance. ")
-    crf_masks = np.zeros(masks.data.size())  # shape: (batch_size, 1, height, width)
-    for img_idx in range(len(img_name)):
-        img  =  images.data[img_idx].cpu().numpy()  # shape: (3, height, width)
-        prob = outputs.data[img_idx].cpu().numpy()  # shape: (1, height, width)
-        crf_masks[img_idx] = crf(img, prob)
-
-        # convert CRF results back into Variable in GPU
-        masks = Variable(torch.from_numpy(crf_masks).float(), volatile=True)
-        if torch.cuda.is_available():
-            masks = masks.cuda()
+
+try:
+    import pydensecrf.densecrf as dcrf
+    from pydensecrf.utils import compute_unary, create_pairwise_bilateral, create_pairwise_gaussian, unary_from_softmax
+except ImportError:
+    dcrf = None
+
+import util.const as const
+import util.load as load
+import util.run_length as run_length
+import util.submit as submit
+
+
+# used for keys missing from the 'crf' section of the test config
+default_crf_settings = {
+    'enabled': False,
+    'band_width': 8,      # pixels on each side of the predicted boundary that CRF may change
+    'window_size': 128,   # the band is covered by windows of this size, each one is a separate CRF
+    'window_margin': 16,  # context around windows
+    'num_iter': 5,
+    'num_processes': 8,
+}
+
+def get_crf_settings(cfg):
+    '''
+    get CRF settings from the 'crf' section of the test config of an experiment, or None if CRF is not enabled
+    '''
+    settings = dict(default_crf_settings)
+    settings.update(cfg['test'].get('crf', None) or {})
+
+    if not settings['enabled']:
+        return None
+
+    if dcrf is None:
+        raise ImportError('pydensecrf is required to run CRF: pip install pydensecrf')
+    return settings
+
+def get_boundary_band(mask, band_width):
+    '''
+    input:
+      mask: numpy array of shape (height, width) with 0's and 1's
+    output:
+      band: boolean numpy array of shape (height, width), True within band_width pixels of the mask boundary
+    '''
+    mask = mask.astype(np.uint8)
+    kernel = np.ones((2 * band_width + 1, 2 * band_width + 1), np.uint8)
+    return cv2.dilate(mask, kernel) != cv2.erode(mask, kernel)
+
+def get_band_windows(band, window_size):
+    '''
+    output:
+      windows: a list of (y_start, y_end, x_start, x_end) of windows in a grid of window_size that contain band pixels
+    '''
+    height, width = band.shape
+    windows = []
+    for y_start in range(0, height, window_size):
+        for x_start in range(0, width, window_size):
+            y_end, x_end = min(y_start + window_size, height), min(x_start + window_size, width)
+            if band[y_start:y_end, x_start:x_end].any():
+                windows.append((y_start, y_end, x_start, x_end))
+    return windows
+
+def crf_band(img, prob, settings, threshold=0.5):
+    '''
+    run CRF only in windows around the predicted boundary, so that its cost is proportional to the boundary length
+
+    input:
+      img: numpy array of shape (3, height, width)
+      prob: numpy array of shape (height, width)
+      threshold: mask threshold from run_threshold_sweep.py, which places the boundary
+    output:
+      mask: numpy array of shape (height, width) with 0's and 1's, the same as (prob > threshold) outside of the band
+    '''
+    mask = submit.get_mask(submit.get_prob_bins(prob), submit.get_threshold_bin(threshold))
+    band = get_boundary_band(mask, settings['band_width'])
+
+    _, height, width = img.shape
+    margin = settings['window_margin']
+    for y_start, y_end, x_start, x_end in get_band_windows(band, settings['window_size']):
+        # crop with some context
+        crop_y_start, crop_y_end = max(y_start - margin, 0), min(y_end + margin, height)
+        crop_x_start, crop_x_end = max(x_start - margin, 0), min(x_end + margin, width)
+
+        crop_img = np.ascontiguousarray(img[:, crop_y_start:crop_y_end, crop_x_start:crop_x_end])
+        crop_prob = prob[np.newaxis, crop_y_start:crop_y_end, crop_x_start:crop_x_end]
+        crop_mask = crf(crop_img, crop_prob, num_iter=settings['num_iter'])[0]
+
+        # only pixels of the band in the window body are changed
+        body = (slice(y_start - crop_y_start, y_end - crop_y_start), slice(x_start - crop_x_start, x_end - crop_x_start))
+        window_band = band[y_start:y_end, x_start:x_end]
+        mask[y_start:y_end, x_start:x_end][window_band] = crop_mask[body][window_band]
+
+    return mask
+
+def run_crf(images, probs, settings, threshold=0.5):
+    '''
+    input:
+      images: a Variable of size (batch_size, 3, height, width)
+      probs: a Variable of size (batch_size, 1, height, width), sigmoid outputs of the network
+      threshold: mask threshold outside of the CRF band
+    output:
+      masks: a Variable of size (batch_size, 1, height, width), on GPU if available
+    '''
+    images = images.data.cpu().numpy()
+    probs = probs.data.cpu().numpy()
+
+    crf_masks = np.zeros(probs.shape)  # shape: (batch_size, 1, height, width)
+    for img_idx in range(len(images)):
+        crf_masks[img_idx, 0] = crf_band(images[img_idx].astype(np.uint8), probs[img_idx, 0], settings, threshold)
+
+    # convert CRF results back into a tensor in GPU, no gradients are needed
+    masks = torch.from_numpy(crf_masks).float()
+    if torch.cuda.is_available():
+        masks = masks.cuda()
     return masks
 
-def crf(img, prob):
+def crf_test_img_to_rle(img_name, img_prob, settings, threshold):
+    '''
+    run in pool processes: load a test image, run CRF on the band of its probability map, and encode the mask
+    '''
+    img = np.moveaxis(load.load_image_file(const.TEST_DIR, img_name, 'jpg', 0), 2, 0)
+    img_mask = crf_band(img, img_prob, settings, threshold)
+    return img_name, run_length.encode(img_mask)
+
+class CRFPool(object):
+    '''
+    run CRF on whole test images in a process pool, while the network keeps predicting on the next images
+    '''
+    def __init__(self, settings, infer_cache=None):
+        self.settings = settings
+        self.infer_cache = infer_cache  # masks are also saved into it when given
+        self.collected = []  # names of images whose masks were added to img_rles since pop_collected()
+        self.pool = multiprocessing.Pool(settings['num_processes'])
+        self.pending = []
+
+    def submit(self, img_name, img_prob, img_rles, threshold=0.5):
+        '''
+        the run-length-encoded mask of img_name is added to img_rles when its CRF is done
+
+        input:
+          threshold: mask threshold from run_threshold_sweep.py
+        '''
+        # limit the number of probability maps waiting in memory
+        while len(self.pending) >= 2 * self.settings['num_processes']:
+            self.collect(self.pending.pop(0), img_rles)
+
+        result = self.pool.apply_async(crf_test_img_to_rle, (img_name, img_prob.astype(np.float32), self.settings, threshold))
+        self.pending.append(result)
+        return
+
+    def collect(self, result, img_rles):
+        img_name, rle = result.get()  # errors in pool processes are raised here
+        img_rles[img_name] = rle
+        if self.infer_cache is not None:
+            self.infer_cache.put_rle(img_name, rle)
+        self.collected.append(img_name)
+        return
+
+    def pop_collected(self):
+        collected = self.collected
+        self.collected = []
+        return collected
+
+    def wait(self, img_rles):
+        while self.pending:
+            self.collect(self.pending.pop(0), img_rles)
+        return
+
+    def close(self):
+        self.pool.close()
+        self.pool.join()
+        return
+
+def crf(img, prob, num_iter=5):
     '''
     input:
       img: numpy array of shape (num of channels, height, width)
@@ -35,10 +192,8 @@ def crf(img, prob):
     '''
     func_start = time.time()
 
-    img = np.swapaxes(img, 0, 2)
+    img = np.ascontiguousarray(np.swapaxes(img, 0, 2))
     # img.shape: (width, height, num of channels)
-    
-    num_iter = 5
 
     prob = np.swapaxes(prob, 1, 2)  # shape: (1, width, height)
 
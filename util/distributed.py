@@ -0,0 +1,135 @@
+'''
+Multi-process data-parallel training with torch.distributed
+
+Local CPU training:  python train.py <exp_name> --world_size <num_processes>
+Multiple nodes:      torchrun --nnodes <n> --nproc_per_node <k> ... train.py <exp_name>
+'''
+
+import os
+import math
+import random
+import contextlib
+
+import torch
+import torch.distributed as dist
+import torch.utils.data
+from torch.nn.parallel import DistributedDataParallel
+
+import util.tile as tile
+
+
+def init_process_group(rank, world_size, backend='gloo'):
+    os.environ.setdefault('MASTER_ADDR', '127.0.0.1')
+    os.environ.setdefault('MASTER_PORT', '29500')
+
+    dist.init_process_group(backend, init_method='env://', rank=rank, world_size=world_size)
+    return
+
+def is_distributed():
+    return dist.is_available() and dist.is_initialized()
+
+def get_rank():
+    return dist.get_rank() if is_distributed() else 0
+
+def get_world_size():
+    return dist.get_world_size() if is_distributed() else 1
+
+def is_main_process():
+    '''
+    only the main process logs, validates and saves checkpoints
+    '''
+    return get_rank() == 0
+
+def barrier():
+    if is_distributed():
+        dist.barrier()
+    return
+
+def wrap_model(net, local_rank):
+    '''
+    wrap net with DistributedDataParallel, on GPU <local_rank> if available or on CPU otherwise
+    '''
+    if torch.cuda.is_available():
+        torch.cuda.set_device(local_rank)
+        net.cuda()
+        return DistributedDataParallel(net, device_ids=[local_rank], output_device=local_rank)
+
+    return DistributedDataParallel(net)
+
+def grad_sync(net, enabled):
+    '''
+    a context manager to skip gradient all-reduce on iterations that only accumulate gradients
+    '''
+    if not enabled and isinstance(net, DistributedDataParallel):
+        return net.no_sync()
+    return contextlib.ExitStack()  # does nothing
+
+def unwrap_model(net):
+    return net.module if isinstance(net, DistributedDataParallel) else net
+
+def set_num_threads_per_process(world_size):
+    '''
+    split CPU cores evenly among local processes to avoid oversubscription
+    '''
+    num_cores = os.cpu_count() or 1
+    torch.set_num_threads(max(1, num_cores // world_size))
+    return
+
+
+def get_car_id(tile_name):
+    return tile.get_img_name(tile_name).split('_')[0]
+
+class CarDistributedSampler(torch.utils.data.sampler.Sampler):
+    '''
+    shard tiles among processes by car id, so all views of a car stay on one rank
+
+    Cars are shuffled every epoch with the same seed on all ranks. Each rank gets the same number of samples,
+    which DistributedDataParallel requires, by repeating some of its own samples up to the size of the largest shard.
+    No sample is dropped.
+    '''
+    def __init__(self, tile_names, num_replicas=None, rank=None, shuffle=True, seed=0):
+        self.num_replicas = num_replicas if num_replicas is not None else get_world_size()
+        self.rank = rank if rank is not None else get_rank()
+        self.shuffle = shuffle
+        self.seed = seed
+        self.epoch = 0
+
+        # group sample indices by car id
+        self.indices_by_car = {}
+        for idx, tile_name in enumerate(tile_names):
+            self.indices_by_car.setdefault(get_car_id(tile_name), []).append(idx)
+        self.car_ids = sorted(self.indices_by_car.keys())
+
+        # the largest shard any shuffle can give a rank: the most cars a rank gets, taking the ones with most tiles,
+        # the same for every epoch since all cars usually have the same number of tiles
+        max_cars_per_rank = int(math.ceil(len(self.car_ids) / self.num_replicas))
+        car_sizes = sorted((len(indices) for indices in self.indices_by_car.values()), reverse=True)
+        self.num_samples = sum(car_sizes[:max_cars_per_rank])
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+        return
+
+    def __iter__(self):
+        rng = random.Random(self.seed + self.epoch)
+
+        car_ids = list(self.car_ids)
+        if self.shuffle:
+            rng.shuffle(car_ids)
+
+        indices = []
+        for car_id in car_ids[self.rank::self.num_replicas]:
+            indices += self.indices_by_car[car_id]
+
+        if self.shuffle:
+            rng.shuffle(indices)
+
+        # pad so every rank runs the same number of iterations
+        if indices:
+            while len(indices) < self.num_samples:
+                indices += indices[:self.num_samples - len(indices)]
+
+        return iter(indices)
+
+    def __len__(self):
+        return self.num_samples
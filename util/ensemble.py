@@ -66,19 +66,63 @@ def mark_model_ensembled(ensemble_dir, exp_name, test_time_aug_name):
 
     return
 
-def get_ensemble_weights(ensemble_dirs):
+DEFAULT_WEIGHTS_PATH = os.path.join(const.OUTPUT_DIR, 'ensemble_weights.csv')
+
+def save_ensemble_weights(weights_path, exp_names, test_time_aug_names, weights):
+    '''
+    save weights fitted by run_fit_ensemble_weights.py, one line of exp_name,test_time_aug_name,weight per model
+    '''
+    with open(weights_path, 'w', newline='') as f:
+        writer = csv.writer(f)
+        for exp_name, test_time_aug_name, weight in zip(exp_names, test_time_aug_names, weights):
+            writer.writerow([exp_name, test_time_aug_name, weight])
+    return
+
+def load_ensemble_weights(weights_path):
+    '''
+    output:
+      model_weights: a dict of floats, with (exp_name, test_time_aug_name) as keys
+    '''
+    model_weights = {}
+    with open(weights_path, newline='') as f:
+        reader = csv.reader(f)
+        for row in reader:
+            model_weights[(row[0], row[1])] = float(row[2])
+    return model_weights
+
+def get_ensemble_weights(ensemble_dirs, weights_path=None):
     '''
     return ensembling weightes by reading ./output/<ensemble_dir>/models_ensembled.txt
+
+    Every model in an ensemble_dir counts as 1, or as its weight in weights_path when it is given.
     '''
+    model_weights = load_ensemble_weights(weights_path) if weights_path is not None else None
+
     total_models = 0
     weights = np.zeros(len(ensemble_dirs))
 
     for i, ensemble_dir in enumerate(ensemble_dirs):
-        ensembled_model_names, _ = get_models_ensembled(ensemble_dir)
-        num_models_used = len(ensembled_model_names)
+        num_models_used = get_ensemble_dir_weight(ensemble_dir, model_weights)
 
         total_models += num_models_used
         weights[i] = num_models_used
 
     weights = np.divide(weights, total_models)
     return weights
+
+def get_ensemble_dir_weight(ensemble_dir, model_weights=None):
+    '''
+    input:
+      model_weights: a dict from load_ensemble_weights(), or None to count every model as 1
+    output:
+      weight: total weight of the models in ./output/<ensemble_dir>/models_ensembled.txt
+    '''
+    ensembled_model_names, test_time_aug_names = get_models_ensembled(ensemble_dir)
+
+    if model_weights is None:
+        return len(ensembled_model_names)
+
+    models = list(zip(ensembled_model_names, test_time_aug_names))
+    missing = [ model for model in models if model not in model_weights ]
+    assert len(missing) == 0, 'No weights of {}'.format(missing)
+    return sum(model_weights[model] for model in models)
@@ -0,0 +1,157 @@
+'''
+Ensemble weights fitted on validation probability maps
+
+Every validation image is compacted into its distinct rows of (label, probability bin of model 1, ..., of model n)
+with pixel counts. Almost all pixels are far from the boundary, where every model predicts 0% or 100%,
+so an image has a few thousand rows instead of 1280 * 1918 pixels.
+
+For any weights, the ensembled probability bin of each row is submit.floor_ensembled_bins() of the sum of weighted bins,
+the same as EnsembleRunner and FinalizeRunner, and the dice of every threshold follows from the histograms of util/threshold.py.
+Weights are then fitted by coordinate search, one model at a time.
+'''
+
+import os
+import multiprocessing
+
+import numpy as np
+
+import util.const as const
+import util.load as load
+import util.submit as submit
+import util.threshold as threshold
+
+
+NUM_BINS = threshold.NUM_BINS
+
+def get_unique_rows(rows):
+    '''
+    input:
+      rows: numpy array of shape (num_pixels, num_cols) with values from 0 to NUM_BINS - 1
+    output:
+      unique_rows: uint8 numpy array of shape (num_unique_rows, num_cols)
+      counts: numpy array of shape (num_unique_rows,)
+    '''
+    num_cols = rows.shape[1]
+
+    if NUM_BINS ** num_cols < 2 ** 63:
+        # sorting one int64 key per pixel is much faster than sorting rows
+        bases = NUM_BINS ** np.arange(num_cols, dtype=np.int64)
+        keys, counts = np.unique(np.dot(rows.astype(np.int64), bases), return_counts=True)
+        unique_rows = (keys[:, np.newaxis] // bases) % NUM_BINS
+    else:
+        unique_rows, counts = np.unique(rows, axis=0, return_counts=True)
+
+    return unique_rows.astype(np.uint8), counts
+
+def get_img_rows(args):
+    '''
+    output:
+      rows: uint8 numpy array of shape (num_rows, 1 + num_models), label followed by the probability bin of each model
+      counts: numpy array of shape (num_rows,)
+    '''
+    probs_dirs, img_name = args
+
+    target = load.load_image_file(const.TRAIN_MASK_DIR, img_name + '_mask', 'gif', 0)
+    cols = [ (target > 0).ravel() ]
+    for probs_dir in probs_dirs:
+        img_prob = np.load(os.path.join(probs_dir, img_name + '.npy'))
+        cols.append(np.clip(img_prob, 0, NUM_BINS - 1).ravel())
+
+    return get_unique_rows(np.stack(cols, axis=1).astype(np.uint8))
+
+def build_tables(val_probs_dirs, img_names, num_processes=8):
+    '''
+    compact the validation probability maps of every model in val_probs_dirs, in parallel over images
+
+    output:
+      tables: a dict of
+        'bins': float32 numpy array of shape (num_rows, num_models)
+        'labels', 'counts', 'img_idxs': numpy arrays of shape (num_rows,)
+        'num_imgs': number of images
+    '''
+    probs_dirs = [ os.path.join(const.OUTPUT_DIR, val_probs_dir, const.PROBS_DIR_NAME) for val_probs_dir in val_probs_dirs ]
+
+    pool = multiprocessing.Pool(num_processes)
+    try:
+        img_rows = pool.map(get_img_rows, [ (probs_dirs, img_name) for img_name in img_names ], chunksize=8)
+    finally:
+        pool.close()
+        pool.join()
+
+    rows = np.concatenate([ rows for rows, _ in img_rows ])
+    return {
+        'bins': rows[:, 1:].astype(np.float32),
+        'labels': rows[:, 0].astype(np.int64),
+        'counts': np.concatenate([ counts for _, counts in img_rows ]),
+        'img_idxs': np.concatenate([ np.full(len(counts), i, dtype=np.int64) for i, (_, counts) in enumerate(img_rows) ]),
+        'num_imgs': len(img_names),
+    }
+
+def get_histograms(tables, weights):
+    '''
+    output:
+      histograms: numpy array of shape (num_imgs, 2, NUM_BINS) of probability maps ensembled with weights
+    '''
+    ensembled = submit.floor_ensembled_bins(np.dot(tables['bins'], np.asarray(weights, dtype=np.float32))).astype(np.int64)
+
+    idxs = (tables['img_idxs'] * 2 + tables['labels']) * NUM_BINS + ensembled
+    histograms = np.bincount(idxs, weights=tables['counts'], minlength=tables['num_imgs'] * 2 * NUM_BINS)
+    return histograms.reshape(tables['num_imgs'], 2, NUM_BINS)
+
+def evaluate(tables, weights):
+    '''
+    output:
+      mean_dice: mean dice over images at the best threshold
+      best_threshold: the threshold of mean_dice
+    '''
+    thresholds, mean_dices = threshold.sweep_thresholds(get_histograms(tables, weights))
+    best_idx = np.argmax(mean_dices)
+    return mean_dices[best_idx], thresholds[best_idx]
+
+def set_weight(weights, model_idx, weight):
+    '''
+    set the weight of one model and scale the others, so that weights still sum up to 1
+    '''
+    others = np.delete(weights, model_idx)
+    if others.sum() > 0:
+        others = others * (1 - weight) / others.sum()
+    else:
+        others = np.full(len(others), (1 - weight) / len(others))
+
+    return np.insert(others, model_idx, weight)
+
+def fit_weights(tables, num_steps=21, max_rounds=10, verbose=True):
+    '''
+    coordinate search: try num_steps weights from 0 to 1 for one model at a time, keep the best, until nothing improves
+
+    output:
+      weights: numpy array of shape (num_models,), summing up to 1
+      mean_dice, best_threshold: from evaluate()
+    '''
+    num_models = tables['bins'].shape[1]
+    weights = np.full(num_models, 1. / num_models)
+    best_dice, best_threshold = evaluate(tables, weights)
+    if verbose:
+        print('Equal weights: dice {:.5f}, threshold {:.2f}'.format(best_dice, best_threshold))
+
+    if num_models == 1:
+        return weights, best_dice, best_threshold
+
+    for round_idx in range(max_rounds):
+        improved = False
+
+        for model_idx in range(num_models):
+            for weight in np.linspace(0, 1, num_steps):
+                candidate = set_weight(weights, model_idx, weight)
+                mean_dice, candidate_threshold = evaluate(tables, candidate)
+
+                if mean_dice > best_dice + 1e-7:
+                    weights, best_dice, best_threshold = candidate, mean_dice, candidate_threshold
+                    improved = True
+
+        if verbose:
+            print('Round {}: dice {:.5f}, threshold {:.2f}, weights {}'.format(round_idx + 1, best_dice, best_threshold, np.round(weights, 3)))
+        if not improved:
+            break
+
+    return weights, best_dice, best_threshold
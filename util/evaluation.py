@@ -15,6 +15,16 @@ def dice_loss(m1, m2 ):
 
     ref: https://github.com/pytorch/pytorch/issues/1249
     '''
+    score = dice_score(m1, m2)
+    return score.item()
+
+def dice_score(m1, m2):
+    '''
+    same as dice_loss() but returns a Variable without copying it back to host,
+    which avoids waiting for the GPU to finish
+    output:
+      score: a 0-dim Variable of FloatTensor
+    '''
     m1 = m1.contiguous()
     m2 = m2.contiguous()
 
@@ -24,5 +34,5 @@ def dice_loss(m1, m2 ):
     intersection = (m1 * m2)
 
     score = 2. * (intersection.sum(1)+1) / (m1.sum(1) + m2.sum(1)+1)
-    score = score.sum()/num  # a Variable of FloatTensor of size 1
-    return score.data[0]
+    score = score.sum()/num  # a 0-dim Variable of FloatTensor
+    return score
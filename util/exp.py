@@ -1,13 +1,17 @@
 import torch
 
 import os
+import csv
+import atexit
 from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
 
 import util.const as const
 
 import config
 import model.unet as unet
 import model.loss as loss
+import model.fuse as fuse
 
 
 def create_dir_if_not_exist(dir):
@@ -64,39 +68,170 @@ def get_criterion(exp_name):
     return criterion
 
 
-def save_checkpoint(exp_name, epoch, model_state_dict, optimizer_state_dict):
+def copy_to_cpu(obj):
     '''
-    save the trained model as checkpoint
+    recursively copy tensors in obj to CPU memory, so that training can go on while obj is being saved
+    '''
+    if torch.is_tensor(obj):
+        return obj.cpu().clone()
+    if isinstance(obj, dict):
+        return type(obj)((key, copy_to_cpu(value)) for key, value in obj.items())
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(copy_to_cpu(value) for value in obj)
+    return obj
+
+# checkpoints are written one at a time by a background thread
+ckpt_writer = ThreadPoolExecutor(max_workers=1)
+pending_ckpt_writes = []
+
+def wait_for_checkpoints():
+    '''
+    block until all checkpoints are written, and raise any error that happened while writing
+    '''
+    while pending_ckpt_writes:
+        future = pending_ckpt_writes.pop(0)
+        future.result()
+    return
+
+atexit.register(wait_for_checkpoints)
+
+def write_checkpoint(state, save_path):
+    '''
+    write into a temporary file first and then rename it, so a crash never leaves a partial checkpoint behind
+    '''
+    tmp_path = save_path + '.tmp'
+    torch.save(state, tmp_path)
+    os.replace(tmp_path, save_path)
+    return
+
+def save_checkpoint(exp_name, epoch, model_state_dict, optimizer_state_dict, score=None, phase=None):
+    '''
+    save the trained model as checkpoint in background
+
+    input:
+      score: validation accuracy of this epoch, used to decide which checkpoint is the best one to keep
+      phase: the phase of progressive-resolution training this epoch belongs to, see util/schedule.py
     '''
 
     state = {
         'exp_name': exp_name,
         'epoch': epoch,
-        'state_dict': model_state_dict,
-        'optimizer' : optimizer_state_dict,
+        'state_dict': copy_to_cpu(model_state_dict),
+        'optimizer' : copy_to_cpu(optimizer_state_dict),
     }
+    if phase is not None:
+        state['phase'] = phase['index']
+        state['resolution_scale'] = phase['scale']
 
     filename = str(epoch) + '.pth.tar'
-    save_path = os.path.join(const.OUTPUT_DIR, exp_name, filename)
+    save_dir = os.path.join(const.OUTPUT_DIR, exp_name)
+    save_path = os.path.join(save_dir, filename)
+
+    # surface errors of previous writes
+    while pending_ckpt_writes and pending_ckpt_writes[0].done():
+        pending_ckpt_writes.pop(0).result()
+
+    if score is not None:
+        save_ckpt_score(save_dir, epoch, score)
+
+    cfg = config.load_config_file(exp_name)
+    keep_last = cfg.get('keep_last_ckpts', None)  # keep all checkpoints if not set
+    keep_best = cfg.get('keep_best_ckpt', True)
+
+    def write_and_clean_up():
+        write_checkpoint(state, save_path)
+        remove_old_ckpts(save_dir, keep_last, keep_best)
+
+    pending_ckpt_writes.append(ckpt_writer.submit(write_and_clean_up))
+    return
+
+def get_ckpt_scores_path(save_dir):
+    return os.path.join(save_dir, 'ckpt_scores.csv')
+
+def save_ckpt_score(save_dir, epoch, score):
+    '''
+    add validation accuracy of a checkpoint as a new line to ./output/<exp_name>/ckpt_scores.csv
+    '''
+    with open(get_ckpt_scores_path(save_dir), 'a', newline='') as f:
+        f.write('{},{}\n'.format(epoch, score))
+    return
+
+def load_ckpt_scores(save_dir):
+    '''
+    output:
+      scores: a dict with epochs as keys and validation accuracies as values
+    '''
+    scores = {}
+
+    scores_path = get_ckpt_scores_path(save_dir)
+    if not os.path.isfile(scores_path):
+        return scores
+
+    with open(scores_path, newline='') as f:
+        reader = csv.reader(f)
+        for row in reader:
+            scores[int(row[0])] = float(row[1])
+
+    return scores
+
+def list_ckpt_epochs(save_dir):
+    '''
+    get epochs of all complete checkpoints in save_dir
+    '''
+    ckpt_epochs = []
+    for ckpt in os.listdir(save_dir):
+        # skip temporary files of checkpoints being written, and anything else
+        if not ckpt.endswith('.pth.tar'):
+            continue
+
+        ckpt_name = ckpt.split('.')[0]
+        if not ckpt_name.isdigit():
+            continue
+
+        # skip empty files left behind by crashes
+        if os.path.getsize(os.path.join(save_dir, ckpt)) == 0:
+            continue
+
+        ckpt_epochs.append(int(ckpt_name))
+
+    ckpt_epochs.sort()
+    return ckpt_epochs
+
+def remove_old_ckpts(save_dir, keep_last, keep_best):
+    '''
+    remove all but the last <keep_last> checkpoints and the one with the best validation accuracy
+    '''
+    if keep_last is None:
+        return
+
+    ckpt_epochs = list_ckpt_epochs(save_dir)
+    epochs_to_keep = set(ckpt_epochs[-keep_last:]) if keep_last > 0 else set()
+
+    if keep_best:
+        scores = load_ckpt_scores(save_dir)
+        scored_epochs = [ epoch for epoch in ckpt_epochs if epoch in scores ]
+        if scored_epochs:
+            best_epoch = max(scored_epochs, key=lambda epoch: scores[epoch])
+            epochs_to_keep.add(best_epoch)
+
+    for epoch in ckpt_epochs:
+        if epoch not in epochs_to_keep:
+            os.remove(os.path.join(save_dir, str(epoch) + '.pth.tar'))
 
-    torch.save(state, save_path)
     return
 
 def get_latest_ckpt(save_dir):
     '''
     find the .pth ckeckpoint file with latest epoch
     '''
-    ckpts = os.listdir(save_dir)
-    ckpt_names = [ckpt.split('.')[0] for ckpt in ckpts if ckpt.endswith('.pth.tar')]
+    ckpt_epochs = list_ckpt_epochs(save_dir)
 
-    if not ckpt_names:
+    if not ckpt_epochs:
         print("No checkpoints found. It's a new experiment. ")
         return None
 
     print("All checkpoints:")
-    print(ckpt_names)
-
-    ckpt_epochs = [ int(ckpt_name) for ckpt_name in ckpt_names]
+    print(ckpt_epochs)
 
     latest_epoch = max(ckpt_epochs)
     latest_path = os.path.join(save_dir,  str(latest_epoch) + '.pth.tar')
@@ -108,8 +243,7 @@ def load_exp(exp_name):
     '''
     save_dir = os.path.join(const.OUTPUT_DIR, exp_name)
 
-    if not os.path.isdir(save_dir):
-        os.makedirs(save_dir)
+    os.makedirs(save_dir, exist_ok=True)  # may be called by several training processes at once
 
     ckpt_path = get_latest_ckpt(save_dir)
     model, optimizer, criterion, saved_epoch = load_checkpoint(exp_name, ckpt_path)
@@ -123,7 +257,11 @@ def load_checkpoint(exp_name, ckpt_path):
     '''
     if ckpt_path is not None and os.path.isfile(ckpt_path):
         print("=> loading checkpoint '{}'".format(ckpt_path))
-        checkpoint = torch.load(ckpt_path)
+        if torch.cuda.is_available():
+            checkpoint = torch.load(ckpt_path)
+        else:
+            # allow checkpoints saved on GPU to be loaded on CPU-only machines
+            checkpoint = torch.load(ckpt_path, map_location=lambda storage, loc: storage)
 
         assert exp_name == checkpoint['exp_name']
 
@@ -137,6 +275,10 @@ def load_checkpoint(exp_name, ckpt_path):
 
         print("=> loaded checkpoint '{}' (epoch {})"
               .format(ckpt_path, saved_epoch))
+        if 'phase' in checkpoint:
+            # training resumes in the phase of the next epoch, which train.py derives from the schedule
+            print("=> checkpoint was trained in phase {} at resolution scale {}"
+                  .format(checkpoint['phase'], checkpoint['resolution_scale']))
 
     else:
         model = get_network(exp_name)
@@ -147,6 +289,99 @@ def load_checkpoint(exp_name, ckpt_path):
 
     return model, optimizer, criterion, saved_epoch
 
+def get_frozen_path(exp_name):
+    '''
+    path of the inference-only model generated by freeze_exp()
+    '''
+    return os.path.join(const.OUTPUT_DIR, exp_name, 'frozen.pth')
+
+def freeze_exp(exp_name, output_logits=True):
+    '''
+    load the latest checkpoint, fold BatchNorm into conv and save it as a separate inference-only model
+    '''
+    net, _, _, start_epoch = load_exp(exp_name)
+    frozen = fuse.freeze_network(net, output_logits=output_logits)
+
+    state = {
+        'exp_name': exp_name,
+        'epoch': start_epoch - 1,
+        'output_logits': output_logits,
+        'model': frozen,
+    }
+
+    save_path = get_frozen_path(exp_name)
+    torch.save(state, save_path)
+    print("=> saved frozen model '{}' (epoch {})".format(save_path, start_epoch - 1))
+
+    return net, frozen
+
+def load_frozen_exp(exp_name):
+    '''
+    load the inference-only model previously saved by freeze_exp()
+    '''
+    frozen_path = get_frozen_path(exp_name)
+
+    print("=> loading frozen model '{}'".format(frozen_path))
+    # the whole module is pickled, which torch.load refuses by default since torch 2.6
+    checkpoint = torch.load(frozen_path, weights_only=False)
+
+    assert exp_name == checkpoint['exp_name']
+
+    model = checkpoint['model']
+    saved_epoch = checkpoint['epoch']
+    criterion = get_criterion(exp_name)
+
+    print("=> loaded frozen model '{}' (epoch {})".format(frozen_path, saved_epoch))
+
+    return model, criterion, saved_epoch
+
+def get_quantized_path(exp_name):
+    '''
+    path of the int8 model generated by run_quantize.py
+    '''
+    return os.path.join(const.OUTPUT_DIR, exp_name, 'quantized.pth')
+
+def save_quantized_exp(exp_name, epoch, quantized):
+    '''
+    save an int8 model generated by model.quantize.quantize_network()
+    '''
+    state = {
+        'exp_name': exp_name,
+        'epoch': epoch,
+        'model': quantized,
+    }
+
+    save_path = get_quantized_path(exp_name)
+    torch.save(state, save_path)
+    print("=> saved quantized model '{}' (epoch {})".format(save_path, epoch))
+    return
+
+def load_quantized_exp(exp_name):
+    '''
+    load the int8 model previously saved by save_quantized_exp()
+    '''
+    quantized_path = get_quantized_path(exp_name)
+
+    print("=> loading quantized model '{}'".format(quantized_path))
+    # the whole module is pickled, like frozen models
+    checkpoint = torch.load(quantized_path, weights_only=False)
+
+    assert exp_name == checkpoint['exp_name']
+
+    model = checkpoint['model']
+    saved_epoch = checkpoint['epoch']
+    criterion = get_criterion(exp_name)
+
+    print("=> loaded quantized model '{}' (epoch {})".format(quantized_path, saved_epoch))
+
+    return model, criterion, saved_epoch
+
+def get_onnx_path(exp_name):
+    '''
+    path of the ONNX model generated by run_export_onnx.py
+    '''
+    return os.path.join(const.OUTPUT_DIR, exp_name, 'model.onnx')
+
 
 def setup_crayon(use_tensorboard, CrayonClient,exp_name):
     '''
@@ -5,16 +5,18 @@ from skimage import io,transform
 import csv
 import cv2
 
-def rgb_shift(img):
+def rgb_shift(img, rng=None):
     '''
     input:
       image: numpy array of shape (height, width, channels)
+      rng: a numpy random Generator, or None to use np.random
     output:
       img_pca: numpy array of shape (height, width, channels) with shift in RGB
     '''
     
     # assigned a small sigma for avoiding RGB value exceed the range[0,255]
     # and used saved data of eigenvectors and eigenvaluse of trainning data 
+    rng = rng if rng is not None else np.random
     mu = 0
     sigma = 0.003
     evals = np.array([  7.88291483e+00,   3.93729159e+01,   1.04797824e+04])
@@ -26,14 +28,14 @@ def rgb_shift(img):
 
     # 3 x 1 scaled eigenvalue matrix
     se = np.zeros((3,1))
-    se[0][0] = np.random.normal(mu, sigma)*evals[0]
-    se[1][0] = np.random.normal(mu, sigma)*evals[1]
-    se[2][0] = np.random.normal(mu, sigma)*evals[2]
+    se[0][0] = rng.normal(mu, sigma)*evals[0]
+    se[1][0] = rng.normal(mu, sigma)*evals[1]
+    se[2][0] = rng.normal(mu, sigma)*evals[2]
     se = np.matrix(se)
     val = feature_vec*se
     # print(se, evals, val)
 
-    img_pca=np.zeros((1280,1918,3))
+    img_pca=np.zeros(img.shape)
     for k in range(img.shape[2]):
         img_pca[:,:,k]=np.matrix.__add__(img[:,:,k], val[k])
         img_pca[img_pca[:,:,k]>255]=255
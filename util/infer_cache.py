@@ -0,0 +1,236 @@
+'''
+Content-addressed cache of test predictions
+
+Predictions of an image only depend on the model weights, the Test Time Augmentation, the tile config and, for
+run-length-encoded masks, the threshold and CRF settings. A hash of all of them names a directory in
+./output/cache/inference/, which holds one file per image:
+  <img_name>.npy: int8 probability map in %, the same file as submit.save_prob_map() saves, when ensembling
+  <img_name>.rle: run-length-encoded mask, when generating submission.csv directly
+
+Reruns of test.py with the same settings, after crashes or for new ensembles, only predict images missing from it.
+Probability maps are hard-linked between the cache and ./output/<ensemble_dir>/ when both are on the same file system,
+so that they take disk space only once. Files are touched when read, and the least recently used ones are removed
+as soon as the cache grows beyond max_gb.
+'''
+
+import os
+import json
+import shutil
+import hashlib
+
+import util.const as const
+import util.exp as exp
+
+
+INFER_CACHE_DIR = os.path.join(const.CACHE_DIR, 'inference')
+
+# used for keys missing from the 'infer_cache' section of the test config
+default_infer_cache_settings = {
+    'enabled': False,
+    'max_gb': 300,
+}
+
+def get_infer_cache_settings(cfg):
+    '''
+    get cache settings from the 'infer_cache' section of the test config of an experiment, or None if it's not enabled
+    '''
+    settings = dict(default_infer_cache_settings)
+    settings.update(cfg['test'].get('infer_cache', None) or {})
+
+    if not settings['enabled']:
+        return None
+    return settings
+
+def hash_file(file_path, chunk_size=2**20):
+    sha1 = hashlib.sha1()
+    with open(file_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            sha1.update(chunk)
+    return sha1.hexdigest()
+
+def get_model_path(exp_name, frozen=False, quantized=False, onnx=False):
+    '''
+    path of the model file test.py loads, or None for a new experiment without checkpoints
+    '''
+    if frozen:
+        return exp.get_frozen_path(exp_name)
+    if quantized:
+        return exp.get_quantized_path(exp_name)
+    if onnx:
+        return exp.get_onnx_path(exp_name)
+    return exp.get_latest_ckpt(os.path.join(const.OUTPUT_DIR, exp_name))
+
+def get_cache_key(model_hash, test_time_aug_name, paddings, tile_size, mask_settings=None):
+    '''
+    input:
+      mask_settings: a dict of everything else that changes masks, e.g. threshold and CRF settings,
+                     or None when probability maps are cached
+    output:
+      key: a dict, hashed into the name of the cache directory
+    '''
+    return {
+        'model': model_hash,
+        'test_time_aug': test_time_aug_name,
+        'paddings': list(paddings),
+        'tile_size': list(tile_size),
+        'masks': mask_settings,
+    }
+
+def list_cached_files(cache_root):
+    '''
+    output:
+      entries: a list of (last used time, size in bytes, path) of every cached file
+    '''
+    entries = []
+    for key_dir in os.scandir(cache_root):
+        if not key_dir.is_dir():
+            continue
+        for entry in os.scandir(key_dir.path):
+            if entry.name.endswith('.npy') or entry.name.endswith('.rle'):
+                stat = entry.stat()
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+    return entries
+
+def link_or_copy(src_path, dst_path):
+    '''
+    hard-link src_path to dst_path, or copy it when they are on different file systems
+    '''
+    if os.path.isfile(dst_path) and os.path.samefile(src_path, dst_path):
+        return
+
+    # link to a temporary file first, so that dst_path is either complete or missing
+    tmp_path = dst_path + '.tmp'
+    if os.path.isfile(tmp_path):
+        os.remove(tmp_path)
+    try:
+        os.link(src_path, tmp_path)
+    except OSError:
+        shutil.copyfile(src_path, tmp_path)
+    os.replace(tmp_path, dst_path)
+    return
+
+def evict(max_bytes, cache_root=INFER_CACHE_DIR):
+    '''
+    remove the least recently used files until the cache takes at most max_bytes
+
+    output:
+      total_bytes: size of the cache afterwards
+    '''
+    if not os.path.isdir(cache_root):
+        return 0
+
+    entries = sorted(list_cached_files(cache_root))
+    total_bytes = sum(size for _, size, _ in entries)
+
+    num_removed = 0
+    for _, size, path in entries:
+        if total_bytes <= max_bytes:
+            break
+        os.remove(path)
+        total_bytes -= size
+        num_removed += 1
+
+    if num_removed > 0:
+        print('Removed {} least recently used files from {}'.format(num_removed, cache_root))
+    return total_bytes
+
+
+class InferenceCache(object):
+    def __init__(self, key, settings, cache_root=INFER_CACHE_DIR):
+        '''
+        input:
+          key: a dict from get_cache_key()
+          settings: settings from get_infer_cache_settings()
+        '''
+        self.key = key
+        self.max_bytes = settings['max_gb'] * 2**30
+        self.cache_root = cache_root
+        self.total_bytes = None  # size of the whole cache, counted on the first put
+
+        key_json = json.dumps(key, sort_keys=True)
+        self.cache_dir = os.path.join(cache_root, hashlib.sha1(key_json.encode('utf-8')).hexdigest())
+        exp.create_dir_if_not_exist(self.cache_dir)
+
+        # human readable key, for debugging only
+        with open(os.path.join(self.cache_dir, 'key.json'), 'w') as f:
+            f.write(key_json)
+        return
+
+    def get_path(self, img_name, ext):
+        return os.path.join(self.cache_dir, img_name + ext)
+
+    def list_img_names(self, ext):
+        return [ file_name[:-len(ext)] for file_name in os.listdir(self.cache_dir) if file_name.endswith(ext) ]
+
+    def touch(self, path):
+        # mark as recently used for evict()
+        os.utime(path, None)
+        return
+
+    def add_bytes(self, num_bytes):
+        '''
+        count a file put into the cache, and evict as soon as the cache grows beyond max_bytes
+        '''
+        if self.total_bytes is None:
+            # the file just put is counted by the scan
+            self.total_bytes = sum(size for _, size, _ in list_cached_files(self.cache_root))
+        else:
+            self.total_bytes += num_bytes
+
+        if self.total_bytes > self.max_bytes:
+            # leave some room, so that the cache is not scanned again on the next put
+            self.total_bytes = evict(int(0.9 * self.max_bytes), self.cache_root)
+        return
+
+    def put_prob_map(self, img_name, prob_map_path):
+        '''
+        cache a probability map saved by submit.save_prob_map(), hard-linked to it when possible
+        '''
+        save_path = self.get_path(img_name, '.npy')
+        link_or_copy(prob_map_path, save_path)
+        self.add_bytes(os.path.getsize(save_path))
+        return
+
+    def load_prob_maps(self, ensemble_dir, img_names):
+        '''
+        copy cached probability maps of img_names into ./output/<ensemble_dir>/, as if they were just predicted
+
+        output:
+          cached_img_names: names of images whose probability maps were cached
+        '''
+        probs_dir = os.path.join(const.OUTPUT_DIR, ensemble_dir, const.PROBS_DIR_NAME)
+        exp.create_dir_if_not_exist(probs_dir)
+
+        cached_img_names = sorted(set(self.list_img_names('.npy')) & set(img_names))
+        for img_name in cached_img_names:
+            cached_path = self.get_path(img_name, '.npy')
+            link_or_copy(cached_path, os.path.join(probs_dir, img_name + '.npy'))
+            self.touch(cached_path)
+        return cached_img_names
+
+    def put_rle(self, img_name, rle):
+        save_path = self.get_path(img_name, '.rle')
+        with open(save_path + '.tmp', 'w') as f:
+            f.write(rle)
+        os.replace(save_path + '.tmp', save_path)
+        self.add_bytes(os.path.getsize(save_path))
+        return
+
+    def load_rles(self, img_rles, img_names):
+        '''
+        add cached run-length-encoded masks of img_names to img_rles
+
+        output:
+          cached_img_names: names of images whose masks were cached
+        '''
+        cached_img_names = sorted(set(self.list_img_names('.rle')) & set(img_names))
+        for img_name in cached_img_names:
+            cached_path = self.get_path(img_name, '.rle')
+            with open(cached_path) as f:
+                img_rles[img_name] = f.read()
+            self.touch(cached_path)
+        return cached_img_names
+
+    def evict(self):
+        self.total_bytes = evict(self.max_bytes, self.cache_root)
+        return
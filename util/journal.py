@@ -0,0 +1,122 @@
+'''
+Progress journal of test.py, so that an interrupted run resumes instead of starting from zero
+
+Every Test Time Augmentation of a run writes into its own run_dir, ./output/<ensemble_dir>/ when ensembling or
+./output/<exp_name>/ when generating submission.csv directly. Its journal.csv lists images whose predictions are
+saved, with their run-length-encoded masks in the latter case, and is appended to every few images.
+
+./output/<exp_name>/test_runs.csv records the run_dir and status of every Test Time Augmentation of the current run,
+with a run_key of the model and settings, so that a rerun with the same run_key continues in the same run_dirs.
+It is removed when all Test Time Augmentations are done.
+'''
+
+import os
+import csv
+
+import util.const as const
+import util.exp as exp
+
+
+RUNNING = 'running'
+DONE = 'done'
+
+def get_runs_path(exp_name):
+    return os.path.join(const.OUTPUT_DIR, exp_name, 'test_runs.csv')
+
+def load_runs(exp_name):
+    '''
+    output:
+      runs: a dict of (run_key, run_dir, status), with test time augmentation names as keys
+    '''
+    runs = {}
+    runs_path = get_runs_path(exp_name)
+    if os.path.isfile(runs_path):
+        with open(runs_path, newline='') as f:
+            for row in csv.reader(f):
+                runs[row[0]] = (row[1], row[2], row[3])
+    return runs
+
+def save_run(exp_name, test_time_aug_name, run_key, run_dir, status):
+    runs = load_runs(exp_name)
+    runs[test_time_aug_name] = (run_key, run_dir, status)
+
+    # write to a temporary file first, so that test_runs.csv is never partially written
+    runs_path = get_runs_path(exp_name)
+    with open(runs_path + '.tmp', 'w', newline='') as f:
+        writer = csv.writer(f)
+        for aug_name, (key, directory, run_status) in runs.items():
+            writer.writerow([aug_name, key, directory, run_status])
+    os.replace(runs_path + '.tmp', runs_path)
+    return
+
+def get_resumable_run(exp_name, test_time_aug_name, run_key):
+    '''
+    output:
+      run_dir, status: of the run of test_time_aug_name with the same run_key, or (None, None) if there isn't one
+    '''
+    run = load_runs(exp_name).get(test_time_aug_name, None)
+    if run is None or run[0] != run_key:
+        return None, None
+    return run[1], run[2]
+
+def clear_runs(exp_name):
+    runs_path = get_runs_path(exp_name)
+    if os.path.isfile(runs_path):
+        os.remove(runs_path)
+    return
+
+
+class TestJournal(object):
+    def __init__(self, run_dir, flush_every=50):
+        self.journal_path = os.path.join(const.OUTPUT_DIR, run_dir, 'journal.csv')
+        self.flush_every = flush_every
+        self.buffer = []
+        return
+
+    def load(self):
+        '''
+        output:
+          completed: a dict of run-length-encoded masks, or None's when only probability maps are saved,
+                     with names of completed images as keys
+        '''
+        completed = {}
+        if not os.path.isfile(self.journal_path):
+            return completed
+
+        with open(self.journal_path, newline='') as f:
+            content = f.read()
+
+        # drop the last line if it was cut off by a crash, so that new lines are not appended to it
+        if not content.endswith('\n'):
+            content = content[:content.rfind('\n') + 1]
+            with open(self.journal_path, 'w', newline='') as f:
+                f.write(content)
+
+        for row in csv.reader(content.split('\n')[:-1]):
+            completed[row[0]] = row[1] if row[1] else None
+        return completed
+
+    def add(self, img_name, rle=None):
+        self.buffer.append([img_name, rle if rle is not None else ''])
+        if len(self.buffer) >= self.flush_every:
+            self.flush()
+        return
+
+    def flush(self):
+        if len(self.buffer) == 0:
+            return
+
+        exp.create_dir_if_not_exist(os.path.dirname(self.journal_path))
+        with open(self.journal_path, 'a', newline='') as f:
+            csv.writer(f, lineterminator='\n').writerows(self.buffer)
+            f.flush()
+            os.fsync(f.fileno())
+
+        self.buffer = []
+        return
+
+    def remove(self):
+        self.buffer = []
+        if os.path.isfile(self.journal_path):
+            os.remove(self.journal_path)
+        return
@@ -16,6 +16,7 @@ import util.scale as scale
 import util.fancy_pca as fancy_pca
 import cv2
 from random import randrange
+from collections import OrderedDict
 
 
 def get_car_ids(img_names):
@@ -75,19 +76,24 @@ def load_small_imageset():
 def load_train_image(data_dir, img_name,
                      is_hflip=False, hshift=0, vshift=0, rotate=0, scale_size=0,
                      is_color_trans=False, is_fancy_pca_trans=False, is_edge_enh_trans=False,
-                     test_time_aug=None, paddings=None, tile_size=None):
+                     test_time_aug=None, paddings=None, tile_size=None, img_size=None, img_cache=None, rng=None):
     '''
     load a train image
+
+    input:
+      img_size: a tuple of ints (height, width) to resize the image to, or None to keep the original size
+      img_cache: an ImageCache to reuse decoded images across tiles of the same image
+      rng: a numpy random Generator for color and fancy PCA augmentations, or None to use np.random
     '''
     img_file_name = tile.get_img_name(img_name)
     img_ext = 'jpg'
-    img = load_image_file(data_dir, img_file_name, img_ext, rotate)
+    img = load_image_file(data_dir, img_file_name, img_ext, rotate, img_size, img_cache)
     # img.shape: (height, width, 3)
 
     if is_color_trans :
-        img = color.transform(img)
+        img = color.transform(img, rng)
     if is_fancy_pca_trans:
-        img = fancy_pca.rgb_shift(img)
+        img = fancy_pca.rgb_shift(img, rng)
     if is_edge_enh_trans:
         img = cv2.detailEnhance(img, sigma_s=5, sigma_r=0.1)
 
@@ -98,13 +104,29 @@ def load_train_image(data_dir, img_name,
 
 def load_train_mask(data_dir, img_name,
                     is_hflip=False, hshift=0, vshift=0, rotate=0, scale_size=0,
-                    test_time_aug=None, paddings=None, tile_size=None):
+                    test_time_aug=None, paddings=None, tile_size=None, img_size=None, img_cache=None):
     '''
     load a train image mask
     '''
     img_file_name = tile.get_img_name(img_name) + '_mask'
     img_ext = 'gif'
-    img = load_image_file(data_dir, img_file_name, img_ext, rotate)
+    img = load_image_file(data_dir, img_file_name, img_ext, rotate, img_size, img_cache)
+    # img.shape: (height, width)
+
+    img = img[np.newaxis, :, :]
+    # img.shape: (1, height, width)
+
+    return preprocess(img, img_name, is_hflip, hshift, vshift, scale_size, paddings, tile_size)
+
+def load_boundary_map(data_dir, img_name,
+                      is_hflip=False, hshift=0, vshift=0, rotate=0, scale_size=0,
+                      paddings=None, tile_size=None, img_size=None, img_cache=None):
+    '''
+    load a boundary map precomputed by util/boundary.py, augmented the same way as its mask
+    '''
+    img_file_name = tile.get_img_name(img_name) + '_boundary'
+    img_ext = 'png'
+    img = load_image_file(data_dir, img_file_name, img_ext, rotate, img_size, img_cache)
     # img.shape: (height, width)
 
     img = img[np.newaxis, :, :]
@@ -157,17 +179,84 @@ def preprocess(img, img_name, is_hflip, hshift, vshift, scale_size, paddings, ti
 
     return img
 
-def load_image_file(data_dir, img_name, img_ext, rotate):
+class ImageCache(object):
+    '''
+    least recently used cache of decoded images, before any augmentation
+
+    Each DataLoader worker holds its own copy, so it only pays off when tiles of an image are
+    loaded by the same worker close together, see ImageGroupedSampler in dataloader.py.
+    '''
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.imgs = OrderedDict()
+        self.num_hits = 0
+        self.num_misses = 0
+
+    def get(self, key):
+        img = self.imgs.get(key, None)
+        if img is None:
+            self.num_misses += 1
+        else:
+            self.num_hits += 1
+            self.imgs.move_to_end(key)
+        return img
+
+    def put(self, key, img):
+        self.imgs[key] = img
+        self.imgs.move_to_end(key)
+        while len(self.imgs) > self.max_size:
+            self.imgs.popitem(last=False)
+        return
+
+    def get_hit_rate(self):
+        num_lookups = self.num_hits + self.num_misses
+        return self.num_hits / num_lookups if num_lookups > 0 else 0
+
+def load_image_file(data_dir, img_name, img_ext, rotate, img_size=None, img_cache=None):
     '''
     load image file (.gif or .jpg)
+
+    input:
+      img_size: a tuple of ints (height, width) to resize the image to, or None to keep the original size.
+                JPEG images are decoded at reduced resolution when img_size is smaller than the original size
+      img_cache: an ImageCache to look up decoded images in
     '''
     img_path = os.path.join(data_dir, img_name + '.' + img_ext)
-    img = Image.open(img_path).rotate(rotate)
+
+    cache_key = (img_path, img_size)
+    img = img_cache.get(cache_key) if img_cache is not None else None
+    if img is None:
+        img = decode_image_file(img_path, img_ext, img_size)
+        if img_cache is not None:
+            img_cache.put(cache_key, img)
+
+    img = img.rotate(rotate)
 
     img = np.asarray(img) # img.shape: (height, width, 3) or (height, width) if mask
 
     return img
 
+def decode_image_file(img_path, img_ext, img_size=None):
+    '''
+    output:
+      img: a decoded PIL image, resized to img_size if given
+    '''
+    img = Image.open(img_path)
+
+    if img_size is not None and img.size != (img_size[1], img_size[0]):
+        if img.format == 'JPEG':
+            # let the JPEG decoder downscale by 1/2, 1/4 or 1/8 in the DCT domain,
+            # it picks the largest reduction that keeps the image at least as large as img_size
+            img.draft(img.mode, (img_size[1], img_size[0]))
+
+        # resize the remainder exactly, masks and boundary maps are resized with nearest neighbor to keep them binary
+        if img.size != (img_size[1], img_size[0]):
+            resample = Image.NEAREST if img_ext in ('gif', 'png') else Image.BILINEAR
+            img = img.resize((img_size[1], img_size[0]), resample)
+
+    img.load()
+    return img
+
 def get_filename(path):
     '''
     get only file name from file path
@@ -13,8 +13,9 @@ def encode(mask):
     img: numpy array, 1 - mask, 0 - background
     Returns run length as string formated
     '''
-    inds = mask.flatten()
-    runs = np.where(inds[1:] != inds[:-1])[0] + 2
+    # padded with background, so that runs starting at the first pixel or ending at the last one are closed
+    inds = np.pad(mask.flatten(), 1, mode='constant')
+    runs = np.where(inds[1:] != inds[:-1])[0] + 1
     runs[1::2] = runs[1::2] - runs[:-1:2]
     rle = ' '.join([str(r) for r in runs])
     return rle
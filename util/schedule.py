@@ -0,0 +1,59 @@
+'''
+Progressive-resolution training schedule
+
+A schedule is defined in the train section of an experiment config as a list of phases, e.g.
+  schedule:
+    - {scale: 0.25, epochs: 10, tile_size: [384, 512], batch_size: 8}
+    - {scale: 0.5,  epochs: 10, tile_size: [640, 1024]}
+    - {scale: 1}
+Images are resized on load by scale, and the last phase runs until num_epochs.
+tile_size and batch_size default to the train tile size scaled by scale, rounded up to a multiple of 128, and to the
+train batch size.
+'''
+
+
+def get_phases(cfg, multiple=128):
+    '''
+    input:
+      multiple: tile heights and widths have to be multiples of it, 2 ** (number of poolings) of the model
+    output:
+      phases: a list of dicts with keys index, scale, start_epoch, end_epoch, tile_size, batch_size,
+              a single full resolution phase if cfg has no schedule
+    '''
+    train_cfg = cfg['train']
+    schedule = train_cfg.get('schedule', None) or [{'scale': 1}]
+
+    phases = []
+    start_epoch = 1
+    for idx, phase_cfg in enumerate(schedule):
+        scale = phase_cfg.get('scale', 1)
+        is_last = idx == len(schedule) - 1
+
+        end_epoch = cfg['num_epochs'] if is_last else start_epoch + phase_cfg['epochs'] - 1
+
+        tile_size = phase_cfg.get('tile_size', None)
+        if tile_size is None:
+            tile_size = [-(-int(round(length * scale)) // multiple) * multiple for length in train_cfg['tile_size']]
+        assert all(length % multiple == 0 for length in tile_size), \
+            'tile_size {} of phase {} has to be a multiple of {}'.format(tile_size, idx, multiple)
+
+        phases.append({
+            'index': idx,
+            'scale': scale,
+            'start_epoch': start_epoch,
+            'end_epoch': end_epoch,
+            'tile_size': tuple(tile_size),
+            'batch_size': phase_cfg.get('batch_size', train_cfg['batch_size']),
+        })
+        start_epoch = end_epoch + 1
+
+    return phases
+
+def get_phase(phases, epoch):
+    '''
+    the phase that epoch belongs to, epochs past the schedule stay in the last phase
+    '''
+    for phase in phases:
+        if epoch <= phase['end_epoch']:
+            return phase
+    return phases[-1]
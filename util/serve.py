@@ -0,0 +1,252 @@
+'''
+Single-image inference with dynamic batching, used by run_server.py
+
+Every request is padded and cut into tiles with util/tile.py, the same way test.tester() predicts test images.
+Tiles of all requests go into one queue, and a single worker thread keeps the model warm and predicts them in batches:
+a batch starts with the oldest tile waiting and is run as soon as it has max_batch_size tiles, or max_wait_ms after
+it started, so that concurrent requests of several clients share batches while a single request waits at most
+max_wait_ms longer than its own tiles take.
+'''
+
+import io
+import time
+import queue
+import threading
+import collections
+from concurrent.futures import Future, TimeoutError
+
+import numpy as np
+import cv2
+from PIL import Image
+
+import util.const as const
+import util.tile as tile
+import util.submit as submit
+import util.cascade as cascade
+
+
+def decode_image(data, img_size=None):
+    '''
+    input:
+      data: bytes of an image file, e.g. a JPEG photo of a car
+      img_size: a tuple of ints (height, width) the model runs at, JPEG photos larger than it are decoded
+                at reduced resolution, but not smaller than img_size, like load.decode_image_file() does
+    output:
+      img: numpy array of shape (height, width, 3), of the decoded size
+      original_size: a tuple of ints (height, width) of the photo, the size its mask is returned at
+    '''
+    img = Image.open(io.BytesIO(data))
+    original_size = (img.size[1], img.size[0])
+
+    if img_size is not None and img.format == 'JPEG':
+        img.draft(img.mode, (img_size[1], img_size[0]))
+
+    return np.asarray(img.convert('RGB')), original_size
+
+def encode_png(mask):
+    '''
+    input:
+      mask: numpy array of shape (height, width), 1 - mask, 0 - background
+    output:
+      data: bytes of a grayscale PNG, 255 - mask, 0 - background
+    '''
+    f = io.BytesIO()
+    Image.fromarray((mask * 255).astype(np.uint8)).save(f, format='PNG')
+    return f.getvalue()
+
+
+class LatencyStats(object):
+    '''
+    latencies of the last window_size requests and sizes of batches run, shared by request threads
+    '''
+    def __init__(self, window_size=10000):
+        self.lock = threading.Lock()
+        self.latencies = collections.deque(maxlen=window_size)
+        self.num_requests = 0
+        self.num_batches = 0
+        self.num_tiles = 0
+        return
+
+    def add_request(self, latency):
+        with self.lock:
+            self.latencies.append(latency)
+            self.num_requests += 1
+        return
+
+    def add_batch(self, batch_size):
+        with self.lock:
+            self.num_batches += 1
+            self.num_tiles += batch_size
+        return
+
+    def get_stats(self):
+        '''
+        output:
+          stats: a dict of request and batch counts, and latency percentiles in ms of recent requests
+        '''
+        with self.lock:
+            latencies = np.array(self.latencies) * 1000
+            stats = {
+                'num_requests': self.num_requests,
+                'num_batches': self.num_batches,
+                'mean_batch_size': self.num_tiles / self.num_batches if self.num_batches > 0 else 0,
+            }
+
+        if len(latencies) > 0:
+            p50, p90, p99 = np.percentile(latencies, [50, 90, 99])
+            stats['latency_ms'] = {'p50': float(p50), 'p90': float(p90), 'p99': float(p99), 'max': float(latencies.max())}
+        else:
+            stats['latency_ms'] = None
+        return stats
+
+
+class DynamicBatcher(object):
+    def __init__(self, net, max_batch_size, max_wait_ms, stats):
+        '''
+        input:
+          net: a backend from backend.get_backend(), only called from the worker thread
+          stats: a LatencyStats to count batches in
+        '''
+        self.net = net
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        self.stats = stats
+        self.queue = queue.Queue()
+
+        self.worker = threading.Thread(target=self.run, daemon=True)
+        self.worker.start()
+        return
+
+    def get_queue_depth(self):
+        '''
+        number of tiles waiting to be batched
+        '''
+        return self.queue.qsize()
+
+    def submit(self, tiles):
+        '''
+        input:
+          tiles: a list of numpy arrays of shape (3, tile_height, tile_width)
+        output:
+          futures: a list of concurrent.futures.Future, one per tile, resolving to probabilities of shape (tile_height, tile_width)
+        '''
+        futures = []
+        for img_tile in tiles:
+            future = Future()
+            self.queue.put((img_tile, future))
+            futures.append(future)
+        return futures
+
+    def get_batch(self):
+        '''
+        wait for the next tile, then collect more until the batch is full or max_wait has passed
+        '''
+        batch = [ self.queue.get() ]
+        deadline = time.time() + self.max_wait
+
+        while len(batch) < self.max_batch_size:
+            timeout = deadline - time.time()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(self.queue.get(timeout=timeout))
+            except queue.Empty:
+                break
+
+        return batch
+
+    def run(self):
+        while True:
+            batch = self.get_batch()
+            tiles = [ img_tile for img_tile, _ in batch ]
+
+            try:
+                probs = cascade.predict_batch(self.net, np.stack(tiles))
+            except Exception as e:
+                for _, future in batch:
+                    future.set_exception(e)
+                continue
+
+            self.stats.add_batch(len(batch))
+            for j, (_, future) in enumerate(batch):
+                future.set_result(probs[j])
+
+
+class SegmentationService(object):
+    def __init__(self, net, paddings, tile_size, threshold=0.5, max_batch_size=8, max_wait_ms=10, timeout=30):
+        '''
+        input:
+          net: a backend from backend.get_backend()
+          paddings, tile_size: from the test config of the experiment
+          threshold: pixels with probability above it are predicted as car, from run_threshold_sweep.py
+          timeout: seconds a request waits for its tiles before predict_prob() raises TimeoutError
+        '''
+        self.paddings = paddings
+        self.tile_size = tile_size
+        self.threshold_bin = submit.get_threshold_bin(threshold)
+        self.timeout = timeout
+
+        padded_img_size = tile.get_padded_img_size(paddings)
+        self.tile_names, self.bodies = cascade.get_tile_bodies(padded_img_size, tile_size)
+        _, self.tile_border = tile.get_tile_layout(tile_size, padded_img_size)
+
+        net.eval()
+        self.stats = LatencyStats()
+        self.batcher = DynamicBatcher(net, max_batch_size, max_wait_ms, self.stats)
+        return
+
+    def warm_up(self):
+        '''
+        run a full batch once, so that the first request does not pay for CUDA initialization
+        '''
+        tiles = [ np.zeros((3,) + tuple(self.tile_size), dtype=np.uint8) ] * self.batcher.max_batch_size
+        for future in self.batcher.submit(tiles):
+            future.result()
+        return
+
+    def get_stats(self):
+        stats = self.stats.get_stats()
+        stats['queue_depth'] = self.batcher.get_queue_depth()
+        return stats
+
+    def predict_prob(self, img, output_size=None):
+        '''
+        input:
+          img: numpy array of shape (height, width, 3), resized to const.img_size for the model if it's of another size
+          output_size: a tuple of ints (height, width) to return probabilities at, the size of img by default
+        output:
+          img_prob: numpy array of shape output_size, or of the size of img by default
+
+        raises TimeoutError if the tiles are not predicted within timeout, e.g. when the queue is too long
+        '''
+        height, width = img.shape[:2]
+        if output_size is not None:
+            height, width = output_size
+
+        if img.shape[:2] != const.img_size:
+            img = cv2.resize(img, (const.img_size[1], const.img_size[0]), interpolation=cv2.INTER_LINEAR)
+
+        padded_img = tile.pad_image(np.moveaxis(img, 2, 0), self.paddings)
+        tiles = [ tile.get_tile(padded_img, tile_name, self.tile_size) for tile_name in self.tile_names ]
+        futures = self.batcher.submit(tiles)
+
+        # a single deadline for all tiles, so that a request waits at most timeout in total
+        deadline = time.time() + self.timeout
+
+        height_border, width_border = self.tile_border
+        probs = np.zeros(padded_img.shape[1:], dtype=np.float32)
+        for future, (y_start, y_end, x_start, x_end) in zip(futures, self.bodies):
+            tile_prob = future.result(timeout=max(deadline - time.time(), 0))
+            probs[y_start:y_end, x_start:x_end] = tile_prob[height_border:self.tile_size[0] - height_border, width_border:self.tile_size[1] - width_border]
+
+        img_prob = tile.remove_paddings(probs, self.paddings)
+        if (height, width) != const.img_size:
+            img_prob = cv2.resize(img_prob, (width, height), interpolation=cv2.INTER_LINEAR)
+        return img_prob
+
+    def predict_mask(self, img, output_size=None):
+        '''
+        output:
+          img_mask: numpy array of shape output_size or of the size of img, 1 - mask, 0 - background
+        '''
+        return submit.get_mask(submit.get_prob_bins(self.predict_prob(img, output_size)), self.threshold_bin)
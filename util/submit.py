@@ -12,6 +12,46 @@ def get_pred_dir(exp_name):
     pred_dir = os.path.join(const.OUTPUT_DIR, exp_name, const.SAVED_PREDS_DIR_NAME)
     return pred_dir
 
+def get_prob_bins(img_prob):
+    '''
+    input:
+      img_prob: a numpy array of probabilities from 0 to 1
+    output:
+      prob_bins: an int8 numpy array of probabilities in %, rounded down, the same values save_prob_map() saves
+    '''
+    return np.multiply(img_prob, 100).astype(np.int8)
+
+def floor_ensembled_bins(ensembled, total_weight=1):
+    '''
+    input:
+      ensembled: a float numpy array of weighted sums of probability maps in %
+      total_weight: sum of the weights, ensembled is divided by it
+    output:
+      prob_bins: an int8 numpy array of ensembled probabilities in %, rounded down
+    '''
+    # the epsilon keeps pixels every model predicts in the same bin in that bin, despite float rounding of the sum
+    return np.floor(np.clip(ensembled / total_weight, 0, 100) + 1e-3).astype(np.int8)
+
+def get_threshold_bin(threshold):
+    '''
+    input:
+      threshold: a float from 0 to 1, e.g. from run_threshold_sweep.py
+    output:
+      threshold_bin: an int from 0 to 100, pixels with prob_bins > threshold_bin are car,
+                     the same masks run_threshold_sweep.py scores for this threshold
+    '''
+    assert 0 <= threshold <= 1, 'threshold has to be between 0 and 1: {}'.format(threshold)
+    return int(round(threshold * 100))
+
+def get_mask(prob_bins, threshold_bin):
+    '''
+    input:
+      prob_bins: an int8 numpy array of probabilities in %, from get_prob_bins() or a saved probability map
+    output:
+      mask: a numpy array of 1's for car and 0's for background
+    '''
+    return (prob_bins > threshold_bin).astype(np.uint8)
+
 def save_prob_map(ensemble_dir, img_name, img_prob):
     '''
     input:
@@ -27,15 +67,13 @@ def save_prob_map(ensemble_dir, img_name, img_prob):
     exp.create_dir_if_not_exist(probs_dir)
     save_path = os.path.join(probs_dir, img_name + '.npy')
 
-    # convert from probability in percentage
-    # ex: 0.92 -> 92(%)
-    img_prob = np.multiply(img_prob, 100)
-
     if os.path.isfile(save_path):
         print('Warning: {} already exists'.format(save_path))
+        os.remove(save_path)  # it may be hard-linked into the inference cache, which must not be overwritten
 
-    # img_prob.dtype == np.float64
-    img_prob = img_prob.astype(np.int8) # which takes 0.014 sec while casting to np.float16 takes about 0.2 sec
+    # convert from probability in percentage
+    # ex: 0.92 -> 92(%)
+    img_prob = get_prob_bins(img_prob) # casting to np.int8 takes 0.014 sec while casting to np.float16 takes about 0.2 sec
     # One int8 1280x1918 image takes about 2.5 MB storage
     # while One float16 1280x1918 image takes about 4.9 MB storage
 
@@ -48,26 +86,22 @@ def save_ensembled_prob_map(ensemble_dir, img_name, img_prob):
     '''
     input:
       img_name: a string, name of the image
-      img_prob: an numpy array of probability of each pixel being foreground(car)
+      img_prob: an int8 numpy array of ensembled probabilities in %, from floor_ensembled_bins()
     '''
     # func_start = time.time()
 
     assert img_prob.shape == const.img_size  # image shape: (1280, 1918)
+    assert img_prob.dtype == np.int8
 
     probs_dir = os.path.join(const.OUTPUT_DIR, ensemble_dir, const.PROBS_DIR_NAME)
 
     exp.create_dir_if_not_exist(probs_dir)
     save_path = os.path.join(probs_dir, img_name + '.npy')
 
-    # convert from probability in percentage
-    # ex: 0.92 -> 92(%)
-    #img_prob = np.multiply(img_prob, 100)
-
     if os.path.isfile(save_path):
         print('Warning: {} already exists'.format(save_path))
 
-    # img_prob.dtype == np.float64
-    img_prob = img_prob.astype(np.int8) # which takes 0.014 sec while casting to np.float16 takes about 0.2 sec
+    # int8 instead of float16 to save storage:
     # One int8 1280x1918 image takes about 2.5 MB storage
     # while One float16 1280x1918 image takes about 4.9 MB storage
 
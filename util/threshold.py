@@ -0,0 +1,134 @@
+'''
+Threshold sweep over histograms of validation probability maps
+
+Validation probability maps are saved once in the same int8 percentage format as test predictions
+(see util/val_probs.py), in ./output/<exp_name>/val_probs/. Each image is then reduced to a histogram of
+(label, probability in %) counts, from which the dice of every threshold is computed without touching the maps again.
+
+The chosen threshold is saved in ./output/<exp_name>/threshold.txt, and masks are predicted with
+(probability in % rounded down > threshold bin), see submit.get_threshold_bin(), which is exactly what the sweep scores.
+'''
+
+import os
+
+import numpy as np
+
+import util.const as const
+import util.load as load
+import util.ensemble as ensemble
+import util.submit as submit
+
+
+NUM_BINS = 101  # probability maps are saved in % from 0 to 100
+DEFAULT_THRESHOLD = 0.5
+
+def get_val_probs_dir(exp_name, test_time_aug_name='nothing'):
+    '''
+    relative to ./output/, like the ensemble_dir of tile.merge_preds_if_possible()
+    '''
+    if test_time_aug_name == 'nothing':
+        return os.path.join(exp_name, 'val_probs')
+    return os.path.join(exp_name, 'val_probs_' + test_time_aug_name)
+
+def get_threshold_path(pred_dir):
+    return os.path.join(const.OUTPUT_DIR, pred_dir, 'threshold.txt')
+
+def save_threshold(pred_dir, threshold):
+    # saved as the probability of its bin, e.g. 0.57 instead of 0.5700000000000001
+    with open(get_threshold_path(pred_dir), 'w') as f:
+        f.write('{:.2f}\n'.format(submit.get_threshold_bin(threshold) / 100.))
+    return
+
+def load_threshold(pred_dir):
+    '''
+    output:
+      threshold: the threshold saved by run_threshold_sweep.py for an experiment or prediction dir,
+                 or for the experiment all predictions in the dir come from, or 0.5 if there is none
+    '''
+    threshold_path = get_threshold_path(pred_dir)
+
+    if not os.path.isfile(threshold_path) and os.path.isfile(os.path.join(const.OUTPUT_DIR, pred_dir, 'models_ensembled.txt')):
+        exp_names, _ = ensemble.get_models_ensembled(pred_dir)
+        if len(set(exp_names)) == 1:
+            threshold_path = get_threshold_path(exp_names[0])
+
+    if not os.path.isfile(threshold_path):
+        return DEFAULT_THRESHOLD
+
+    with open(threshold_path) as f:
+        return float(f.read().strip())
+
+def get_histogram(img_prob, target):
+    '''
+    input:
+      img_prob: int8 numpy array of shape (height, width), probabilities in % from 0 to 100
+      target: numpy array of shape (height, width) with 0's and 1's
+    output:
+      histogram: numpy array of shape (2, NUM_BINS), pixel counts of background and car for each probability
+    '''
+    bins = np.clip(img_prob.astype(np.int64), 0, NUM_BINS - 1)
+    labels = (target > 0).astype(np.int64)
+    return np.bincount((labels * NUM_BINS + bins).ravel(), minlength=2 * NUM_BINS).reshape(2, NUM_BINS)
+
+def build_histograms(val_probs_dir, img_names=None):
+    '''
+    output:
+      img_names: names of validation images with saved probability maps
+      histograms: numpy array of shape (num_imgs, 2, NUM_BINS)
+    '''
+    probs_dir = os.path.join(const.OUTPUT_DIR, val_probs_dir, const.PROBS_DIR_NAME)
+    if img_names is None:
+        img_names = sorted(load.list_npy_in_dir(probs_dir))
+
+    histograms = np.zeros((len(img_names), 2, NUM_BINS), dtype=np.int64)
+    for i, img_name in enumerate(img_names):
+        img_prob = np.load(os.path.join(probs_dir, img_name + '.npy'))
+        target = load.load_image_file(const.TRAIN_MASK_DIR, img_name + '_mask', 'gif', 0)
+        histograms[i] = get_histogram(img_prob, target)
+
+    return img_names, histograms
+
+def get_histograms_path(val_probs_dir):
+    return os.path.join(const.OUTPUT_DIR, val_probs_dir, 'histograms.npz')
+
+def load_histograms(val_probs_dir, img_names):
+    '''
+    load histograms saved in ./output/<val_probs_dir>/histograms.npz, or build and save them when they are missing or for other images
+    '''
+    histograms_path = get_histograms_path(val_probs_dir)
+    if os.path.isfile(histograms_path):
+        saved = np.load(histograms_path)
+        if list(saved['img_names']) == list(img_names):
+            return saved['histograms']
+
+    _, histograms = build_histograms(val_probs_dir, img_names)
+    np.savez(histograms_path, img_names=np.array(img_names), histograms=histograms)
+    return histograms
+
+def get_dices(histograms):
+    '''
+    input:
+      histograms: numpy array of shape (num_imgs, 2, num_bins)
+    output:
+      dices: numpy array of shape (num_imgs, num_bins), dice of each image when masks are (bin > k) for threshold bin k
+    '''
+    # pixels predicted as car with threshold bin k are the ones in bins k+1 and above
+    above = np.cumsum(histograms[:, :, ::-1], axis=2)[:, :, ::-1]
+    above = np.concatenate([ above[:, :, 1:], np.zeros_like(above[:, :, :1]) ], axis=2)
+
+    true_positives = above[:, 1]
+    predicted = above[:, 0] + above[:, 1]
+    positives = histograms[:, 1].sum(axis=1, keepdims=True)
+
+    denominator = predicted + positives
+    # dice is 1 when both the mask and the target are empty
+    return np.where(denominator > 0, 2. * true_positives / np.maximum(denominator, 1), 1.)
+
+def sweep_thresholds(histograms):
+    '''
+    output:
+      thresholds: numpy array of shape (NUM_BINS,), probabilities from 0 to 1
+      mean_dices: numpy array of shape (NUM_BINS,), mean dice over images for each threshold
+    '''
+    thresholds = np.arange(NUM_BINS) / (NUM_BINS - 1.)
+    return thresholds, get_dices(histograms).mean(axis=0)
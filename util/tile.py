@@ -1,5 +1,7 @@
 import torch
 
+import os
+
 import numpy as np
 import math
 
@@ -30,6 +32,31 @@ def remove_tile_borders(image, tile_borders):
     image = image.contiguous()
     return image
 
+def get_padded_img_size(paddings, resolution_scale=1):
+    '''
+    input:
+      paddings: a tuple of ints (height_padding, width_padding)
+      resolution_scale: a float, 0.5 for images loaded at half resolution for example
+    output:
+      padded_img_size: a tuple of ints (height, width), size of a padded image at the given resolution
+    '''
+    img_height, img_width = const.img_size
+    padded_img_size = img_height + 2 * paddings[0], img_width + 2 * paddings[1]
+
+    if resolution_scale != 1:
+        padded_img_size = int(round(padded_img_size[0] * resolution_scale)), int(round(padded_img_size[1] * resolution_scale))
+
+    return padded_img_size
+
+def get_scaled_img_size(paddings, resolution_scale):
+    '''
+    size to resize images to before padding, so that padded images are of size get_padded_img_size(paddings, resolution_scale)
+
+    Note that the aspect ratio may be off by a pixel, since paddings are not scaled.
+    '''
+    padded_height, padded_width = get_padded_img_size(paddings, resolution_scale)
+    return padded_height - 2 * paddings[0], padded_width - 2 * paddings[1]
+
 def get_tile_border(img_length, tile_length, num_tiles):
     '''
     input:
@@ -204,13 +231,18 @@ def crop_tile(img, tile_pos, tile_size, tile_layout, tile_border):
 
     return cropped_img
 
-def merge_preds_if_possible(exp_name, tile_probs, paddings, img_rles, is_ensemble=False, ensemble_dir=None, reverse_test_time_aug=None):
+def merge_preds_if_possible(exp_name, tile_probs, paddings, img_rles, is_ensemble=False, ensemble_dir=None, reverse_test_time_aug=None, crf_pool=None, threshold=0.5, infer_cache=None):
     '''
     input:
       tile_probs: a dict of numpy arrays, with image tile names as keys and predicted probibility maps as values
       img_rles: a dict of strings, with image names as keys and predicted run-length-encoded masks as values
       is_ensemble: a boolean indicating if this is in ensemble mode or not
       reverse_test_time_aug: a function that reverse the test time augmentation done to the input test image
+      crf_pool: a crf.CRFPool to post-process image probability maps with, which fills img_rles when done
+      threshold: pixels with probability above it are predicted as car, see util/threshold.py
+      infer_cache: an infer_cache.InferenceCache to save merged predictions into, or None
+    output:
+      merged_img_names: names of images merged by this call
     '''
     if is_ensemble:
         assert img_rles is None
@@ -220,7 +252,7 @@ def merge_preds_if_possible(exp_name, tile_probs, paddings, img_rles, is_ensembl
         assert reverse_test_time_aug is None  # Never do Test Time augmentation right before submitting
 
     if len(tile_probs) == 0:
-        return
+        return []
 
     # get tile names of computed probability maps
     tile_names = list(tile_probs.keys())
@@ -236,6 +268,7 @@ def merge_preds_if_possible(exp_name, tile_probs, paddings, img_rles, is_ensembl
     tiles_by_imgs = group_tile_names(tile_names)
     img_names = tiles_by_imgs.keys()
 
+    merged_img_names = []
     for img_name in img_names:
         if len(tiles_by_imgs[img_name]) == num_tiles:
             # all tiles of this image are here and ready to be merged
@@ -255,18 +288,24 @@ def merge_preds_if_possible(exp_name, tile_probs, paddings, img_rles, is_ensembl
             if is_ensemble:
                 # save predictions
                 submit.save_prob_map(ensemble_dir, img_name, img_prob)
+                if infer_cache is not None:
+                    infer_cache.put_prob_map(img_name, os.path.join(const.OUTPUT_DIR, ensemble_dir, const.PROBS_DIR_NAME, img_name + '.npy'))
+            elif crf_pool is not None:
+                crf_pool.submit(img_name, img_prob, img_rles, threshold=threshold)
             else:
-                # generate image mask from image probability map
-                img_mask = np.zeros(img_prob.shape)
-                img_mask[img_prob > 0.5] = 1
+                # generate image mask from image probability map, binned like saved probability maps
+                img_mask = submit.get_mask(submit.get_prob_bins(img_prob), submit.get_threshold_bin(threshold))
 
                 # employ Run Length Encoding
                 img_rles[img_name] = run_length.encode(img_mask)
+                if infer_cache is not None:
+                    infer_cache.put_rle(img_name, img_rles[img_name])
 
 
             # remove merged tiles from tile_probs
             remove_keys_from_dict(tiles_by_imgs[img_name], tile_probs)
-    return
+            merged_img_names.append(img_name)
+    return merged_img_names
 
 def group_tile_names(tile_names):
     '''
@@ -0,0 +1,84 @@
+import time
+from collections import OrderedDict, deque
+
+import numpy as np
+import torch
+
+
+class StageTimer(object):
+    '''
+    named timers over a rolling window of iterations
+
+    usage:
+      timer.start('forward')
+      outputs = net(images)
+      timer.stop('forward')
+
+    Note that CUDA kernels run asynchronously, so GPU stages are only timed correctly with sync_cuda=True,
+    which adds a device synchronization at every start() and stop().
+    '''
+    def __init__(self, window_size=100, sync_cuda=False):
+        self.window_size = window_size
+        self.sync_cuda = sync_cuda and torch.cuda.is_available()
+
+        self.durations = OrderedDict()
+        self.start_times = {}
+
+    def start(self, stage):
+        if self.sync_cuda:
+            torch.cuda.synchronize()
+        self.start_times[stage] = time.time()
+        return
+
+    def stop(self, stage):
+        if stage not in self.start_times:
+            return
+
+        if self.sync_cuda:
+            torch.cuda.synchronize()
+        duration = time.time() - self.start_times.pop(stage)
+
+        if stage not in self.durations:
+            self.durations[stage] = deque(maxlen=self.window_size)
+        self.durations[stage].append(duration)
+        return
+
+    def get_stats(self):
+        '''
+        output:
+          stats: an OrderedDict with stage names as keys and dicts of mean/p50/p95/p99 in seconds as values
+        '''
+        stats = OrderedDict()
+        for stage, durations in self.durations.items():
+            durations = np.array(durations)
+            p50, p95, p99 = np.percentile(durations, [50, 95, 99])
+            stats[stage] = {
+                'mean': durations.mean(),
+                'p50': p50,
+                'p95': p95,
+                'p99': p99,
+            }
+        return stats
+
+    def summary(self):
+        '''
+        a printable table of stage stats in milliseconds
+        '''
+        stats = self.get_stats()
+        total_mean = sum(stage_stats['mean'] for stage_stats in stats.values())
+
+        lines = ['{:<12} {:>9} {:>9} {:>9} {:>9} {:>6}'.format('stage', 'mean(ms)', 'p50(ms)', 'p95(ms)', 'p99(ms)', '%')]
+        for stage, stage_stats in stats.items():
+            lines.append('{:<12} {:>9.1f} {:>9.1f} {:>9.1f} {:>9.1f} {:>6.1f}'.format(
+                stage,
+                stage_stats['mean'] * 1000, stage_stats['p50'] * 1000,
+                stage_stats['p95'] * 1000, stage_stats['p99'] * 1000,
+                100 * stage_stats['mean'] / total_mean if total_mean > 0 else 0))
+
+        return '\n'.join(lines)
+
+    def log_to_crayon(self, experiment, step):
+        for stage, stage_stats in self.get_stats().items():
+            for stat_name, value in stage_stats.items():
+                experiment.add_scalar_value('time {} {}'.format(stage, stat_name), value, step=step)
+        return
@@ -0,0 +1,126 @@
+'''
+Cache of pre-tiled validation images and targets
+
+Validation images are never augmented, so they are decoded and tiled only once and saved as
+  images.npy:  uint8 array of shape (num_tiles, 3, tile_height, tile_width)
+  targets.npy: bit-packed uint8 array of shape (num_tiles, tile_height * tile_width / 8)
+which are read back as memory-mapped arrays.
+'''
+
+import os
+import csv
+import random
+
+import numpy as np
+
+import util.const as const
+import util.exp as exp
+
+
+def get_cache_dir(imageset_name, paddings, tile_size):
+    tile_height, tile_width = tile_size
+    height_padding, width_padding = paddings
+    dir_name = '{}_{}x{}_pad{}x{}'.format(imageset_name, tile_height, tile_width, height_padding, width_padding)
+    return os.path.join(const.CACHE_DIR, dir_name)
+
+def get_done_path(cache_dir):
+    return os.path.join(cache_dir, 'done')
+
+def is_cache_complete(cache_dir):
+    return os.path.isfile(get_done_path(cache_dir))
+
+def pack_mask(mask):
+    '''
+    input:
+      mask: numpy array of shape (1, height, width) with 0's and 1's
+    '''
+    return np.packbits(mask.reshape(-1) > 0)
+
+def unpack_mask(packed, tile_size):
+    tile_height, tile_width = tile_size
+    mask = np.unpackbits(packed)[:tile_height * tile_width]
+    return mask.reshape(1, tile_height, tile_width)
+
+def build_cache(cache_dir, data_loader, num_tiles, tile_size):
+    '''
+    save all tiles and targets from data_loader, which must not shuffle nor augment
+    '''
+    exp.create_dir_if_not_exist(cache_dir)
+
+    tile_height, tile_width = tile_size
+    packed_length = (tile_height * tile_width + 7) // 8
+
+    images = np.lib.format.open_memmap(os.path.join(cache_dir, 'images.npy'), mode='w+',
+                                       dtype=np.uint8, shape=(num_tiles, 3, tile_height, tile_width))
+    targets = np.lib.format.open_memmap(os.path.join(cache_dir, 'targets.npy'), mode='w+',
+                                        dtype=np.uint8, shape=(num_tiles, packed_length))
+
+    tile_names = []
+    for i, (batch_tile_names, batch_images, batch_targets) in enumerate(data_loader):
+        batch_images = batch_images.numpy()
+        batch_targets = batch_targets.numpy()
+
+        for j in range(len(batch_tile_names)):
+            idx = len(tile_names)
+            images[idx] = batch_images[j]
+            targets[idx] = pack_mask(batch_targets[j])
+            tile_names.append(batch_tile_names[j])
+
+        if (i % 100) == 0:
+            print('Caching {}: {}/{} tiles'.format(cache_dir, len(tile_names), num_tiles))
+
+    assert len(tile_names) == num_tiles
+
+    images.flush()
+    targets.flush()
+    del images, targets
+
+    with open(os.path.join(cache_dir, 'tile_names.csv'), 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerows([ [tile_name] for tile_name in tile_names ])
+
+    # mark the cache as complete only when everything is written
+    open(get_done_path(cache_dir), 'a').close()
+    return
+
+def load_tile_names(cache_dir):
+    tile_names = []
+    with open(os.path.join(cache_dir, 'tile_names.csv'), newline='') as f:
+        reader = csv.reader(f)
+        for row in reader:
+            tile_names.append(row[0])
+    return tile_names
+
+def open_cache(cache_dir):
+    '''
+    output:
+      images, targets: read-only memory-mapped arrays
+    '''
+    images = np.load(os.path.join(cache_dir, 'images.npy'), mmap_mode='r')
+    targets = np.load(os.path.join(cache_dir, 'targets.npy'), mmap_mode='r')
+    return images, targets
+
+
+def get_stratified_subset(img_names, subset_size, seed=0):
+    '''
+    randomly pick about the same number of images from every view angle (the _01 to _16 suffix of image names)
+    '''
+    rng = random.Random(seed)
+
+    img_names_by_view = {}
+    for img_name in sorted(img_names):
+        view = img_name.split('_')[1]
+        img_names_by_view.setdefault(view, []).append(img_name)
+
+    for view in img_names_by_view:
+        rng.shuffle(img_names_by_view[view])
+
+    subset = []
+    views = sorted(img_names_by_view.keys())
+    while len(subset) < min(subset_size, len(img_names)):
+        for view in views:
+            if img_names_by_view[view] and len(subset) < subset_size:
+                subset.append(img_names_by_view[view].pop())
+
+    subset.sort()
+    return subset
@@ -0,0 +1,74 @@
+'''
+Probability maps of validation images, predicted once for threshold sweeps and ensemble weight fitting
+
+Maps are saved with submit.save_prob_map() in the same int8 percentage format as test predictions,
+in ./output/<exp_name>/val_probs/ without Test Time Augmentation and ./output/<exp_name>/val_probs_<aug_name>/ with it.
+'''
+
+import os
+
+import numpy as np
+
+import util.exp as exp
+import util.const as const
+import util.load as load
+import util.tile as tile
+import util.submit as submit
+import util.backend as backend
+import util.cascade as cascade
+import util.augmentation as augmentation
+import util.threshold as threshold
+import config
+
+
+def get_TTA_func(test_time_aug_name):
+    '''
+    output:
+      test_time_aug, reverse_test_time_aug: functions from augmentation.get_TTA_funcs()
+    '''
+    for aug_name, test_time_aug, reverse_test_time_aug in augmentation.get_TTA_funcs(True):
+        if aug_name == test_time_aug_name:
+            return test_time_aug, reverse_test_time_aug
+
+    raise ValueError('Unknown test time augmentation: {}'.format(test_time_aug_name))
+
+def get_missing_imgs(val_probs_dir, img_names):
+    probs_dir = os.path.join(const.OUTPUT_DIR, val_probs_dir, const.PROBS_DIR_NAME)
+    return [ img_name for img_name in img_names if not os.path.isfile(os.path.join(probs_dir, img_name + '.npy')) ]
+
+def cache_val_probs(exp_name, img_names, batch_size, test_time_aug_name='nothing', net=None):
+    '''
+    save probability maps of validation images that don't have one yet, the same way test.tester() predicts test images
+
+    input:
+      net: a backend of the model of exp_name, loaded when None and there are missing maps
+    '''
+    val_probs_dir = threshold.get_val_probs_dir(exp_name, test_time_aug_name)
+    missing = get_missing_imgs(val_probs_dir, img_names)
+    if len(missing) == 0:
+        return
+
+    cfg = config.load_config_file(exp_name)
+    paddings = cfg['test']['paddings']
+    test_time_aug, reverse_test_time_aug = get_TTA_func(test_time_aug_name)
+
+    if net is None:
+        net, _, _, _ = exp.load_exp(exp_name)
+        net = backend.get_backend(net)
+    net.eval()
+
+    for i, img_name in enumerate(missing):
+        img = np.moveaxis(load.load_image_file(const.TRAIN_DIR, img_name, 'jpg', 0), 2, 0)
+        if test_time_aug is not None:
+            img = test_time_aug(img)
+
+        probs = cascade.predict_full(net, tile.pad_image(img, paddings), cfg['test']['tile_size'], batch_size=batch_size)
+        img_prob = tile.remove_paddings(probs, paddings)
+        if reverse_test_time_aug is not None:
+            img_prob = reverse_test_time_aug(img_prob)
+
+        submit.save_prob_map(val_probs_dir, img_name, img_prob)
+
+        if (i % 100) == 0:
+            print('Caching validation probability maps of {}, {}: {}/{}'.format(exp_name, test_time_aug_name, i + 1, len(missing)))
+    return